@@ -0,0 +1,71 @@
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+from flask import jsonify
+from flask_restful import reqparse
+
+"""
+bench_serialization.py
+========================================================
+Micro-benchmark of decoding a request and encoding visits, compares the reqparse and MyAppSchema path
+with parse_args and visits_json used by restAPI.py
+"""
+
+ROW_COUNTS = (1, 10, 100, 1000)
+REPEAT = 200
+
+old_args = reqparse.RequestParser()
+old_args.add_argument("visit_id", type=int)
+old_args.add_argument("visit_date", type=int)
+old_args.add_argument("patient_id", type=str)
+old_args.add_argument("patient_name", type=str)
+old_args.add_argument("doctor_name", type=str)
+
+
+def old_path(restAPI):
+    """Request handling as it was done before, reqparse, VisitModel objects and MyAppSchema"""
+    req = old_args.parse_args()
+    entries = restAPI.VisitModel.query.join(restAPI.Doctor).filter(
+        restAPI.Doctor.doctor_name == req["doctor_name"]).order_by(restAPI.VisitModel.visit_id).all()
+    return jsonify(restAPI.my_app_schema.dump(entries)).get_data()
+
+
+def new_path(restAPI):
+    """Request handling of restAPI.py, parse_args, column tuples and visits_json"""
+    req = restAPI.parse_args(restAPI.VISIT_ARGS)
+    rows = restAPI.filter_key(restAPI.visit_rows(), restAPI.VisitModel.doctor_id,
+                              restAPI.find_doctor(req["doctor_name"])).order_by(restAPI.VisitModel.visit_id).all()
+    return restAPI.visits_json(rows).encode()
+
+
+def main():
+    """Fills a temporary database and prints time per request and per row of both paths"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import restAPI
+
+    app = restAPI.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')})
+    with app.app_context():
+        doctors, patients, _ = restAPI.visit_keys(
+            [f"Doctor {rows}" for rows in ROW_COUNTS],
+            {str(10000000000 + i): "Jan Kowalski" for i in range(max(ROW_COUNTS))})
+        for rows in ROW_COUNTS:
+            restAPI.db.session.execute(restAPI.VisitModel.__table__.insert(), [
+                {"visit_date": 100000000 + i, "patient_key": patients[str(10000000000 + i)],
+                 "doctor_id": doctors[f"Doctor {rows}"]} for i in range(rows)])
+        restAPI.db.session.commit()
+
+    print(f"{'rows':>6} {'old us/req':>12} {'new us/req':>12} {'old us/row':>12} {'new us/row':>12} {'speedup':>8}")
+    for rows in ROW_COUNTS:
+        with app.test_request_context(query_string={"doctor_name": f"Doctor {rows}"}):
+            if json.loads(old_path(restAPI)) != json.loads(new_path(restAPI)):
+                raise AssertionError(f"Different output for {rows} rows")
+            old = min(timeit.repeat(lambda: old_path(restAPI), number=REPEAT, repeat=3)) / REPEAT * 1e6
+            new = min(timeit.repeat(lambda: new_path(restAPI), number=REPEAT, repeat=3)) / REPEAT * 1e6
+        print(f"{rows:>6} {old:>12.1f} {new:>12.1f} {old / rows:>12.2f} {new / rows:>12.2f} {old / new:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+import argparse
+import datetime
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+"""
+benchmark.py
+========================================================
+Concurrent load test of a running restAPI.py instance
+
+Many workers send a configurable mix of bookings, conflicting bookings, reads, updates and deletes,
+the script reports throughput and latency percentiles of every route, counts double-bookings
+and saves the results as json, optionally comparing them with a previous run
+"""
+
+BASE = "http://127.0.0.1:5000/"
+# Share of every operation in the mix
+DEFAULT_MIX = "book=30,conflict=20,doctor=15,patient=10,date=10,update=10,delete=5"
+OPERATIONS = ("book", "conflict", "doctor", "patient", "date", "update", "delete")
+DOCTORS = 20
+# Slots that all workers try to book at once, at most one booking of each may succeed
+HOT_SLOTS = 10
+FIRST_HOUR = 8
+HOURS = 11
+
+
+def parse_mix(text):
+    """Reads the operation mix
+
+    :param text: comma separated pairs operation=weight
+    :type text: str
+    :returns: dictionary of operations and their weights
+    :rtype: dict
+    """
+    mix = {}
+    for pair in text.split(","):
+        operation, weight = pair.split("=")
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {operation}")
+        mix[operation] = float(weight)
+    return mix
+
+
+def slot_date(number):
+    """Returns visit date of the number-th hourly slot counted from 2030/01/01 08.00
+
+    :param number: number of the slot
+    :type number: int
+    :returns: date in 1YYMMDDHH format
+    :rtype: int
+    """
+    day = datetime.date(2030, 1, 1) + datetime.timedelta(days=number // HOURS)
+    return int(f"1{day:%y%m%d}{FIRST_HOUR + number % HOURS:02d}")
+
+
+def percentile(values, fraction):
+    """Returns percentile of sorted values using the nearest-rank method
+
+    :param values: sorted values
+    :type values: list
+    :param fraction: percentile as fraction, e.g. 0.95
+    :type fraction: float
+    :returns: the percentile or None if there are no values
+    :rtype: float
+    """
+    if not values:
+        return None
+    return values[max(int(round(fraction * len(values) + 0.5)) - 1, 0)]
+
+
+class Benchmark:
+    """State of one benchmark run shared by all workers
+
+    :param base: address of the server
+    :type base: str
+    :param mix: operations and their weights
+    :type mix: dict
+    """
+    def __init__(self, base, mix):
+        self.base = base
+        self.operations = list(mix)
+        self.weights = [mix[operation] for operation in self.operations]
+        self.tag = f"Bench {random.randrange(10 ** 6):06d}"
+        self.id_base = random.randrange(10 ** 12, 10 ** 15)
+        self.numbers = itertools.count()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.hot_bookings = Counter()
+        self.owned = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def session(self):
+        """Returns keep-alive session of the current worker"""
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def call(self, route, method, url, **kwargs):
+        """Sends a request and records its latency and status
+
+        :param route: name of the route in the report
+        :type route: str
+        :param method: HTTP method
+        :type method: str
+        :param url: path of the request
+        :type url: str
+        :returns: response or None if the request failed
+        :rtype: requests.Response object
+        """
+        start = time.perf_counter()
+        try:
+            response = self.session().request(method, self.base + url, **kwargs)
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, "failed"
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies[route].append(elapsed)
+            self.statuses[route][status] += 1
+        return response
+
+    def visit(self, number, doctor, visit_date):
+        """Returns data of a new visit of the run"""
+        return {"visit_id": self.id_base + number, "visit_date": visit_date, "patient_id": str(10 ** 10 + number),
+                "patient_name": "Bench Patient", "doctor_name": f"{self.tag} Doctor {doctor}"}
+
+    def book(self):
+        """Books a free slot"""
+        number = next(self.numbers)
+        data = self.visit(number, number % DOCTORS, slot_date(number // DOCTORS))
+        response = self.call("POST /visit", "POST", "visit", json=data)
+        if response is not None and response.status_code == 201:
+            with self.lock:
+                self.owned.append(data)
+
+    def conflict(self):
+        """Books one of the slots contested by all workers"""
+        number = next(self.numbers)
+        slot = random.randrange(HOT_SLOTS)
+        data = self.visit(number, "Hot", slot_date(slot))
+        response = self.call("POST /visit (conflict)", "POST", "visit", json=data)
+        if response is not None and response.status_code == 201:
+            with self.lock:
+                self.hot_bookings[slot] += 1
+
+    def doctor(self):
+        """Reads visits of a doctor"""
+        self.call("GET /visit/doctor", "GET", "visit/doctor",
+                  params={"doctor_name": f"{self.tag} Doctor {random.randrange(DOCTORS)}"})
+
+    def patient(self):
+        """Reads visits of a patient booked by the run"""
+        with self.lock:
+            data = random.choice(self.owned) if self.owned else None
+        if data is not None:
+            self.call("GET /visit/patient", "GET", "visit/patient", params={"patient_id": data["patient_id"]})
+
+    def date(self):
+        """Reads visits of a day"""
+        self.call("GET /visit/date", "GET", "visit/date",
+                  params={"visit_date": slot_date(random.randrange(HOURS * 30))})
+
+    def update(self):
+        """Updates a visit booked by the run"""
+        with self.lock:
+            data = random.choice(self.owned) if self.owned else None
+        if data is not None:
+            self.call("PUT /visit/<visit_id>", "PUT", f"visit/{data['visit_id']}",
+                      json=dict(data, patient_name="Bench Patient Updated"))
+
+    def delete(self):
+        """Deletes a visit booked by the run"""
+        with self.lock:
+            data = self.owned.pop(random.randrange(len(self.owned))) if self.owned else None
+        if data is not None:
+            self.call("DELETE /visit/<visit_id>", "DELETE", f"visit/{data['visit_id']}")
+
+    def worker(self, deadline):
+        """Sends operations drawn from the mix until the deadline"""
+        while time.perf_counter() < deadline:
+            getattr(self, random.choices(self.operations, self.weights)[0])()
+
+    def double_bookings(self):
+        """Counts slots booked more than once
+
+        :returns: number of extra bookings acknowledged by the server and number of extra rows in the database
+        :rtype: tuple
+        """
+        acknowledged = sum(count - 1 for count in self.hot_bookings.values() if count > 1)
+        stored = 0
+        for doctor in [f"{self.tag} Doctor {number}" for number in range(DOCTORS)] + [f"{self.tag} Doctor Hot"]:
+            response = self.session().get(self.base + "visit/doctor", params={"doctor_name": doctor,
+                                                                              "format": "ndjson"})
+            dates = Counter(json.loads(line)["visit_date"] for line in response.text.splitlines() if line)
+            stored += sum(count - 1 for count in dates.values() if count > 1)
+        return acknowledged, stored
+
+    def cleanup(self):
+        """Deletes visits made by the run"""
+        for doctor in [f"{self.tag} Doctor {number}" for number in range(DOCTORS)] + [f"{self.tag} Doctor Hot"]:
+            response = self.session().get(self.base + "visit/doctor", params={"doctor_name": doctor,
+                                                                              "format": "ndjson"})
+            for line in response.text.splitlines():
+                if line:
+                    self.session().delete(self.base + f"visit/{json.loads(line)['visit_id']}")
+
+    def report(self, duration):
+        """Returns results of the run
+
+        :param duration: duration of the run in seconds
+        :type duration: float
+        :returns: throughput, latency percentiles and statuses of every route
+        :rtype: dict
+        """
+        routes = {}
+        for route, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            routes[route] = {"requests": len(latencies), "throughput": len(latencies) / duration,
+                             "p50_ms": percentile(latencies, 0.50) * 1000,
+                             "p95_ms": percentile(latencies, 0.95) * 1000,
+                             "p99_ms": percentile(latencies, 0.99) * 1000,
+                             "statuses": {str(status): count for status, count in self.statuses[route].items()}}
+        total = sum(route["requests"] for route in routes.values())
+        return {"routes": routes, "requests": total, "throughput": total / duration}
+
+
+def compare(results, previous, tolerance):
+    """Prints differences from a previous run
+
+    :param results: results of this run
+    :type results: dict
+    :param previous: results of the previous run
+    :type previous: dict
+    :param tolerance: allowed relative growth of p95 latency and drop of throughput
+    :type tolerance: float
+    :returns: list of regressions
+    :rtype: list
+    """
+    regressions = []
+    for route, now in results["routes"].items():
+        before = previous["routes"].get(route)
+        if before is None:
+            continue
+        print(f"{route:<28} p95 {before['p95_ms']:8.2f} -> {now['p95_ms']:8.2f} ms, "
+              f"throughput {before['throughput']:8.1f} -> {now['throughput']:8.1f} rq/s")
+        if now["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{route} p95 latency")
+        if now["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{route} throughput")
+    return regressions
+
+
+def main(argv=None):
+    """Runs the benchmark, returns exit code 1 on double-bookings or regressions"""
+    parser = argparse.ArgumentParser(description="Concurrent load test of a running restAPI.py instance")
+    parser.add_argument("--base", default=BASE, help="address of the server")
+    parser.add_argument("--workers", type=int, default=16, help="number of concurrent workers")
+    parser.add_argument("--duration", type=float, default=10, help="duration of the run in seconds")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help="operation=weight,...")
+    parser.add_argument("--output", help="json file for the results")
+    parser.add_argument("--compare", help="json file with results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--keep", action="store_true", help="don't delete visits made by the run")
+    args = parser.parse_args(argv)
+
+    benchmark = Benchmark(args.base, args.mix)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.workers) as executor:
+        for future in [executor.submit(benchmark.worker, start + args.duration) for _ in range(args.workers)]:
+            future.result()
+    duration = time.perf_counter() - start
+
+    results = benchmark.report(duration)
+    results["config"] = {"base": args.base, "workers": args.workers, "duration": args.duration, "mix": args.mix,
+                         "started": datetime.datetime.now().isoformat(timespec="seconds")}
+    acknowledged, stored = benchmark.double_bookings()
+    results["double_bookings"] = {"acknowledged": acknowledged, "stored": stored}
+    if not args.keep:
+        benchmark.cleanup()
+
+    print(f"{'route':<28} {'requests':>9} {'rq/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  statuses")
+    for route, stats in results["routes"].items():
+        print(f"{route:<28} {stats['requests']:>9} {stats['throughput']:>9.1f} {stats['p50_ms']:>8.2f} "
+              f"{stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f}  {stats['statuses']}")
+    print(f"total {results['requests']} requests, {results['throughput']:.1f} rq/s, "
+          f"double-bookings acknowledged: {acknowledged}, stored: {stored}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    failed = acknowledged > 0 or stored > 0
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
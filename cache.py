@@ -0,0 +1,119 @@
+import threading
+from collections import OrderedDict
+
+"""
+cache.py
+========================================================
+Size-bounded LRU cache of serialized responses invalidated by tags
+"""
+
+
+class ResponseCache:
+    """LRU cache of responses
+
+    Every entry is stored with a set of tags describing which visits it was made of,
+    writes invalidate only the entries sharing a tag with the changed visit
+
+    :param maxsize: maximal number of stored entries
+    :type maxsize: int
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self):
+        """Number that changes after every invalidation
+
+        Read it before building a response and pass it to put, so a response built from data
+        that was changed in the meantime is not stored
+        """
+        return self._generation
+
+    def get(self, key):
+        """Returns stored value and marks it as recently used
+
+        :param key: key of the entry
+        :type key: hashable
+        :returns: stored value or None if there is no such entry
+        :rtype: object
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, tags, generation):
+        """Stores value, evicting the least recently used entry when the cache is full
+
+        :param key: key of the entry
+        :type key: hashable
+        :param value: stored value
+        :type value: object
+        :param tags: tags of the entry
+        :type tags: iterable
+        :param generation: value of generation read before the value was built
+        :type generation: int
+        """
+        tags = frozenset(tags)
+        with self._lock:
+            if generation != self._generation or self.maxsize <= 0:
+                return
+            if key in self._entries:
+                self._discard(key)
+            self._entries[key] = (value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tags):
+        """Removes all entries having any of the tags
+
+        :param tags: tags of the changed data
+        :type tags: iterable
+        """
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._discard(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        """Removes all entries"""
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        """Returns counters of the cache
+
+        :returns: dictionary with size, limit, hits, misses, evictions and invalidations
+        :rtype: dict
+        """
+        with self._lock:
+            return {"size": len(self._entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "invalidations": self.invalidations}
+
+    def _discard(self, key):
+        _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
@@ -0,0 +1,85 @@
+import itertools
+import os
+import sys
+import tempfile
+
+"""
+check_query_plans.py
+========================================================
+Checks that every filter combination of GET /visit/query is served by an index of the visit table
+
+The queries are built by the same functions as in restAPI.py, their SQLite query plans must search
+the visit table, and the archive with include_archived, by an index instead of scanning all of it,
+otherwise the script exits with code 1
+"""
+
+FILTERS = {"doctor_name": "Jan Kowalski", "patient_id": "10000000000", "from": 121010108, "to": 121013118}
+
+
+def query_plan(restAPI, query):
+    """Returns SQLite query plan of a query
+
+    :param restAPI: the restAPI module
+    :type restAPI: module
+    :param query: the query
+    :type query: flask_sqlalchemy.BaseQuery object
+    :returns: lines of the plan
+    :rtype: list
+    """
+    compiled = query.statement.compile(restAPI.db.engine)
+    connection = restAPI.db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + str(compiled),
+                       [compiled.params[name] for name in compiled.positiontup])
+        return [row[3] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+def main():
+    """Prints the plan of every combination of filters, order and page, returns 1 if any scans the visits"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import restAPI
+
+    app = restAPI.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'plan.db')})
+    failed = 0
+    with app.app_context():
+        patients, _ = restAPI.patient_keys({str(10000000000 + i): "Jan Kowalski" for i in range(100)})
+        restAPI.db.session.commit()
+        doctors = restAPI.doctor_keys(app.config['DOCTORS'])
+        restAPI.db.session.execute(restAPI.VisitModel.__table__.insert(), [
+            {"visit_date": 121010108 + i // len(doctors) // 11 * 100 + i // len(doctors) % 11,
+             "patient_key": patients[str(10000000000 + i % 100)],
+             "doctor_id": doctors[app.config['DOCTORS'][i % len(doctors)]]} for i in range(1000)])
+        restAPI.db.session.commit()
+        restAPI.archive_visits(121010300)
+        tables = (f" {restAPI.VisitModel.__tablename__}", f" {restAPI.VisitArchive.__tablename__}")
+
+        for count in range(1, len(FILTERS) + 1):
+            for names in itertools.combinations(FILTERS, count):
+                for order, after, archived in itertools.product(restAPI.ORDERS, (None, (121010510, 500)),
+                                                                (False, True)):
+                    args = {name: FILTERS[name] for name in names}
+                    args["order"] = order
+                    if after is not None:
+                        args["after_date"], args["after"] = after
+                    if archived:
+                        args["include_archived"] = "1"
+                    with app.test_request_context(query_string=args):
+                        req = restAPI.parse_args(restAPI.QUERY_ARGS)
+                        visits = restAPI.with_archive(lambda model: restAPI.filter_visits(req, model))
+                        query = restAPI.page_query(visits, restAPI.parse_args(restAPI.PAGE_ARGS), order,
+                                                   restAPI.date_range_only(req))
+                        plan = query_plan(restAPI, query)
+                    visits = [line for line in plan if any(table in line for table in tables)]
+                    ok = len(visits) == 1 + archived and all(line.startswith("SEARCH") for line in visits)
+                    failed += not ok
+                    print(f"{'ok  ' if ok else 'SCAN'} {', '.join(names)}, order={order}"
+                          f"{', after' if after else ''}{', archived' if archived else ''}: {'; '.join(visits)}")
+    print(f"{failed} queries scan the visit table" if failed else "All queries use an index")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,489 @@
+import asyncio
+import functools
+import json
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+"""
+client.py
+========================================================
+Client of the visits server for menus, kiosks and integration scripts
+
+One VisitClient keeps a pool of keep-alive connections and can be shared by threads, AsyncVisitClient
+serves coroutines with the same client. Creates made at the same time are sent together by POST /visit/batch
+"""
+
+BASE = "http://127.0.0.1:5000/"
+# Keep-alive connections kept to the server by one client
+POOL_SIZE = 10
+# Time in seconds to wait for the server's answer
+TIMEOUT = 10
+# Number of times a request that failed on the way is tried again, and the first wait in seconds,
+# doubled with every try
+RETRIES = 3
+BACKOFF = 0.1
+RETRY_STATUSES = (502, 503, 504)
+# Largest number of visits sent by one POST /visit/batch, like BATCH_CHUNK of the server
+BATCH_SIZE = 500
+# Number of listings kept with their ETags
+LISTING_CACHE = 128
+
+Visit = namedtuple("Visit", ("doctor_name", "patient_id", "patient_name", "visit_date", "visit_id"))
+Hold = namedtuple("Hold", ("hold_id", "doctor_name", "visit_date", "expires"))
+
+
+class Outcome(namedtuple("Outcome", ("message", "error"))):
+    """Result of creating one visit, either message or error is set"""
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        """True if the visit was created"""
+        return self.error is None
+
+
+class VisitError(Exception):
+    """Error answered by the server
+
+    :param status: status code of the response
+    :type status: int
+    :param message: error message of the server
+    :type message: str
+    """
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def format_visit(visit):
+    """Visit's data serialization
+
+    :param visit: the visit
+    :type visit: Visit
+    :returns: a string of visit's data followed by an empty line
+    :rtype: str
+    """
+    date = visit.visit_date
+    return f"Visit id: {visit.visit_id}, Visit date: 20{date // 1000000 - 100}/{date // 10000 % 100}" \
+           f"/{date // 100 % 100} {date % 100}.00, Patient id: {visit.patient_id}," \
+           f" Patient name: {visit.patient_name}, Doctor's name: {visit.doctor_name}\n\n"
+
+
+def format_visits(visits):
+    """Converts visits to one string, joined once instead of growing with every visit
+
+    :param visits: the visits
+    :type visits: iterable of Visit
+    :returns: a string of visits' data
+    :rtype: str
+    """
+    return "".join(map(format_visit, visits))
+
+
+def write_visits(visits, file):
+    """Writes visits to a file as they come, so a listing streamed by iter_visits is never held in memory
+
+    :param visits: the visits
+    :type visits: iterable of Visit
+    :param file: text file, e.g. sys.stdout
+    :type file: file object
+    """
+    file.writelines(map(format_visit, visits))
+
+
+def response_json(response):
+    """Parses a response once
+
+    :param response: the response
+    :type response: requests.Response object
+    :returns: parsed body
+    :rtype: list/dict
+    :raises VisitError: if the server answered an error
+    """
+    try:
+        data = response.json()
+    except ValueError:
+        data = None
+    if response.status_code >= 400 or isinstance(data, dict) and "error" in data:
+        if isinstance(data, dict):
+            message = data.get("error") or data.get("message")
+        else:
+            message = response.reason
+        raise VisitError(response.status_code, message if isinstance(message, str) else json.dumps(message))
+    return data
+
+
+class VisitClient:
+    """Client of the visits server
+
+    Requests are retried with growing, randomized waits after lost connections and 502-504 only when
+    repeating them can't change anything twice: GET, PUT and DELETE, and POSTs sent with a new
+    Idempotency-Key reused by every try, so the server answers a repeat with the first response.
+    POST /hold has no such key and is sent once
+
+    :param base: address of the server ending with a slash
+    :type base: str
+    :param pool_size: number of keep-alive connections, at least the number of threads using the client
+    :type pool_size: int
+    :param timeout: time in seconds to wait for the server's answer
+    :type timeout: float
+    :param retries: number of times a request is tried again
+    :type retries: int
+    :param backoff: wait in seconds before the first retry
+    :type backoff: float
+    :param batch_size: largest number of visits sent in one request
+    :type batch_size: int
+    """
+    def __init__(self, base=BASE, pool_size=POOL_SIZE, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF,
+                 batch_size=BATCH_SIZE):
+        self.base = base
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._listings = OrderedDict()
+        self._pending = []
+        self._sending = False
+        self._lock = threading.Lock()
+
+    def close(self):
+        """Closes the connections"""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def request(self, method, path, retry=True, **kwargs):
+        """Sends a request, retried when retry is True
+
+        :param method: HTTP method
+        :type method: str
+        :param path: path without the leading slash, e.g. 'visit/all'
+        :type path: str
+        :param retry: False for requests that must not be repeated
+        :type retry: bool
+        :returns: the response
+        :rtype: requests.Response object
+        """
+        if method == "POST" and retry:
+            kwargs["headers"] = dict(kwargs.get("headers") or {}, **{"Idempotency-Key": uuid.uuid4().hex})
+        tries = self.retries + 1 if retry else 1
+        for attempt in range(tries):
+            try:
+                response = self.session.request(method, self.base + path, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == tries - 1:
+                    raise
+            else:
+                # 409 with the key: the first try is still in progress on the server
+                in_progress = response.status_code == 409 and "Idempotency-Key" in response.text
+                if attempt == tries - 1 or response.status_code not in RETRY_STATUSES and not in_progress:
+                    return response
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def doctors(self):
+        """Returns names of the available doctors
+
+        :rtype: list
+        """
+        return [doctor["doctor_name"] for doctor in response_json(self.request("GET", "doctors"))]
+
+    def visits(self, selector, **params):
+        """Returns visits of GET /visit/<selector>
+
+        The ETag of a listing downloaded before is sent with the request, so the server answers 304
+        without sending the visits again if nothing has changed
+
+        :param selector: e.g. 'all', 'doctor' or 'query'
+        :type selector: str
+        :param params: parameters of the listing, e.g. doctor_name
+        :returns: list of Visit
+        :rtype: list
+        :raises VisitError: if there are no such visits
+        """
+        key = (selector, tuple(sorted(params.items())))
+        with self._lock:
+            cached = self._listings.get(key)
+        headers = {"If-None-Match": cached[0]} if cached is not None else {}
+        response = self.request("GET", "visit/" + selector, params=params, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            return cached[1]
+        visits = [Visit(**item) for item in response_json(response)]
+        if "ETag" in response.headers:
+            with self._lock:
+                self._listings[key] = (response.headers["ETag"], visits)
+                self._listings.move_to_end(key)
+                if len(self._listings) > LISTING_CACHE:
+                    self._listings.popitem(last=False)
+        return visits
+
+    def iter_visits(self, selector, **params):
+        """Generator of visits of GET /visit/<selector> streamed as NDJSON, for listings too large to hold
+
+        :param selector: e.g. 'all', 'doctor' or 'query'
+        :type selector: str
+        :param params: parameters of the listing
+        :returns: generator of Visit
+        :rtype: generator
+        """
+        params["format"] = "ndjson"
+        with self.request("GET", "visit/" + selector, params=params, stream=True) as response:
+            if response.status_code >= 400:
+                response_json(response)
+            for line in response.iter_lines():
+                if line:
+                    yield Visit(**json.loads(line))
+
+    def search(self, q, **params):
+        """Returns visits found by GET /visit/search
+
+        :param q: searched words
+        :type q: str
+        :param params: field, ignore_accents, fuzzy, limit and offset
+        :returns: list of Visit
+        :rtype: list
+        """
+        response = self.request("GET", "visit/search", params=dict(q=q, **params))
+        return [Visit(**item) for item in response_json(response)]
+
+    def create(self, visit):
+        """Creates a visit
+
+        Visits created by other threads while a batch is sent are queued and go together in the next batch,
+        a lone visit is sent at once
+
+        :param visit: visit's data with patient_id, patient_name, doctor_name and visit_date
+        :type visit: dict
+        :rtype: Outcome
+        """
+        entry = {"visit": visit, "done": threading.Event(), "outcome": None, "error": None}
+        with self._lock:
+            self._pending.append(entry)
+            entry["lead"] = not self._sending
+            self._sending = True
+        if not entry["lead"]:
+            entry["done"].wait()
+        if entry["lead"]:
+            self._send_pending()
+        if entry["error"] is not None:
+            raise entry["error"]
+        return entry["outcome"]
+
+    def _send_pending(self):
+        with self._lock:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:len(batch)]
+        try:
+            for entry, outcome in zip(batch, self.create_many([entry["visit"] for entry in batch])):
+                entry["outcome"] = outcome
+        except Exception as error:
+            for entry in batch:
+                entry["error"] = error
+        finally:
+            # The first queued visit sends the next batch
+            with self._lock:
+                following = self._pending[0] if self._pending else None
+                if following is not None:
+                    following["lead"] = True
+                else:
+                    self._sending = False
+            for entry in batch:
+                entry["done"].set()
+            if following is not None:
+                following["done"].set()
+
+    def create_many(self, visits):
+        """Creates visits by POST /visit/batch, batch_size at a time
+
+        :param visits: visits' data like in create
+        :type visits: iterable of dict
+        :returns: Outcome of every visit in the same order
+        :rtype: list
+        """
+        visits = list(visits)
+        outcomes = []
+        for start in range(0, len(visits), self.batch_size):
+            batch = visits[start:start + self.batch_size]
+            try:
+                results = response_json(self.request("POST", "visit/batch", json=batch))
+            except VisitError as error:
+                if error.status != 409:
+                    raise
+                results = [{"error": error.message}] * len(batch)
+            outcomes.extend(Outcome(result.get("message"), result.get("error")) for result in results)
+        return outcomes
+
+    def hold(self, doctor_name, visit_date, seconds=None):
+        """Holds a free date of a doctor
+
+        :param doctor_name: doctor's name and surname
+        :type doctor_name: str
+        :param visit_date: visit date
+        :type visit_date: int
+        :param seconds: time of the hold, the server's default if None
+        :type seconds: float
+        :rtype: Hold
+        """
+        data = {"doctor_name": doctor_name, "visit_date": visit_date}
+        if seconds is not None:
+            data["seconds"] = seconds
+        return Hold(**response_json(self.request("POST", "hold", retry=False, data=data)))
+
+    def confirm(self, hold_id, patient_id, patient_name):
+        """Turns a hold into a visit
+
+        :returns: message of the server
+        :rtype: str
+        """
+        data = {"patient_id": patient_id, "patient_name": patient_name}
+        return response_json(self.request("POST", f"hold/{hold_id}/confirm", data=data))["message"]
+
+    def release(self, hold_id):
+        """Releases a hold
+
+        :returns: message of the server
+        :rtype: str
+        """
+        return response_json(self.request("DELETE", f"hold/{hold_id}"))["message"]
+
+    def update(self, visit_id, visit, version=None):
+        """Changes a visit
+
+        :param visit_id: id of the visit
+        :type visit_id: int
+        :param visit: all of the visit's data like in create
+        :type visit: dict
+        :param version: ETag of GET /visit/id, the visit is changed only if nobody changed it since
+        :type version: str
+        :returns: ETag of the new version
+        :rtype: str
+        """
+        headers = {"If-Match": version} if version is not None else {}
+        response = self.request("PUT", f"visit/{visit_id}", data=visit, headers=headers)
+        response_json(response)
+        return response.headers.get("ETag")
+
+    def delete(self, visit_id):
+        """Deletes a visit
+
+        :returns: message of the server
+        :rtype: str
+        """
+        return response_json(self.request("DELETE", f"visit/{visit_id}"))["message"]
+
+    def delete_all(self):
+        """Deletes all visits
+
+        :returns: message of the server
+        :rtype: str
+        """
+        return response_json(self.request("DELETE", "visit"))["message"]
+
+
+class AsyncVisitClient:
+    """VisitClient for coroutines
+
+    Requests run on a pool of threads sharing the connections of one VisitClient, so the event loop never
+    waits for the server. Visits created by many coroutines at the same time go in batches of batch_size
+
+    :param base: address of the server ending with a slash
+    :type base: str
+    :param concurrency: number of requests sent at the same time
+    :type concurrency: int
+    :param options: other arguments of VisitClient
+
+    Methods take the arguments of the methods of VisitClient with the same names
+    """
+    def __init__(self, base=BASE, concurrency=POOL_SIZE, **options):
+        self.client = VisitClient(base, pool_size=concurrency, **options)
+        self._executor = ThreadPoolExecutor(concurrency, thread_name_prefix="visit-client")
+        self._pending = []
+        self._sender = None
+
+    async def close(self):
+        """Waits for the queued visits and closes the connections"""
+        if self._sender is not None:
+            await self._sender
+        self._executor.shutdown()
+        self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+
+    async def create(self, visit):
+        """Creates a visit, see VisitClient.create
+
+        :rtype: Outcome
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((visit, future))
+        if self._sender is None or self._sender.done():
+            self._sender = asyncio.ensure_future(self._send_pending())
+        return await future
+
+    async def _send_pending(self):
+        while self._pending:
+            batch = self._pending[:self.client.batch_size]
+            del self._pending[:len(batch)]
+            try:
+                outcomes = await self._run(self.client.create_many, [visit for visit, _ in batch])
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+            else:
+                for (_, future), outcome in zip(batch, outcomes):
+                    if not future.done():
+                        future.set_result(outcome)
+
+    async def create_many(self, visits):
+        return await self._run(self.client.create_many, visits)
+
+    async def doctors(self):
+        return await self._run(self.client.doctors)
+
+    async def visits(self, selector, **params):
+        return await self._run(self.client.visits, selector, **params)
+
+    async def search(self, q, **params):
+        return await self._run(self.client.search, q, **params)
+
+    async def hold(self, doctor_name, visit_date, seconds=None):
+        return await self._run(self.client.hold, doctor_name, visit_date, seconds)
+
+    async def confirm(self, hold_id, patient_id, patient_name):
+        return await self._run(self.client.confirm, hold_id, patient_id, patient_name)
+
+    async def release(self, hold_id):
+        return await self._run(self.client.release, hold_id)
+
+    async def update(self, visit_id, visit, version=None):
+        return await self._run(self.client.update, visit_id, visit, version)
+
+    async def delete(self, visit_id):
+        return await self._run(self.client.delete, visit_id)
+
+    async def delete_all(self):
+        return await self._run(self.client.delete_all)
@@ -0,0 +1,51 @@
+import threading
+
+"""
+inflight.py
+========================================================
+Coalescing of identical requests handled by one process at the same time
+"""
+
+
+class InFlight:
+    """Calls in progress by key
+
+    The first caller of a key runs the call, callers of the same key arriving before it ends wait for it
+    and get its result instead of running the call again. Results should be immutable, they are shared
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, call):
+        """Runs the call unless a call of the same key is in progress
+
+        :param key: key of identical calls
+        :type key: hashable
+        :param call: function without arguments
+        :type call: function
+        :returns: result of the call and True if it was made by another caller
+        :rtype: tuple
+        """
+        with self._lock:
+            waiting = self._calls.get(key)
+            if waiting is None:
+                waiting = self._calls[key] = {"done": threading.Event(), "result": None, "failed": True}
+                first = True
+            else:
+                first = False
+        if not first:
+            waiting["done"].wait()
+            if not waiting["failed"]:
+                return waiting["result"], True
+            # The first caller failed, its error is its own, so this one tries by itself
+            return call(), False
+
+        try:
+            waiting["result"] = call()
+            waiting["failed"] = False
+            return waiting["result"], False
+        finally:
+            with self._lock:
+                del self._calls[key]
+            waiting["done"].set()
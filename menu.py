@@ -1,11 +1,12 @@
-import requests
 import os
 import platform
 
+from client import VisitClient, VisitError, format_visits
+
 
 BASE = "http://127.0.0.1:5000/"
-# List of available doctors
-DOCTORS = ["Mariusz Nowak", "Marzena Borowik", "Jan Kowalski", "Stanislaw Nowak", "Adam Nadobny", "Piotr Krzyszczak"]
+# Keep-alive connections to the server, the client keeps downloaded visits with their ETags
+CLIENT = VisitClient(BASE)
 
 # initialization of empty dictionary
 DATA = dict.fromkeys(['patient_id', 'patient_name', 'doctor_name', 'visit_date'])
@@ -23,54 +24,51 @@ def clear_screen():
         os.system('clear')
 
 
-def visit_to_string(dictionary):
-    """Visit's data serialization
+def get_doctors():
+    """Download available doctors
+
+    Function asks server for the list of doctors
+
+    :return: list of doctors' names and surnames
+    :rtype: list
+    """
+
+    return CLIENT.doctors()
+
 
-    Function converts visit's data to string
+def print_visits(selector, **params):
+    """Download and display visits
 
-    :param dictionary: Dictionary with visit's data
-    :type dictionary: dict
-    :return: a string of visit's data
-    :rtype: str
+    Function asks server for visits of GET /visit/<selector>, the server answers 304 without sending them
+    again if nothing has changed since they were downloaded before
+
+    :param selector: selector of the listing, e.g. 'all'
+    :type selector: str
+    :param params: parameters of the listing
     """
 
-    visit_string = ''
-    for visits in range(len(dictionary)):
-        visit_string += f"Visit id: {dictionary[visits]['visit_id']}," \
-                        f" Visit date: 20{(int(dictionary[visits]['visit_date'] / 1000000)) - 100}/" \
-                        f"{(int(dictionary[visits]['visit_date'] / 10000) % 100)}" \
-                        f"/{(int(dictionary[visits]['visit_date'] / 100) % 100)}" \
-                        f" {(int(dictionary[visits]['visit_date']) % 100)}.00," \
-                        f" Patient id: {dictionary[visits]['patient_id']}," \
-                        f" Patient name: {dictionary[visits]['patient_name']}," \
-                        f" Doctor's name: {dictionary[visits]['doctor_name']}\n\n"
-    return visit_string
+    try:
+        print(format_visits(CLIENT.visits(selector, **params)))
+    except VisitError as error:
+        print(error.message)
 
 
 def make_appointment():
     """Create new appointment
 
-    Function asks user for visit's data. Function call data_check to check if date format is correct. If it is right,
-    make new visit in database and show information from server as dictionary value.
+    Function asks user for doctor and date first. Function call data_check to check if date format is correct.
+    If it is right, the date is held on the server while user types patient's data, so nobody else can book it
+    in the meantime, then the hold is turned into a new visit and information from server is shown as dictionary value.
     """
 
     clear_screen()
     is_right = True
 
-    patient_id = int(input("Enter your id: "))
-    check = id_check(patient_id)
-    if check[1]:
-        DATA['patient_id'] = check[0]
-    else:
-        is_right = False
-
-    patient_name = input("Enter your name and surname: ")
-    DATA['patient_name'] = patient_name
-
+    doctors = get_doctors()
     print("Available doctors")
-    print(*DOCTORS, sep=", ")
+    print(*doctors, sep=", ")
     doctor_name = input("Enter doctor's name and surname: ")
-    check = check_doctor(doctor_name)
+    check = check_doctor(doctor_name, doctors)
     if check[1]:
         DATA['doctor_name'] = check[0]
     else:
@@ -85,12 +83,36 @@ def make_appointment():
     else:
         is_right = False
 
-    if is_right:
-        response = requests.post(BASE + 'visit', DATA)
-        if 'error' in response.json():
-            print(response.json()["error"])
+    if not is_right:
+        return
+    try:
+        hold_id = CLIENT.hold(DATA['doctor_name'], DATA['visit_date']).hold_id
+    except VisitError as error:
+        print(error.message)
+        return
+    print("The date is held for you, enter your data to book it")
+
+    try:
+        patient_id = int(input("Enter your id: "))
+        check = id_check(patient_id)
+        if check[1]:
+            DATA['patient_id'] = check[0]
         else:
-            print(response.json()["message"])
+            is_right = False
+
+        patient_name = input("Enter your name and surname: ")
+        DATA['patient_name'] = patient_name
+    except BaseException:
+        CLIENT.release(hold_id)
+        raise
+
+    if is_right:
+        try:
+            print(CLIENT.confirm(hold_id, DATA['patient_id'], DATA['patient_name']))
+        except VisitError as error:
+            print(error.message)
+    else:
+        CLIENT.release(hold_id)
 
 
 def show():
@@ -112,44 +134,23 @@ def show():
     how_to_show = int(input("Choose search mode: "))
     print("\n")
     if how_to_show == 1:
-        response = requests.get(BASE + 'visit/all')
-        if 'error' in response.json():
-            print(response.json()["error"])
-        else:
-            print(visit_to_string(response.json()))
+        print_visits('all')
     elif how_to_show == 2:
         patient_id = int(input("Enter your id: "))
-        response = requests.get(BASE + 'visit/patient', {'patient_id': patient_id})
-        if 'error' in response.json():
-            print(response.json()["error"])
-        else:
-            print(visit_to_string(response.json()))
+        print_visits('patient', patient_id=patient_id)
     elif how_to_show == 3:
         doctor_name = input("Enter doctor's name: ")
-        response = requests.get(BASE + 'visit/doctor', {'doctor_name': doctor_name})
-        if 'error' in response.json():
-            print(response.json()["error"])
-        else:
-            print(visit_to_string(response.json()))
+        print_visits('doctor', doctor_name=doctor_name)
     elif how_to_show == 4:
         visit_date = input("Enter date (YYMMDDHH): ")
         visit_date = int("1" + visit_date)
-        response = requests.get(BASE + 'visit/date', {'visit_date': visit_date})
-        if 'error' in response.json():
-            print(response.json()["error"])
-        else:
-            print(visit_to_string(response.json()))
+        print_visits('date', visit_date=visit_date)
     elif how_to_show == 5:
         patient_id = int(input("Enter your id: "))
         doctor_name = input("Enter doctor's name: ")
         visit_date = input("Enter date (YYMMDDHH): ")
         visit_date = int("1" + visit_date)
-        response = requests.get(BASE + 'visit/selected', {'patient_id': patient_id, 'doctor_name': doctor_name,
-                                                          'visit_date': visit_date})
-        if 'error' in response.json():
-            print(response.json()["error"])
-        else:
-            print(visit_to_string(response.json()))
+        print_visits('selected', patient_id=patient_id, doctor_name=doctor_name, visit_date=visit_date)
     else:
         print("Cannot be selected")
 
@@ -164,11 +165,10 @@ def delete():
 
     clear_screen()
     visit_to_delete = int(input("Enter the id of the visit you want to delete: "))
-    response = requests.delete(BASE + f'visit/{visit_to_delete}')
-    if 'error' in response.json():
-        print(response.json()["error"])
-    else:
-        print(response.json()["message"])
+    try:
+        print(CLIENT.delete(visit_to_delete))
+    except VisitError as error:
+        print(error.message)
 
 
 def delete_all():
@@ -179,8 +179,7 @@ def delete_all():
     """
 
     clear_screen()
-    response = requests.delete(BASE + f'visit')
-    print(response.json()["message"])
+    print(CLIENT.delete_all())
 
 
 def date_check(date):
@@ -253,25 +252,27 @@ def id_check(patient_id):
         return [patient_id, is_right]
 
 
-def check_doctor(doctor_name):
+def check_doctor(doctor_name, doctors):
     """Check if doctor is available
 
-    Function, in loop, checks if doctor name and surname in doctor list (DOCTORS) and allows user to type correct one.
+    Function, in loop, checks if doctor name and surname in doctor list and allows user to type correct one.
 
     :param doctor_name: given doctor name and surname
     :type doctor_name: str
+    :param doctors: list of available doctors returned by get_doctors
+    :type doctors: list
     :return: list of 2 arguments; doctor name nad surname and if doctor is available or not
     :rtype: list
     """
     while True:
         is_right = True
-        if doctor_name not in DOCTORS:
+        if doctor_name not in doctors:
             is_right = False
             print("This doctor is not available")
             decision = input("Do you want try again? [y/n]: ")
             if decision == 'y':
                 print("Available doctors")
-                print(*DOCTORS, sep=", ")
+                print(*doctors, sep=", ")
                 doctor_name = input("Enter doctor name and surname: ")
                 continue
         return [doctor_name, is_right]
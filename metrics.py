@@ -0,0 +1,168 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+"""
+metrics.py
+========================================================
+Request latency histograms, SQL statement counters and event counters in Prometheus text format
+"""
+
+# Upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def format_labels(labels):
+    """Formats labels of a sample
+
+    :param labels: pairs of label's name and value
+    :type labels: tuple
+    :returns: labels in Prometheus text format, empty string if there are none
+    :rtype: str
+    """
+    if not labels:
+        return ""
+    values = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f"{name}=\"{value}\"" for (name, _), value in zip(labels, values)) + "}"
+
+
+class Metrics:
+    """Metrics of the requests handled by one process
+
+    The request being handled by a thread and its SQL statements are tracked in thread-local state,
+    finishing a request takes one lock and a few additions, the text is built only when it is scraped
+
+    :param counters: descriptions of the event counters
+    :type counters: dict
+    """
+    def __init__(self, counters):
+        self.counters = counters
+        self.enabled = True
+        self._latency = {}
+        self._requests = Counter()
+        self._sql = Counter()
+        self._events = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def start_request(self):
+        """Starts measuring a request handled by the current thread"""
+        if self.enabled:
+            self._local.request = [time.perf_counter(), 0, 0.0, None, 500]
+
+    def start_statement(self):
+        """Starts measuring an SQL statement executed by the current thread"""
+        self._local.statement = time.perf_counter()
+
+    def end_statement(self):
+        """Adds the SQL statement executed by the current thread to its request"""
+        request = getattr(self._local, "request", None)
+        if request is not None:
+            request[1] += 1
+            request[2] += time.perf_counter() - self._local.statement
+
+    def set_response(self, route, status):
+        """Sets route and status of the request handled by the current thread
+
+        :param route: route of the request, e.g. "GET /visit/doctor"
+        :type route: str
+        :param status: status code of the response
+        :type status: int
+        """
+        request = getattr(self._local, "request", None)
+        if request is not None:
+            request[3] = route
+            request[4] = status
+
+    def end_request(self, failed):
+        """Records the request handled by the current thread
+
+        :param failed: True if the request ended with an exception
+        :type failed: bool
+        """
+        request = self._local.__dict__.pop("request", None)
+        if request is not None and request[3] is not None:
+            start, statements, sql_seconds, route, status = request
+            self.observe(route, 500 if failed else status, time.perf_counter() - start, statements, sql_seconds)
+
+    def observe(self, route, status, seconds, statements, sql_seconds):
+        """Records a handled request
+
+        :param route: route of the request, e.g. "GET /visit/doctor"
+        :type route: str
+        :param status: status code of the response
+        :type status: int
+        :param seconds: time of handling the request
+        :type seconds: float
+        :param statements: number of SQL statements executed by the request
+        :type statements: int
+        :param sql_seconds: time spent executing the statements
+        :type sql_seconds: float
+        """
+        bucket = bisect_left(BUCKETS, seconds)
+        with self._lock:
+            latency = self._latency.get(route)
+            if latency is None:
+                latency = self._latency[route] = [[0] * (len(BUCKETS) + 1), 0.0]
+            latency[0][bucket] += 1
+            latency[1] += seconds
+            self._requests[route, status] += 1
+            self._sql[route, "statements"] += statements
+            self._sql[route, "seconds"] += sql_seconds
+
+    def count(self, name, amount=1, **labels):
+        """Increases an event counter
+
+        :param name: name of the counter, one of the counters given to the constructor
+        :type name: str
+        :param amount: value added to the counter
+        :type amount: int
+        """
+        with self._lock:
+            self._events[name, tuple(sorted(labels.items()))] += amount
+
+    def render(self, gauges=()):
+        """Returns all metrics in Prometheus text format
+
+        :param gauges: triples of gauge's name, description and value sampled at the time of the scrape
+        :type gauges: iterable
+        :returns: text exposition of the metrics
+        :rtype: str
+        """
+        with self._lock:
+            latency = {route: (list(buckets), total) for route, (buckets, total) in self._latency.items()}
+            requests = dict(self._requests)
+            sql = dict(self._sql)
+            events = dict(self._events)
+
+        lines = ["# HELP visits_request_duration_seconds Time of handling requests by route",
+                 "# TYPE visits_request_duration_seconds histogram"]
+        for route, (buckets, total) in sorted(latency.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), buckets):
+                cumulative += count
+                lines.append(f"visits_request_duration_seconds_bucket{format_labels((('route', route), ('le', bound)))}"
+                             f" {cumulative}")
+            lines.append(f"visits_request_duration_seconds_sum{format_labels((('route', route),))} {total}")
+            lines.append(f"visits_request_duration_seconds_count{format_labels((('route', route),))} {cumulative}")
+
+        lines += ["# HELP visits_requests_total Handled requests by route and status",
+                  "# TYPE visits_requests_total counter"]
+        lines += [f"visits_requests_total{format_labels((('route', route), ('status', status)))} {count}"
+                  for (route, status), count in sorted(requests.items())]
+        for kind, description in (("statements", "SQL statements executed by requests by route"),
+                                  ("seconds", "Time of executing SQL statements by route")):
+            name = "visits_sql_statements_total" if kind == "statements" else "visits_sql_duration_seconds_total"
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+            lines += [f"{name}{format_labels((('route', route),))} {value}"
+                      for (route, sql_kind), value in sorted(sql.items()) if sql_kind == kind]
+
+        for name, description in self.counters.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+            lines += [f"{name}{format_labels(labels)} {value}"
+                      for (event, labels), value in sorted(events.items()) if event == name]
+
+        for name, description, value in gauges:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,206 @@
+import cProfile
+import io
+import itertools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+"""
+profiler.py
+========================================================
+Opt-in profiling of sampled and slow requests, saved to a bounded directory of json files
+"""
+
+# Number of functions listed in a saved cProfile report
+PROFILE_LINES = 60
+# Number of innermost frames kept in a sampled stack
+STACK_DEPTH = 40
+
+
+def stack_line(frame):
+    """Returns stack of a frame in the collapsed format of flame graphs
+
+    :param frame: the innermost frame
+    :type frame: frame object
+    :returns: functions from the outermost to the innermost separated by semicolons
+    :rtype: str
+    """
+    names = []
+    while frame is not None and len(names) < STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class RequestProfiler:
+    """Profiler of the requests handled by one process
+
+    Every sample_every-th request is profiled with cProfile, while slow_seconds is set a background thread
+    samples stacks of all requests in progress and the samples are kept for requests that took longer.
+    SQL statements of the requests are recorded without their parameters, which hold patients' data.
+    Disabled profiler costs one attribute check per request
+    """
+    def __init__(self):
+        self.directory = None
+        self.sample_every = 0
+        self.slow_seconds = None
+        self.keep = 0
+        self.interval = 0.01
+        self._requests = {}
+        self._numbers = itertools.count()
+        self._files = itertools.count()
+        self._sampler = None
+        self._lock = threading.Lock()
+
+    def configure(self, directory, sample_every, slow_ms, keep, interval_ms):
+        """Sets what is profiled
+
+        :param directory: directory of the saved profiles, None disables the profiler
+        :type directory: str
+        :param sample_every: every how many requests one is profiled with cProfile, 0 for none
+        :type sample_every: int
+        :param slow_ms: duration in milliseconds from which requests are saved with their sampled stacks,
+        None for none
+        :type slow_ms: float
+        :param keep: maximal number of saved profiles, the oldest are removed, at least 1
+        :type keep: int
+        :param interval_ms: time in milliseconds between stack samples
+        :type interval_ms: float
+        """
+        self.directory = directory
+        self.sample_every = sample_every or 0
+        self.slow_seconds = slow_ms / 1000 if slow_ms is not None else None
+        self.keep = keep
+        self.interval = interval_ms / 1000
+        if directory and self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        """True if any request may be profiled"""
+        return bool(self.directory) and (self.sample_every > 0 or self.slow_seconds is not None)
+
+    def start_request(self):
+        """Starts profiling the request handled by the current thread if it is chosen"""
+        if not self.enabled:
+            return
+        record = {"start": time.perf_counter(), "statement": None, "sql": [], "stacks": Counter(), "profile": None,
+                  "route": None, "status": 500}
+        if self.sample_every and next(self._numbers) % self.sample_every == 0:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+                record["profile"] = profile
+            except ValueError:  # another profiler is active in the process
+                pass
+        with self._lock:
+            self._requests[threading.get_ident()] = record
+        if self.slow_seconds is not None and (self._sampler is None or not self._sampler.is_alive()):
+            self._start_sampler()
+
+    def start_statement(self):
+        """Remembers when the SQL statement executed by the current thread started"""
+        record = self._requests.get(threading.get_ident())
+        if record is not None:
+            record["statement"] = time.perf_counter()
+
+    def end_statement(self, statement):
+        """Adds the SQL statement executed by the current thread to its request
+
+        :param statement: text of the statement
+        :type statement: str
+        """
+        record = self._requests.get(threading.get_ident())
+        if record is not None and record["statement"] is not None:
+            record["sql"].append({"statement": statement,
+                                  "ms": round((time.perf_counter() - record["statement"]) * 1000, 3)})
+
+    def set_response(self, route, status):
+        """Sets route and status of the request handled by the current thread
+
+        :param route: route of the request, e.g. "GET /visit/doctor"
+        :type route: str
+        :param status: status code of the response
+        :type status: int
+        """
+        record = self._requests.get(threading.get_ident())
+        if record is not None:
+            record["route"] = route
+            record["status"] = status
+
+    def end_request(self, failed):
+        """Finishes profiling the request handled by the current thread and saves it if it was chosen or slow
+
+        :param failed: True if the request ended with an exception
+        :type failed: bool
+        """
+        with self._lock:
+            record = self._requests.pop(threading.get_ident(), None)
+        if record is None:
+            return
+        seconds = time.perf_counter() - record["start"]
+        profile = record["profile"]
+        if profile is not None:
+            profile.disable()
+        slow = self.slow_seconds is not None and seconds >= self.slow_seconds
+        if profile is None and not slow:
+            return
+
+        report = None
+        if profile is not None:
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(PROFILE_LINES)
+            report = stream.getvalue()
+        self._save({"route": record["route"], "status": 500 if failed else record["status"],
+                    "ms": round(seconds * 1000, 3), "reason": "slow" if slow else "sampled", "pid": os.getpid(),
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "sql": record["sql"], "profile": report,
+                    "stacks": dict(record["stacks"].most_common())})
+
+    def profiles(self):
+        """Returns saved profiles from the newest
+
+        :returns: list of dictionaries with name and size of every file
+        :rtype: list
+        """
+        if not self.directory or not os.path.isdir(self.directory):
+            return []
+        return [{"name": name, "size": os.path.getsize(os.path.join(self.directory, name))}
+                for name in sorted(self._names(), reverse=True)]
+
+    def _names(self):
+        return [name for name in os.listdir(self.directory) if name.endswith(".json")]
+
+    def _save(self, data):
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._files):06d}.json"
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "w") as file:
+            json.dump(data, file)
+        os.replace(path + ".tmp", path)
+        names = sorted(self._names())
+        for old in names[:max(len(names) - self.keep, 0)]:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:  # removed by another process
+                pass
+
+    def _start_sampler(self):
+        with self._lock:
+            if self._sampler is None or not self._sampler.is_alive():
+                self._sampler = threading.Thread(target=self._sample, name="request-profiler", daemon=True)
+                self._sampler.start()
+
+    def _sample(self):
+        while self.slow_seconds is not None:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                requests = list(self._requests.items())
+            for ident, record in requests:
+                frame = frames.get(ident)
+                if frame is not None:
+                    record["stacks"][stack_line(frame)] += 1
@@ -1,211 +1,3994 @@
-from flask import Flask, jsonify, make_response
-from flask_sqlalchemy import SQLAlchemy
+import calendar
+import concurrent.futures
+import contextlib
+import csv
+import datetime
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import os
+import re
+import secrets
+import threading
+import time
+import unicodedata
+import zlib
+
+import click
+from flask import Blueprint, Flask, Response, abort, copy_current_request_context, current_app, g, \
+    has_app_context, has_request_context, jsonify, make_response, request, send_from_directory, stream_with_context
+from flask.cli import with_appcontext
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
 from flask_marshmallow import Marshmallow
-from flask_restful import reqparse
+from sqlalchemy import event, false, inspect, or_, select, tuple_
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from werkzeug.datastructures import MultiDict
+from werkzeug.local import LocalProxy
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, responses are compressed with gzip without it
+    brotli = None
+
+from cache import ResponseCache
+from inflight import InFlight
+from metrics import Metrics
+from profiler import RequestProfiler
+from slots import FIRST_HOUR, LAST_HOUR, SlotHolds, SlotIndex, date_to_day, day_to_date, split_date
+
+"""
+restAPI.py
+========================================================
+Program that creates and maintains a databse on a server
+"""
+
+# Default configuration, DATABASE_URI environment variable sets the database
+# and VISITS_SETTINGS may point to a python file overriding any of the values
+DEFAULT_CONFIG = {
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///databse.db',
+    'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+    'DB_POOL_SIZE': 10,
+    'DB_MAX_OVERFLOW': 20,
+    'SQLITE_BUSY_TIMEOUT': 30000,
+    'SQLITE_SYNCHRONOUS': 'NORMAL',
+    # Databases of the shards besides the main one, visits of every doctor are kept in one of them chosen
+    # by the doctor's name, so writers of different shards don't wait for each other, empty keeps all in one
+    'SHARD_URIS': [],
+    'VISIT_CACHE_SIZE': 1024,
+    # Responses of GET /visit/<parameter> at least that large are compressed for clients accepting it
+    'COMPRESS_MIN_SIZE': 1024,
+    'COMPRESS_LEVEL': 6,
+    # Latency and SQL statistics of every request served by GET /metrics
+    'METRICS': True,
+    # Profiling is off until PROFILE_DIR is set together with PROFILE_SAMPLE, profiling every N-th request
+    # with cProfile, and/or PROFILE_SLOW_MS, keeping sampled stacks of requests slower than that
+    'PROFILE_DIR': None,
+    'PROFILE_SAMPLE': 0,
+    'PROFILE_SLOW_MS': None,
+    'PROFILE_KEEP': 200,
+    'PROFILE_INTERVAL_MS': 10,
+    # Value of the X-Admin-Token header required by the /admin routes, None leaves them open
+    'ADMIN_TOKEN': None,
+    # Longest wait in seconds of a long poll of GET /visit/changes, how often in milliseconds waiting requests
+    # look for changes written by other processes, and how long an event stream lasts before the client reconnects
+    'CHANGE_WAIT_MAX': 30,
+    'CHANGE_POLL_MS': 500,
+    'CHANGE_STREAM_SECONDS': 300,
+    # Time in seconds responses of POST requests with the Idempotency-Key header are kept, and how long
+    # a repeated request waits for the first one handled by another process before answering 409
+    'IDEMPOTENCY_TTL': 86400,
+    'IDEMPOTENCY_WAIT': 10,
+    # Default and longest time in seconds a slot is held by POST /hold, and how long this process trusts
+    # a hold it knows about before asking the database again, holds may be released by other processes
+    'HOLD_SECONDS': 120,
+    'HOLD_MAX_SECONDS': 600,
+    'HOLD_LOCAL_SECONDS': 5,
+    # How often in milliseconds every worker process brings free slots, holds and doctors it keeps in memory
+    # up to date with the writes of other processes, in a thread of its own, 0 checks them in every request
+    'SLOT_REFRESH_MS': 250,
+    # Doctors added to the doctor table at start, more are added by booking visits with new doctors
+    'DOCTORS': ["Mariusz Nowak", "Marzena Borowik", "Jan Kowalski", "Stanislaw Nowak", "Adam Nadobny",
+                "Piotr Krzyszczak"],
+}
+
+
+class ShardSession(SignallingSession):
+    """Session running statements in the database of the current shard
+
+    Idempotency keys and the directory of visits are kept only in the main database, so a repeated request
+    finds its key and a visit is found by its id whichever shard it is written to
+    """
+    def get_bind(self, mapper=None, clause=None):
+        if mapper is not None and mapper.class_ in (IdempotencyKey, VisitShard):
+            return db.main_engine(self.app)
+        return db.get_engine(self.app)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy extension whose engine is the one of the current shard, see use_shard"""
+    def create_session(self, options):
+        return sessionmaker(class_=ShardSession, db=self, **options)
+
+    def main_engine(self, app=None):
+        """Returns the engine of the main database
+
+        :param app: the application, None for the current one
+        :type app: flask.Flask object
+        :returns: the engine
+        :rtype: sqlalchemy.engine.Engine object
+        """
+        return SQLAlchemy.get_engine(self, app)
+
+    def get_engine(self, app=None, bind=None):
+        shard = current_shard()
+        if bind is None and shard:
+            return shard_engines[shard - 1]
+        return SQLAlchemy.get_engine(self, app, bind)
+
+
+db = ShardedSQLAlchemy()
+ma = Marshmallow()
+visits = Blueprint('visits', __name__)
+# Engines of the shards after the main database, created by create_app from SHARD_URIS
+shard_engines = []
+# free_slots and local_state of every shard, the first ones are of the main database
+shard_slots = [SlotIndex()]
+shard_states = [{"version": None, "slots": False, "seq": None, "doctors": None}]
+free_slots = LocalProxy(lambda: shard_slots[current_shard()])
+# Holds of dates made or seen by this process, answer bookings of held dates without querying the database
+slot_holds = SlotHolds()
+# Serialized responses of GET /visit/<parameter>, invalidated by every write
+visit_cache = ResponseCache(maxsize=DEFAULT_CONFIG['VISIT_CACHE_SIZE'])
+# Value of the visits change counter of the current shard that visit_cache is up to date with,
+# "slots" is False when free_slots has to be rebuilt before use, "seq" is the last change of the change log
+# applied to free_slots and "doctors" the number of doctors loaded into doctor_ids, see refresh_slots
+local_state = LocalProxy(lambda: shard_states[current_shard()])
+# Id of the process running the thread of refresh_local_state, requests of other processes check the database
+refresher = {"pid": None}
+refresher_lock = threading.Lock()
+# Statistics of the requests handled by this process
+metrics = Metrics({
+    "visits_booking_conflicts_total": "Bookings and updates rejected because of a taken id or date, by reason",
+    "visits_booking_retries_total": "Batches checked again because a concurrent request took one of their dates",
+    "visits_idempotent_replays_total": "POST requests answered with the response of an identical request, by source",
+    "visits_holds_total": "Requests of POST /hold and of the holds it made, by result",
+})
+# Profiles of sampled and slow requests handled by this process
+profiler = RequestProfiler()
+# doctor_id of every known doctor's name in the current shard, doctors are never removed so it stays valid,
+# doctors added by a transaction are kept in its session's info under "added_doctors" until it commits
+shard_doctor_ids = [{}]
+doctor_ids = LocalProxy(lambda: shard_doctor_ids[current_shard()])
+# Notified after every write of this process, wakes up requests waiting in GET /visit/changes
+change_signal = threading.Condition()
+# POST requests in progress in this process, identical ones share one response
+in_flight = InFlight()
+# Threads of fan_out, the calls of concurrent requests share them
+FAN_OUT_THREADS = 32
+fan_out_pool = concurrent.futures.ThreadPoolExecutor(max_workers=FAN_OUT_THREADS, thread_name_prefix="fan-out")
+
+
+def current_shard():
+    """Returns the shard whose database the statements of the current context run in
+
+    :returns: index of the shard, 0 for the main database
+    :rtype: int
+    """
+    return g.get("shard", 0) if has_app_context() else 0
+
+
+@contextlib.contextmanager
+def use_shard(shard):
+    """Context manager running the statements of the current context in the database of a shard
+
+    :param shard: index of the shard
+    :type shard: int
+    """
+    previous = current_shard()
+    g.shard = shard
+    try:
+        yield
+    finally:
+        g.shard = previous
+
+
+def shard_count():
+    """Returns number of shards, 1 when all visits are kept in the main database"""
+    return len(shard_engines) + 1
+
+
+def shard_of(doctor_name):
+    """Returns the shard keeping the visits of a doctor
+
+    Doctors are spread by crc32 of their names, which is the same in every process,
+    visits without a doctor are kept in the main database
+
+    :param doctor_name: name of a doctor
+    :type doctor_name: str
+    :returns: index of the shard
+    :rtype: int
+    """
+    if doctor_name is None or not shard_engines:
+        return 0
+    return zlib.crc32(doctor_name.encode()) % shard_count()
+
+
+def id_shard(visit_id):
+    """Returns the shard keeping a live visit, read from the directory of visits, see VisitShard
+
+    :param visit_id: id of a visit
+    :type visit_id: int
+    :returns: index of the shard, None if there is no such visit, 0 without shards
+    :rtype: int
+    """
+    if not shard_engines:
+        return 0
+    return db.session.query(VisitShard.shard).filter_by(visit_id=visit_id).scalar()
+
+
+def each_shard(function):
+    """Calls a function in every shard one after another in the current thread,
+    for queries too quick to be worth a thread
+
+    :param function: function without arguments
+    :type function: function
+    :returns: results of the calls in the order of the shards
+    :rtype: list
+    """
+    results = []
+    for shard in range(shard_count()):
+        with use_shard(shard):
+            results.append(function())
+    return results
+
+
+def fan_out(function, shards=None):
+    """Calls a function in every shard at the same time
+
+    Every call runs in a thread of fan_out_pool with a copy of the request context, or of the application
+    context outside of requests, and with its own session. The function must not fan out itself, so calls
+    never wait for free threads of the pool. A single shard is called in the current thread
+
+    :param function: function without arguments
+    :type function: function
+    :param shards: indexes of the shards, None for all of them
+    :type shards: list
+    :returns: results of the calls in the order of the shards
+    :rtype: list
+    """
+    shards = list(range(shard_count())) if shards is None else shards
+    if len(shards) == 1:
+        with use_shard(shards[0]):
+            return [function()]
+
+    def call(shard):
+        with use_shard(shard):
+            return function()
+
+    if has_request_context():
+        calls = [copy_current_request_context(functools.partial(call, shard)) for shard in shards]
+    else:
+        app = current_app._get_current_object()
+
+        def call_in_app(shard):
+            with app.app_context():
+                return call(shard)
+        calls = [functools.partial(call_in_app, shard) for shard in shards]
+    return [future.result() for future in [fan_out_pool.submit(call) for call in calls]]
+
+
+class Doctor(db.Model):
+    """The record class of doctors
+
+    :param doctor_id: id of a doctor, primary_key
+    :type doctor_id: int
+    :param doctor_name: name of a doctor
+    :type doctor_name: str
+    :param changes: number of changes of the doctor's visits, the ETag of the doctor's listings
+    :type changes: int
+    :param search_name: name of a doctor returned by fold_name, searched when accents are ignored
+    :type search_name: str
+    """
+    doctor_id = db.Column(db.Integer, primary_key=True)
+    doctor_name = db.Column(db.String(500), nullable=False, unique=True)
+    changes = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    search_name = db.Column(db.String(500))
+
+
+class Patient(db.Model):
+    """The record class of patients
+
+    :param patient_key: internal id of a patient, primary_key
+    :type patient_key: int
+    :param patient_id: id of a patient given by the patient
+    :type patient_id: str
+    :param patient_name: name of a patient, the one given in the latest booking
+    :type patient_name: str
+    :param changes: number of changes of the patient's visits, the ETag of the patient's listings
+    :type changes: int
+    :param search_name: name of a patient returned by fold_name, searched when accents are ignored
+    :type search_name: str
+    """
+    patient_key = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.String(500), nullable=False, unique=True)
+    patient_name = db.Column(db.String(500))
+    changes = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    search_name = db.Column(db.String(500))
+
+
+class VisitModel(db.Model):
+    """The record class in the db database
+
+    This class is a look of our visit database, doctors and patients are referenced by integer keys
+
+    :param visit_id: id of a visit, primary_key
+    :type visit_id: int
+    :param visit_date: date of a visit
+    :type visit_date: int
+    :param doctor_id: id of a doctor
+    :type doctor_id: int
+    :param patient_key: internal id of a patient
+    :type patient_key: int
+    :param version: number of the revision of a visit, increased by every update and sent as its ETag
+    :type version: int
+
+    A doctor can have only one visit at a given date and a patient can make a given appointment only once,
+    both rules are kept by unique indexes, so the database itself rejects double-booking. The same indexes
+    and the one on visit_date serve the date ranges of GET /visit/query
+    """
+    visit_id = db.Column(db.Integer, primary_key=True)
+    visit_date = db.Column(db.Integer)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.doctor_id'))
+    patient_key = db.Column(db.Integer, db.ForeignKey('patient.patient_key'))
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    doctor = db.relationship(Doctor, lazy='joined')
+    patient = db.relationship(Patient, lazy='joined')
+
+    __table_args__ = (
+        db.Index('ix_visit_doctor_date', 'doctor_id', 'visit_date', unique=True),
+        db.Index('ix_visit_patient_date_doctor', 'patient_key', 'visit_date', 'doctor_id', unique=True),
+        db.Index('ix_visit_date', 'visit_date'),
+    )
+
+    @property
+    def doctor_name(self):
+        """Name of the doctor of the visit"""
+        return self.doctor.doctor_name if self.doctor else None
+
+    @property
+    def patient_id(self):
+        """Id of the patient of the visit"""
+        return self.patient.patient_id if self.patient else None
+
+    @property
+    def patient_name(self):
+        """Name of the patient of the visit"""
+        return self.patient.patient_name if self.patient else None
+
+
+class VisitArchive(db.Model):
+    """The record class of archived visits
+
+    Visits older than a cutoff are moved here by archive_visits, so the visit table and its indexes hold
+    only the visits that are still booked, updated and checked for conflicts. Archived visits are read-only
+    and are selected by GET /visit/<parameter> only with include_archived, ids of archived visits may be
+    given again to new visits
+
+    :param archive_id: id of an archived visit, primary_key
+    :type archive_id: int
+    :param visit_id: id of the visit when it was live
+    :type visit_id: int
+    :param visit_date: date of a visit
+    :type visit_date: int
+    :param doctor_id: id of a doctor
+    :type doctor_id: int
+    :param patient_key: internal id of a patient
+    :type patient_key: int
+    :param version: number of the last revision of a visit
+    :type version: int
+    """
+    archive_id = db.Column(db.Integer, primary_key=True)
+    visit_id = db.Column(db.Integer, nullable=False)
+    visit_date = db.Column(db.Integer)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.doctor_id'))
+    patient_key = db.Column(db.Integer, db.ForeignKey('patient.patient_key'))
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    __table_args__ = (
+        db.Index('ix_visit_archive_id', 'visit_id'),
+        db.Index('ix_visit_archive_doctor_date', 'doctor_id', 'visit_date'),
+        db.Index('ix_visit_archive_patient_date', 'patient_key', 'visit_date'),
+        db.Index('ix_visit_archive_date', 'visit_date'),
+    )
+
+
+class IdempotencyKey(db.Model):
+    """The record class of responses of requests sent with the Idempotency-Key header
+
+    A row is inserted before the request is handled, so only one of concurrent requests with the same key
+    runs, and gets the response afterwards, which is returned to repeats of the request until it expires
+
+    :param key: value of the header, primary_key
+    :type key: str
+    :param fingerprint: hash of the method, path and body of the request
+    :type fingerprint: str
+    :param status: status code of the response, None while the request is handled
+    :type status: int
+    :param body: body of the response
+    :type body: str
+    :param created: time the request was received in seconds since the epoch
+    :type created: int
+    """
+    key = db.Column(db.String(200), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.Integer)
+    body = db.Column(db.Text)
+    created = db.Column(db.Integer, nullable=False, index=True)
+
+
+class SlotHold(db.Model):
+    """The record class of time-limited holds of dates of doctors
+
+    Only one hold of a date can exist, an expired hold is ignored by bookings and replaced by the next hold
+
+    :param doctor_id: id of a doctor, primary_key
+    :type doctor_id: int
+    :param visit_date: held date, primary_key
+    :type visit_date: int
+    :param hold_id: random id of the hold given to its owner
+    :type hold_id: str
+    :param expires: time the hold expires in seconds since the epoch
+    :type expires: float
+    """
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.doctor_id'), primary_key=True, autoincrement=False)
+    visit_date = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    hold_id = db.Column(db.String(64), nullable=False, unique=True)
+    expires = db.Column(db.Float, nullable=False, index=True)
+
+
+class ChangeCounter(db.Model):
+    """The record class of counters of changes
+
+    Counter "visits" is incremented in the transaction of every write of visits, so every process serving
+    the database can tell whether its free_slots and visit_cache are still up to date
+
+    :param name: name of a counter, primary_key
+    :type name: str
+    :param value: number of changes
+    :type value: int
+    """
+    name = db.Column(db.String(100), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+
+class IdCounter(db.Model):
+    """The record class of counters giving out ids
+
+    Counter "visits" holds the last visit_id given out, a transaction reserves the ids of all its new visits
+    with a single UPDATE of the counter, see reserve_ids, so concurrent writers never get the same ids
+    and a batch is inserted with one executemany. With shards the counter of the main database gives out
+    the ids of visits of all shards and counter "doctors" of every shard the doctor_ids of the shard
+
+    :param name: name of a counter, primary_key
+    :type name: str
+    :param value: the last id given out
+    :type value: int
+    """
+    name = db.Column(db.String(100), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+
+class VisitShard(db.Model):
+    """The record class of the directory of visits kept in shards
+
+    Used in the main database only when SHARD_URIS is set. Every live visit has a row holding the shard
+    keeping it, so a visit is found by its id in one shard and an id given by a client is taken when its row
+    exists, whichever shard keeps the visit. Rows are written before their visits, see assign_ids,
+    and removed after them, see release_ids
+
+    :param visit_id: id of a visit, primary_key
+    :type visit_id: int
+    :param shard: index of the shard keeping the visit
+    :type shard: int
+    """
+    visit_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    shard = db.Column(db.Integer, nullable=False)
+
+
+class VisitChange(db.Model):
+    """The record class of the change log of visits
+
+    Every write of visits appends its changes in its own transaction after incrementing the visits change
+    counter, which keeps concurrent writers waiting until it commits, so seq grows in the order of commits
+    and a reader never skips a change that is commited later
+
+    :param seq: sequence number of a change, primary_key
+    :type seq: int
+    :param kind: "created", "updated", "deleted", "archived", "cleared" when all visits were deleted
+    or "imported" when visits were imported in bulk and have to be read again
+    :type kind: str
+    :param visit_id: id of the visit after the change, or before it if the visit was deleted
+    :type visit_id: int
+    :param doctor_id: id of the doctor of the visit after the change
+    :type doctor_id: int
+    :param old_doctor_id: id of the doctor of the visit before the change
+    :type old_doctor_id: int
+    :param data: the visit before and after the change in json format
+    :type data: str
+    """
+    seq = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)
+    visit_id = db.Column(db.Integer)
+    doctor_id = db.Column(db.Integer)
+    old_doctor_id = db.Column(db.Integer)
+    data = db.Column(db.Text, nullable=False)
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+
+class VisitCount(db.Model):
+    """The record class of daily counts of visits of doctors
+
+    Counts are updated in the transaction of every write of visits, so reports of GET /stats/<parameter>
+    read at most one row per doctor and day instead of the visits. Archived visits stay counted, visits
+    without a doctor are counted with doctor_id 0, visits without a date aren't counted
+
+    :param day: day in 1YYMMDD format, primary_key
+    :type day: int
+    :param doctor_id: id of a doctor, primary_key
+    :type doctor_id: int
+    :param visits: number of visits of the doctor in the day
+    :type visits: int
+    :param grid_visits: number of those visits in the working hours from FIRST_HOUR to LAST_HOUR
+    :type grid_visits: int
+    """
+    day = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    doctor_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    visits = db.Column(db.Integer, nullable=False, default=0)
+    grid_visits = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Number of values bound in a single IN clause, kept below the SQLite variable limit
+BATCH_CHUNK = 500
+# Parameter of IN clauses, given a list of at most BATCH_CHUNK values when the query is executed
+IN_VALUES = db.bindparam("values", expanding=True)
+
+
+def in_chunks(values):
+    """Splits values into lists no longer than BATCH_CHUNK
+
+    :param values: values to split
+    :type values: iterable
+    :returns: generator of lists
+    :rtype: generator
+    """
+    values = list(values)
+    for start in range(0, len(values), BATCH_CHUNK):
+        yield values[start:start + BATCH_CHUNK]
+
+
+def migrate_visits():
+    """Moves doctors and patients of visits stored by names into the doctor and patient tables
+
+    Databases created before the tables were introduced keep names in every visit, the visit table
+    is rebuilt with integer keys in one transaction. Double bookings they allowed would break the unique
+    indexes, the visits booked first are kept and the others are left out and logged.
+    Has to be called after db.create_all()
+    """
+    if 'doctor_name' not in {column['name'] for column in inspect(db.engine).get_columns('visit_model')}:
+        return
+    with db.engine.begin() as connection:
+        for index in inspect(connection).get_indexes('visit_model'):
+            connection.execute(f"DROP INDEX {index['name']}")
+        connection.execute("ALTER TABLE visit_model RENAME TO visit_model_old")
+        connection.execute("INSERT INTO doctor (doctor_name) SELECT DISTINCT doctor_name FROM visit_model_old "
+                           "WHERE doctor_name IS NOT NULL AND doctor_name NOT IN (SELECT doctor_name FROM doctor)")
+        connection.execute("INSERT INTO patient (patient_id, patient_name) "
+                           "SELECT patient_id, MAX(patient_name) FROM visit_model_old "
+                           "WHERE patient_id IS NOT NULL AND patient_id NOT IN (SELECT patient_id FROM patient) "
+                           "GROUP BY patient_id")
+        VisitModel.__table__.create(connection)
+        double = "FROM visit_model_old WHERE doctor_name IS NOT NULL AND visit_date IS NOT NULL " \
+                 "AND visit_id NOT IN (SELECT MIN(visit_id) FROM visit_model_old " \
+                 "WHERE doctor_name IS NOT NULL AND visit_date IS NOT NULL GROUP BY doctor_name, visit_date)"
+        for row in connection.execute(f"SELECT {', '.join(VISIT_FIELDS)} {double} ORDER BY visit_id"):
+            current_app.logger.warning("Removed double booking %s", json_encoder.encode(dict(zip(VISIT_FIELDS, row))))
+        connection.execute("INSERT INTO visit_model (visit_id, visit_date, doctor_id, patient_key) "
+                           "SELECT v.visit_id, v.visit_date, d.doctor_id, p.patient_key FROM visit_model_old v "
+                           "LEFT JOIN doctor d ON d.doctor_name = v.doctor_name "
+                           "LEFT JOIN patient p ON p.patient_id = v.patient_id "
+                           f"WHERE v.visit_id NOT IN (SELECT visit_id {double})")
+        connection.execute("DROP TABLE visit_model_old")
+        if connection.dialect.name == 'postgresql':
+            connection.execute("SELECT setval(pg_get_serial_sequence('visit_model', 'visit_id'), "
+                               "COALESCE(MAX(visit_id), 0) + 1, false) FROM visit_model")
+
+
+# Letters without a decomposition into a base letter and a combining accent, replaced by fold_name
+UNACCENTED = str.maketrans({"ł": "l", "đ": "d", "ø": "o", "ħ": "h", "ı": "i"})
+
+
+def fold_name(name):
+    """Returns name lowercased and stripped of accents, e.g. "stanislaw" for "Stanisław"
+
+    :param name: the name
+    :type name: str
+    :returns: the folded name, None for None
+    :rtype: str
+    """
+    if name is None:
+        return None
+    decomposed = unicodedata.normalize("NFKD", name.casefold().translate(UNACCENTED))
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def doctor_keys(names):
+    """Returns doctor_id of every given doctor, adding missing doctors to the doctor table
+
+    Missing doctors are added in the current transaction, so a rejected booking leaves no doctor behind.
+    Has to be called before anything else is written in the transaction, because a doctor added
+    by a concurrent request rolls it back. With shards the ids of a shard come from its counter "doctors",
+    doctor_id = number * shards + shard, so they are unique in all shards
+
+    :param names: names of doctors
+    :type names: iterable
+    :returns: dictionary of doctor_id of every doctor's name
+    :rtype: dict
+    """
+    names = {name for name in names if name is not None}
+    added = db.session.info.setdefault("added_doctors", {})
+    query = select([Doctor.doctor_name, Doctor.doctor_id]).where(Doctor.doctor_name.in_(IN_VALUES))
+    for chunk in in_chunks(names - doctor_ids.keys() - added.keys()):
+        doctor_ids.update(db.session.execute(query, {"values": chunk}).fetchall())
+    missing = names - doctor_ids.keys() - added.keys()
+    while missing:
+        rows = [{"doctor_name": name, "search_name": fold_name(name)} for name in missing]
+        try:
+            if shard_engines:
+                first = reserve_ids("doctors", len(rows))
+                for number, row in enumerate(rows, first):
+                    row["doctor_id"] = number * shard_count() + current_shard()
+            db.session.execute(Doctor.__table__.insert(), rows)
+        except IntegrityError:  # added by a concurrent request
+            db.session.rollback()
+            known = doctor_ids
+        else:
+            known = added
+        for chunk in in_chunks(missing):
+            known.update(db.session.execute(query, {"values": chunk}).fetchall())
+        added = db.session.info.setdefault("added_doctors", {})
+        missing = names - doctor_ids.keys() - added.keys()
+    return {name: doctor_ids[name] if name in doctor_ids else added[name] for name in names}
+
+
+@event.listens_for(db.session, 'after_commit')
+def keep_added_doctors(session):
+    """Makes doctors added by the committed transaction known to every request and keeps the ids it claimed"""
+    doctor_ids.update(session.info.pop("added_doctors", {}))
+    session.info.pop("claimed_ids", None)
+
+
+@event.listens_for(db.session, 'after_transaction_end')
+def forget_added_doctors(session, transaction):
+    """Forgets doctors and patients added by the transaction that ended, releases ids claimed by one rolled back"""
+    if transaction.parent is None:
+        session.info.pop("added_doctors", None)
+        session.info.pop("added_patients", None)
+        release_ids(session.info.pop("claimed_ids", []))
+
+
+def patient_keys(patients):
+    """Returns patient_key of every given patient, adding missing patients to the patient table
+
+    Missing patients are added in the current transaction like doctors by doctor_keys, their ids are kept
+    in its session's info under "added_patients" until it ends, so a rejected booking leaves no patient behind.
+    Has to be called before anything else is written in the transaction, because a patient added by a concurrent
+    request rolls it back. With shards the patients added to the current one are returned as renamed too,
+    marked as added, since other shards may know them by another name, see spread_names
+
+    :param patients: dictionary of patient's name of every patient_id
+    :type patients: dict
+    :returns: dictionary of patient_key of every patient_id and list of patients whose name has changed,
+    to be passed to rename_patients in the transaction of the booking
+    :rtype: tuple
+    """
+    keys, names = {}, {}
+    ids = {patient_id for patient_id in patients if patient_id is not None}
+    query = select([Patient.patient_id, Patient.patient_key, Patient.patient_name])\
+        .where(Patient.patient_id.in_(IN_VALUES))
+
+    def read(chunk):
+        for patient_id, patient_key, patient_name in db.session.execute(query, {"values": chunk}).fetchall():
+            keys[patient_id] = patient_key
+            names[patient_id] = patient_name
+
+    for chunk in in_chunks(ids):
+        read(chunk)
+    missing = ids - keys.keys()
+    while missing:
+        try:
+            db.session.execute(Patient.__table__.insert(), [{"patient_id": patient_id,
+                                                             "patient_name": patients[patient_id],
+                                                             "search_name": fold_name(patients[patient_id])}
+                                                            for patient_id in missing])
+        except IntegrityError:  # added by a concurrent request
+            db.session.rollback()
+            keys.clear()
+            missing = ids
+        else:
+            db.session.info.setdefault("added_patients", set()).update(missing)
+        for chunk in in_chunks(missing):
+            read(chunk)
+        missing = ids - keys.keys()
+    added = db.session.info.get("added_patients", set())
+    renamed = [{"key": keys[patient_id], "id": patient_id, "name": patients[patient_id],
+                "search": fold_name(patients[patient_id]), "added": patient_id in added}
+               for patient_id in ids
+               if names[patient_id] != patients[patient_id] or shard_engines and patient_id in added]
+    return keys, renamed
+
+
+def visit_keys(doctor_names, patients):
+    """Returns keys of the doctors and patients of visits, adding missing ones in the current transaction
+
+    A patient added by a concurrent request rolls back the doctors added before it, then both are read again.
+    Has to be called before anything else is written in the transaction
+
+    :param doctor_names: names of doctors
+    :type doctor_names: iterable
+    :param patients: dictionary of patient's name of every patient_id
+    :type patients: dict
+    :returns: doctor_id of every doctor's name, patient_key of every patient_id and the renamed patients,
+    see patient_keys
+    :rtype: tuple
+    """
+    doctor_names = list(doctor_names)
+    while True:
+        doctors = doctor_keys(doctor_names)
+        keys, renamed = patient_keys(patients)
+        added = db.session.info.get("added_doctors", {})
+        if all(name in doctor_ids or name in added for name in doctors):
+            return doctors, keys, renamed
+
+
+def reserve_ids(name, count, above=0, connection=None):
+    """Reserves a range of ids from a counter of the current shard
+
+    The counter is moved past the ids up to above and past the range by a single UPDATE, which keeps
+    concurrent writers waiting until the transaction ends, so their ranges never overlap
+
+    :param name: name of an IdCounter
+    :type name: str
+    :param count: number of reserved ids
+    :type count: int
+    :param above: the highest id given by the caller, the counter isn't left below it
+    :type above: int
+    :param connection: connection running the transaction, None for the current session
+    :type connection: sqlalchemy.engine.Connection object
+    :returns: the first reserved id
+    :rtype: int
+    """
+    connection = connection or db.session
+    counter = IdCounter.__table__
+    connection.execute(counter.update().where(counter.c.name == name).values(
+        value=db.case([(counter.c.value < above, above)], else_=counter.c.value) + count))
+    return connection.execute(select([counter.c.value]).where(counter.c.name == name)).scalar() - count + 1
+
+
+def claim_ids(rows, connection):
+    """Reserves ids of visits of the current shard and writes them to the directory of visits
+
+    :param rows: column values of the visits, visit_id None for a new id
+    :type rows: list
+    :param connection: connection running a transaction in the main database
+    :type connection: sqlalchemy.engine.Connection object or sqlalchemy.orm.Session object
+    :returns: visit_id of every visit, None for given ids that are taken
+    :rtype: list
+    """
+    given = {row["visit_id"] for row in rows if row["visit_id"] is not None}
+    first = reserve_ids("visits", sum(row["visit_id"] is None for row in rows), max(given, default=0), connection)
+    taken = set()
+    query = select([VisitShard.visit_id]).where(VisitShard.visit_id.in_(IN_VALUES))
+    for chunk in in_chunks(given):
+        taken.update(visit_id for visit_id, in connection.execute(query, {"values": chunk}))
+    new = itertools.count(first)
+    ids = []
+    for row in rows:
+        if row["visit_id"] is None:
+            ids.append(next(new))
+        elif row["visit_id"] in taken:
+            ids.append(None)
+        else:
+            ids.append(row["visit_id"])
+            taken.add(row["visit_id"])
+    claimed = [{"visit_id": visit_id, "shard": current_shard()} for visit_id in ids if visit_id is not None]
+    if claimed:
+        connection.execute(VisitShard.__table__.insert(), claimed)
+    return ids
+
+
+def assign_ids(rows):
+    """Gives ids to visits written in the current transaction, new ones to visits without visit_id
+
+    Ids come from counter "visits" of the main database, see reserve_ids, which is also moved past the given ids.
+    With shards every id is written to the directory of visits too, where a given id already there is taken.
+    The main database writes the directory in the transaction of its visits, other shards in a transaction
+    of their own commited first, whose ids are released again when the transaction of the visits doesn't
+    commit, see forget_added_doctors. Has to be called after visit_keys
+
+    :param rows: column values of the visits, visit_id None for a new id
+    :type rows: list
+    :returns: visit_id of every visit, None for given ids taken by visits of any shard
+    :rtype: list
+    """
+    if not shard_engines:
+        given = [row["visit_id"] for row in rows if row["visit_id"] is not None]
+        new = itertools.count(reserve_ids("visits", len(rows) - len(given), max(given, default=0)))
+        return [next(new) if row["visit_id"] is None else row["visit_id"] for row in rows]
+    if not current_shard():
+        return claim_ids(rows, db.session)
+    while True:
+        try:
+            with db.main_engine().begin() as connection:
+                ids = claim_ids(rows, connection)
+            break
+        except IntegrityError:  # a given id was claimed by a concurrent request in the meantime
+            continue
+    db.session.info.setdefault("claimed_ids", []).extend(visit_id for visit_id in ids if visit_id is not None)
+    return ids
+
+
+def release_ids(ids):
+    """Removes ids of visits that no longer exist from the directory of visits, so they can be given again
+
+    Called after the transaction removing the visits was commited, a visit removed by a process that stopped
+    in the meantime keeps its id taken until reshard-visits builds the directory again
+
+    :param ids: ids of the visits
+    :type ids: list
+    """
+    if not shard_engines or not ids:
+        return
+    with db.main_engine().begin() as connection:
+        for chunk in in_chunks(ids):
+            connection.execute(VisitShard.__table__.delete().where(VisitShard.visit_id.in_(IN_VALUES)),
+                               {"values": chunk})
+
+
+def rename_patients(renamed):
+    """Stores names of patients given in their latest booking
+
+    Every visit of a renamed patient shows the new name, so all of them are returned as changed
+
+    :param renamed: list returned by patient_keys, patients marked as added are skipped
+    :type renamed: list
+    :returns: changes of the visits of the renamed patients, to be recorded with the other changes
+    :rtype: list
+    """
+    renamed = [patient for patient in renamed if not patient.get("added")]
+    if not renamed:
+        return []
+    names = {patient["key"]: patient["name"] for patient in renamed}
+    query = visit_rows().add_columns(VisitModel.patient_key).filter(VisitModel.patient_key.in_(IN_VALUES))
+    changes = []
+    for chunk in in_chunks(names):
+        for row in query.params(values=chunk):
+            old = dict(zip(VISIT_FIELDS, row[:-1]))
+            changes.append((old, dict(old, patient_name=names[row[-1]])))
+    db.session.execute(Patient.__table__.update().where(Patient.patient_key == db.bindparam("key"))
+                       .values(patient_name=db.bindparam("name"), search_name=db.bindparam("search")), renamed)
+    return changes
+
+
+def spread_names(renamed):
+    """Gives patients renamed in one shard their new names in the other shards
+
+    Called after the booking that renamed them was commited, every shard knowing a patient by another name
+    renames it in a transaction of its own, so the visits of the patient show the same name in all shards
+
+    :param renamed: patients renamed by the booking, given by patient_keys
+    :type renamed: list
+    """
+    if not shard_engines or not renamed:
+        return
+    patients = {patient["id"]: patient for patient in renamed}
+    query = select([Patient.patient_id, Patient.patient_key, Patient.patient_name])\
+        .where(Patient.patient_id.in_(IN_VALUES))
+
+    def rename():
+        stale = []
+        for chunk in in_chunks(patients):
+            for patient_id, patient_key, patient_name in db.session.execute(query, {"values": chunk}):
+                if patient_name != patients[patient_id]["name"]:
+                    stale.append(dict(patients[patient_id], key=patient_key, added=False))
+        if stale:
+            changes = rename_patients(stale)
+            version = record_changes(changes)
+            db.session.commit()
+            apply_changes(changes, version)
+
+    fan_out(rename)
+
+
+# Columns introduced after their tables were created, with their definitions
+ADDED_COLUMNS = (("visit_model", "version", "INTEGER NOT NULL DEFAULT 1"),
+                 ("doctor", "changes", "INTEGER NOT NULL DEFAULT 0"),
+                 ("patient", "changes", "INTEGER NOT NULL DEFAULT 0"),
+                 ("doctor", "search_name", "VARCHAR(500)"),
+                 ("patient", "search_name", "VARCHAR(500)"))
+
+
+def add_columns():
+    """Adds columns introduced after the tables were created
+
+    db.create_all() does not change a table that already exists, rows of older databases get the default values
+    """
+    for table, column, definition in ADDED_COLUMNS:
+        if column not in {existing['name'] for existing in inspect(db.engine).get_columns(table)}:
+            with db.engine.begin() as connection:
+                connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def remove_double_bookings():
+    """Deletes visits that take a date of a doctor taken by a visit with lower visit_id
+
+    Every deleted visit is logged with its data
+
+    :returns: number of deleted visits
+    :rtype: int
+    """
+    booked = db.and_(VisitModel.doctor_id.isnot(None), VisitModel.visit_date.isnot(None))
+    first = select([db.func.min(VisitModel.visit_id)]).where(booked)\
+        .group_by(VisitModel.doctor_id, VisitModel.visit_date)
+    for row in visit_rows().filter(booked, VisitModel.visit_id.notin_(first)).order_by(VisitModel.visit_id):
+        current_app.logger.warning("Removed double booking %s", json_encoder.encode(dict(zip(VISIT_FIELDS, row))))
+    removed = db.session.execute(VisitModel.__table__.delete().where(booked)
+                                 .where(VisitModel.visit_id.notin_(first))).rowcount
+    db.session.commit()
+    return removed
+
+
+def create_indexes():
+    """Creates missing indexes of the visit table
+
+    db.create_all() does not add indexes to a table that already exists, so databases created
+    before the indexes were introduced get them here. Such databases may hold double bookings,
+    which the unique indexes reject, the visits booked first are kept and the others removed
+    """
+    existing = {index['name'] for index in inspect(db.engine).get_indexes(VisitModel.__tablename__)}
+    for index in VisitModel.__table__.indexes:
+        if index.name not in existing:
+            try:
+                index.create(db.engine)
+            except IntegrityError:
+                remove_double_bookings()
+                index.create(db.engine)
+
+
+# Tables of the names searched by GET /visit/search with their keys and name columns
+SEARCHED_TABLES = ((Patient, "patient_key", "patient_name"), (Doctor, "doctor_id", "doctor_name"))
+# Whether the names are indexed by SQLite FTS5, set by create_search_index
+search_index = {"fts5": False}
+
+
+def create_search_index():
+    """Creates missing full-text indexes of the names of patients and doctors
+
+    Every index is an FTS5 table over the name and search_name columns of its table, kept in sync
+    by triggers on every write of the table, with an fts5vocab table listing its words for fuzzy search.
+    Other databases and SQLite built without FTS5 are searched without an index
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return
+    with db.engine.begin() as connection:
+        existing = {name for name, in connection.execute("SELECT name FROM sqlite_master")}
+        for model, key, column in SEARCHED_TABLES:
+            table = model.__tablename__
+            index = f"{table}_search"
+            vocabulary = f"CREATE VIRTUAL TABLE IF NOT EXISTS {index}_vocab USING fts5vocab({index}, 'col')"
+            if index in existing:
+                connection.execute(vocabulary)
+                continue
+            try:
+                connection.execute(f"CREATE VIRTUAL TABLE {index} USING fts5({column}, search_name, "
+                                   f"content='{table}', content_rowid='{key}', "
+                                   f"tokenize='unicode61 remove_diacritics 0')")
+            except OperationalError:  # no FTS5 in this SQLite
+                return
+            old = f"INSERT INTO {index}({index}, rowid, {column}, search_name) " \
+                  f"VALUES ('delete', old.{key}, old.{column}, old.search_name);"
+            new = f"INSERT INTO {index}(rowid, {column}, search_name) " \
+                  f"VALUES (new.{key}, new.{column}, new.search_name);"
+            connection.execute(f"CREATE TRIGGER {index}_insert AFTER INSERT ON {table} BEGIN {new} END")
+            connection.execute(f"CREATE TRIGGER {index}_delete AFTER DELETE ON {table} BEGIN {old} END")
+            connection.execute(f"CREATE TRIGGER {index}_update AFTER UPDATE OF {column}, search_name ON {table} "
+                               f"BEGIN {old} {new} END")
+            connection.execute(f"INSERT INTO {index}({index}) VALUES ('rebuild')")
+            connection.execute(vocabulary)
+    search_index["fts5"] = True
+
+
+def fill_search_names():
+    """Sets search_name of doctors and patients added without it, by older versions or by the migration"""
+    for model, key, column in SEARCHED_TABLES:
+        key, column = getattr(model, key), getattr(model, column)
+        query = select([key, column]).where(model.search_name.is_(None)).where(column.isnot(None))\
+            .order_by(key).limit(BATCH_CHUNK)
+        update = model.__table__.update().where(key == db.bindparam("key"))\
+            .values(search_name=db.bindparam("search"))
+        while True:
+            rows = db.session.execute(query).fetchall()
+            if not rows:
+                break
+            db.session.execute(update, [{"key": row[0], "search": fold_name(row[1])} for row in rows])
+            db.session.commit()
+
+
+def conflict_error(req):
+    """Finds out which rule was broken by a rejected visit
+
+    Called only after the database refused the insert, so the successful path stays a single query
+
+    :param req: parsed arguments of the rejected visit
+    :type req: dict
+    :returns: flask.Response object containing the error message in json format with error code
+    :rtype: flask.Response object
+    """
+    if req["visit_id"] is not None and VisitModel.query.get(req["visit_id"]) is not None:
+        return id_taken_error(req["visit_id"])
+
+    result = VisitModel.query.filter_by(visit_date=req["visit_date"], doctor_id=doctor_ids.get(req["doctor_name"]))\
+        .first()
+    if result and result.patient_id == req["patient_id"]:
+        metrics.count("visits_booking_conflicts_total", reason="already_booked")
+        return make_response(jsonify({"error": "You've already made such appointment..."}), 409)
+    if result:
+        metrics.count("visits_booking_conflicts_total", reason="date_taken")
+        return make_response(jsonify({"error": "The given date is taken..."}), 409)
+
+    # The row that caused the conflict was removed in the meantime
+    metrics.count("visits_booking_conflicts_total", reason="race")
+    return make_response(jsonify({'error': 'Someone just took this date...'}), 409)
+
+
+def create_counters():
+    """Creates missing change counters and id counters"""
+    for model, name in ((ChangeCounter, "visits"), (IdCounter, "visits"), (IdCounter, "doctors")):
+        if model.query.get(name) is None:
+            db.session.add(model(name=name, value=0))
+            try:
+                db.session.commit()
+            except IntegrityError:  # created by another process in the meantime
+                db.session.rollback()
+
+
+def rebuild_counts():
+    """Counts the live and archived visits of every doctor and day again, replacing the daily counts of visits
+
+    The visits change counter is incremented first, so writes of visits wait until the counts are replaced
+
+    :returns: number of counted pairs of a doctor and a day
+    :rtype: int
+    """
+    db.session.query(ChangeCounter).filter_by(name="visits").update({"value": ChangeCounter.value + 1},
+                                                                    synchronize_session=False)
+    db.session.execute(VisitCount.__table__.delete())
+    visits = db.union_all(*(select([model.visit_date, model.doctor_id]).where(model.visit_date.isnot(None))
+                            for model in (VisitModel, VisitArchive))).alias()
+    day = visits.c.visit_date / 100
+    hour = visits.c.visit_date % 100
+    grid = db.case([(db.and_(hour >= FIRST_HOUR, hour <= LAST_HOUR), 1)], else_=0)
+    doctor_id = db.func.coalesce(visits.c.doctor_id, 0)
+    counts = select([day, doctor_id, db.func.count(), db.func.sum(grid)]).group_by(day, doctor_id)
+    result = db.session.execute(VisitCount.__table__.insert()
+                                .from_select(["day", "doctor_id", "visits", "grid_visits"], counts))
+    db.session.commit()
+    return result.rowcount
+
+
+@click.command('rebuild-counts')
+@with_appcontext
+def rebuild_counts_command():
+    """Rebuilds daily counts of visits served by GET /stats/<parameter> from the visit table"""
+    click.echo(f"Counted visits of {sum(each_shard(rebuild_counts))} doctor days")
+
+
+# Number of visits moved to the archive in one transaction
+ARCHIVE_BATCH = 1000
+
+
+def archive_visits(before, batch=ARCHIVE_BATCH):
+    """Moves visits earlier than a date from the visit table to the archive
+
+    Visits are moved in transactions of batch visits, so writes of visits wait at most for one batch.
+    Every batch is recorded like other changes, so other processes drop their cached responses and
+    followers of GET /visit/changes get "archived" events. Ids of archived visits leave the directory of visits
+    like ids of deleted ones
+
+    :param before: date in 1YYMMDDHH format, visits earlier than that are archived
+    :type before: int
+    :param batch: number of visits moved in one transaction
+    :type batch: int
+    :returns: number of archived visits
+    :rtype: int
+    """
+    columns = ["visit_id", "visit_date", "doctor_id", "patient_key", "version"]
+    archived = 0
+    while True:
+        # Writes of visits wait from here until the batch is commited, so the read visits stay as they are
+        db.session.query(ChangeCounter).filter_by(name="visits").update({"value": ChangeCounter.value + 1},
+                                                                        synchronize_session=False)
+        rows = visit_rows().filter(VisitModel.visit_date < before).order_by(VisitModel.visit_date).limit(batch).all()
+        if not rows:
+            db.session.rollback()
+            return archived
+        for ids in in_chunks(row.visit_id for row in rows):
+            db.session.execute(VisitArchive.__table__.insert().from_select(
+                columns, select([getattr(VisitModel, column) for column in columns])
+                .where(VisitModel.visit_id.in_(IN_VALUES))), {"values": ids})
+            db.session.execute(VisitModel.__table__.delete().where(VisitModel.visit_id.in_(IN_VALUES)),
+                               {"values": ids})
+        changes = [(dict(zip(VISIT_FIELDS, row)), None) for row in rows]
+        version = record_changes(changes, archived=True)
+        db.session.commit()
+        apply_changes(changes, version)
+        release_ids([row.visit_id for row in rows])
+        archived += len(rows)
+
+
+@click.command('archive-visits')
+@click.option('--before', type=int, help="date in 1YYMMDDHH format, earlier visits are archived")
+@click.option('--days', type=int, help="visits that took place more than that many days ago are archived")
+@click.option('--batch', type=int, default=ARCHIVE_BATCH, show_default=True,
+              help="number of visits moved in one transaction")
+@with_appcontext
+def archive_visits_command(before, days, batch):
+    """Moves past visits to the archive, where GET /visit/<parameter> finds them with include_archived"""
+    if (before is None) == (days is None):
+        raise click.UsageError("Give either --before or --days")
+    if before is None:
+        before = date_to_day(datetime.date.today() - datetime.timedelta(days=days)) * 100
+    archived = sum(each_shard(lambda: archive_visits(before, batch)))
+    click.echo(f"Archived {archived} visits earlier than {before}")
+
+
+def visit_values(entry):
+    """Returns column values of a visit
+
+    :param entry: the visit
+    :type entry: VisitModel object
+    :returns: dictionary of column values
+    :rtype: dict
+    """
+    return {"visit_id": entry.visit_id, "visit_date": entry.visit_date, "patient_id": entry.patient_id,
+            "patient_name": entry.patient_name, "doctor_name": entry.doctor_name}
+
+
+def change_row(old, new):
+    """Returns column values of the change log entry of a visit
+
+    :param old: column values of the visit before the change, None if it was created
+    :type old: dict
+    :param new: column values of the visit after the change, None if it was deleted
+    :type new: dict
+    :returns: dictionary of column values of VisitChange
+    :rtype: dict
+    """
+    old = None if old is None else {field: old[field] for field in VISIT_FIELDS}
+    new = None if new is None else {field: new[field] for field in VISIT_FIELDS}
+    visit_id = (new or old)["visit_id"]
+    return {"kind": "created" if old is None else "deleted" if new is None else "updated", "visit_id": visit_id,
+            "doctor_id": None if new is None else find_doctor(new["doctor_name"]),
+            "old_doctor_id": None if old is None else find_doctor(old["doctor_name"]),
+            "data": json_encoder.encode({"visit_id": visit_id, "old": old, "new": new})}
+
+
+def count_changes(changes):
+    """Updates daily counts of visits by changes of visits in the current transaction
+
+    Has to be called after the visits change counter was incremented, which keeps concurrent writers
+    from inserting the same counts
+
+    :param changes: pairs of column values of a visit before and after the change, as given to record_changes
+    :type changes: list
+    """
+    deltas = {}
+    for old, new in changes:
+        for value, sign in ((old, -1), (new, 1)):
+            if value is not None and value["visit_date"] is not None:
+                day, hour = split_date(value["visit_date"])
+                delta = deltas.setdefault((day, find_doctor(value["doctor_name"]) or 0), [0, 0])
+                delta[0] += sign
+                delta[1] += sign if FIRST_HOUR <= hour <= LAST_HOUR else 0
+    deltas = {key: delta for key, delta in deltas.items() if delta != [0, 0]}
+    if not deltas:
+        return
+
+    existing = set()
+    query = select([VisitCount.day, VisitCount.doctor_id]).where(VisitCount.day.in_(IN_VALUES))
+    for chunk in in_chunks({day for day, _ in deltas}):
+        existing.update(tuple(row) for row in db.session.execute(query, {"values": chunk}))
+    rows = [{"b_day": day, "b_doctor_id": doctor_id, "b_visits": visits, "b_grid_visits": grid_visits}
+            for (day, doctor_id), (visits, grid_visits) in deltas.items()]
+    updated = [row for row in rows if (row["b_day"], row["b_doctor_id"]) in existing]
+    if updated:
+        db.session.execute(VisitCount.__table__.update()
+                           .where(VisitCount.day == db.bindparam("b_day"))
+                           .where(VisitCount.doctor_id == db.bindparam("b_doctor_id"))
+                           .values(visits=VisitCount.visits + db.bindparam("b_visits"),
+                                   grid_visits=VisitCount.grid_visits + db.bindparam("b_grid_visits")), updated)
+    inserted = [{"day": row["b_day"], "doctor_id": row["b_doctor_id"], "visits": row["b_visits"],
+                 "grid_visits": row["b_grid_visits"]}
+                for row in rows if (row["b_day"], row["b_doctor_id"]) not in existing]
+    if inserted:
+        db.session.execute(VisitCount.__table__.insert(), inserted)
+
+
+def record_changes(changes, archived=False):
+    """Records changes of visits in the current transaction, has to be called before commit
+
+    Besides the change counters the changes are appended to the change log read by GET /visit/changes
+    and added to the daily counts of visits
+
+    :param changes: pairs of column values of a visit before and after the change, None for a visit that
+    didn't exist before or doesn't exist after, or None when all visits were deleted; created visits
+    carry the visit_id given by the database, mirrors match later changes of the visit by it
+    :type changes: list
+    :param archived: True if the visits were moved to the archive, they stay in the daily counts
+    :type archived: bool
+    :returns: new value of the visits change counter
+    :rtype: int
+    """
+    db.session.query(ChangeCounter).filter_by(name="visits").update({"value": ChangeCounter.value + 1},
+                                                                    synchronize_session=False)
+    if changes is None:
+        db.session.execute(Doctor.__table__.update().values(changes=Doctor.changes + 1))
+        db.session.execute(Patient.__table__.update().values(changes=Patient.changes + 1))
+        db.session.execute(VisitCount.__table__.delete())
+    else:
+        values = [value for pair in changes for value in pair if value is not None]
+        for table, column, key in ((Doctor.__table__, Doctor.doctor_name, "doctor_name"),
+                                   (Patient.__table__, Patient.patient_id, "patient_id")):
+            query = table.update().where(column.in_(IN_VALUES)).values(changes=table.c.changes + 1)
+            for chunk in in_chunks({value[key] for value in values if value[key] is not None}):
+                db.session.execute(query, {"values": chunk})
+        if not archived:
+            count_changes(changes)
+    if changes is None:
+        log = [{"kind": "cleared", "visit_id": None, "doctor_id": None, "old_doctor_id": None,
+                "data": json_encoder.encode({"visit_id": None, "old": None, "new": None})}]
+    else:
+        log = [change_row(old, new) for old, new in changes]
+        if archived:
+            for row in log:
+                row["kind"] = "archived"
+    if log:
+        db.session.execute(VisitChange.__table__.insert(), log)
+    return db.session.query(ChangeCounter.value).filter_by(name="visits").scalar()
+
+
+def apply_changes(changes, version):
+    """Updates free_slots and visit_cache after the changes were commited
+
+    :param changes: the same value as given to record_changes
+    :type changes: list
+    :param version: value returned by record_changes
+    :type version: int
+    """
+    if changes is None:
+        free_slots.clear()
+        visit_cache.clear()
+    else:
+        for old, new in changes:
+            if old is not None:
+                free_slots.remove(old["doctor_name"], old["visit_date"])
+                visit_cache.invalidate(visit_tags(old["visit_id"], old["visit_date"], old["patient_id"],
+                                                  old["doctor_name"]))
+            if new is not None:
+                free_slots.add(new["doctor_name"], new["visit_date"])
+                visit_cache.invalidate(visit_tags(new["visit_id"], new["visit_date"], new["patient_id"],
+                                                  new["doctor_name"]))
+    # Own change keeps the local state up to date, unless another process wrote in the meantime
+    if local_state["version"] == version - 1:
+        local_state["version"] = version
+    with change_signal:
+        change_signal.notify_all()
+
+
+def sync_local_state(slots):
+    """Drops visit_cache and free_slots when another process changed the visits
+
+    free_slots isn't dropped in processes running the thread of refresh_local_state, which applies the changes
+
+    :param slots: whether free_slots is going to be used and has to be rebuilt if it was dropped
+    :type slots: bool
+    """
+    version = db.session.query(ChangeCounter.value).filter_by(name="visits").scalar()
+    if version != local_state["version"]:
+        visit_cache.clear()
+        if refresher["pid"] != os.getpid():
+            local_state["slots"] = False
+        local_state["version"] = version
+    if slots and not local_state["slots"]:
+        rebuild_slots()
+
+
+def sync_slots():
+    """Makes free_slots of the current shard up to date before it is used
+
+    Processes running the thread of refresh_local_state don't query anything, the others read the change counter
+    """
+    if refresher["pid"] != os.getpid() or not local_state["slots"]:
+        sync_local_state(True)
+
+
+def load_doctors():
+    """Loads all doctors of the current shard into doctor_ids"""
+    count = 0
+    for doctor_id, doctor_name in db.session.query(Doctor.doctor_id, Doctor.doctor_name):
+        doctor_ids[doctor_name] = doctor_id
+        count += 1
+    local_state["doctors"] = count
+
+
+def rebuild_slots():
+    """Fills free_slots of the current shard from the visits and doctor_ids from the doctors
+
+    The position in the change log is read first, so changes commited during the rebuild are applied
+    again by refresh_slots, which changes nothing they already did
+    """
+    local_state["seq"] = change_head()
+    load_doctors()
+    free_slots.rebuild(db.session.query(Doctor.doctor_name, VisitModel.visit_date).join(VisitModel.doctor))
+    local_state["slots"] = True
+
+
+def refresh_slots():
+    """Applies the changes of the visits of the current shard made since the last call to free_slots
+
+    Changes are read from the change log following the last one applied, all visits are read again only after
+    an import. Doctors are loaded again when their number changed
+    """
+    if db.session.query(db.func.count(Doctor.doctor_id)).scalar() != local_state["doctors"]:
+        load_doctors()
+    if not local_state["slots"]:
+        rebuild_slots()
+        return
+    while True:
+        rows, last = read_log(local_state["seq"], None, STREAM_CHUNK)
+        for _, kind, data in rows:
+            if kind == "imported":
+                rebuild_slots()
+                return
+            if kind == "cleared":
+                free_slots.clear()
+                continue
+            change = json.loads(data)
+            if change["old"] is not None:
+                free_slots.remove(change["old"]["doctor_name"], change["old"]["visit_date"])
+            if change["new"] is not None:
+                free_slots.add(change["new"]["doctor_name"], change["new"]["visit_date"])
+        local_state["seq"] = last
+        if len(rows) < STREAM_CHUNK:
+            return
+
+
+def active_holds():
+    """Returns holds of dates of the current shard that haven't expired
+
+    :returns: quadruples of doctor's name, visit date, hold id and the time the hold expires
+    :rtype: list
+    """
+    return db.session.query(Doctor.doctor_name, SlotHold.visit_date, SlotHold.hold_id, SlotHold.expires)\
+        .join(Doctor, Doctor.doctor_id == SlotHold.doctor_id).filter(SlotHold.expires > time.time()).all()
+
+
+def refresh_local_state(app, interval):
+    """Keeps free_slots, slot_holds and doctor_ids of all shards up to date, runs in a thread of every process
+
+    :param app: the application
+    :type app: flask.Flask object
+    :param interval: time in seconds between the refreshes
+    :type interval: float
+    """
+    while True:
+        try:
+            with app.app_context():
+                holds = []
+                for shard in range(shard_count()):
+                    with use_shard(shard):
+                        refresh_slots()
+                        holds += active_holds()
+                        db.session.remove()
+                local_seconds = app.config['HOLD_LOCAL_SECONDS']
+                slot_holds.replace((doctor_name, visit_date, hold_id, min(expires, time.time() + local_seconds))
+                                   for doctor_name, visit_date, hold_id, expires in holds)
+        except Exception:  # the next refresh tries again
+            app.logger.exception("Refreshing free slots failed")
+        time.sleep(interval)
+
+
+class MyAppSchema(ma.Schema):
+    """The class that provides object serialization
+
+    This class is a schema that finds certain keywords and completes objects from given data
+    """
+    class Meta:
+        fields = ('visit_id', 'visit_date', 'patient_id', 'patient_name', 'doctor_name')
+
+
+my_app_schema = MyAppSchema(many=True)
+
+
+# Arguments of the visit routes with their types, read from the json body, the query string and the form
+VISIT_ARGS = (("visit_id", int), ("visit_date", int), ("patient_id", str), ("patient_name", str),
+              ("doctor_name", str))
+# Keyset pagination on visit_id: ?after=<last visit_id seen>&limit=<page size>, format=ndjson streams the rows,
+# visits ordered by date also need after_date=<last visit_date seen>
+PAGE_ARGS = (("after", int), ("after_date", int), ("limit", int), ("format", str))
+# Selectors of GET /visit/<parameter> and GET /slot/<parameter>
+VISIT_SELECTORS = ("doctor", "patient", "selected", "date", "id", "all", "query")
+SLOT_SELECTORS = ("free", "next")
+# Selectors of GET /stats/<parameter>, counts of visits of every doctor and day, of every day and of every month
+STATS_SELECTORS = ("doctor", "day", "month")
+# Filters of GET /stats/<parameter>, from and to are inclusive bounds in the visit_date format, only their days count
+STATS_ARGS = (("from", int), ("to", int), ("doctor_name", str))
+# Number of hourly slots of a doctor in a day
+GRID_HOURS = LAST_HOUR - FIRST_HOUR + 1
+# Filters of GET /visit/query, every one is optional, from and to are inclusive bounds of visit_date
+QUERY_ARGS = (("from", int), ("to", int), ("doctor_name", str), ("patient_id", str), ("order", str))
+# Orders of GET /visit/query, by visit_id, by date from the earliest and by date from the latest
+ORDERS = ("id", "date", "-date")
+
+# Columns of a visit in the order of keys in json, selected as plain tuples instead of VisitModel objects
+VISIT_FIELDS = ('doctor_name', 'patient_id', 'patient_name', 'visit_date', 'visit_id')
+VISIT_COLUMNS = (Doctor.doctor_name, Patient.patient_id, Patient.patient_name, VisitModel.visit_date,
+                 VisitModel.visit_id)
+json_encoder = json.JSONEncoder(separators=(',', ':'))
+
+# Number of rows fetched from the database cursor at once while streaming
+STREAM_CHUNK = 1000
+
+
+def parse_args(arguments):
+    """Reads arguments of a request
+
+    Lean replacement of flask_restful reqparse looking the arguments up in the same order, the json body first,
+    then the query string and then the form, aborting with 400 if any of the given values is invalid
+
+    :param arguments: pairs of argument's name and type
+    :type arguments: tuple
+    :returns: dictionary of converted arguments, None for missing ones
+    :rtype: dict
+    """
+    source = MultiDict()
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        source.update(body)
+    source.update(request.values)
+    args = {}
+    for name, convert in arguments:
+        values = source.getlist(name)
+        for index, value in enumerate(values):
+            if value is not None:
+                try:
+                    values[index] = convert(value)
+                except (TypeError, ValueError):
+                    abort(make_response(jsonify({"error": f"Invalid {name}..."}), 400))
+        args[name] = values[0] if values else None
+    return args
+
+
+def visit_rows(model=VisitModel):
+    """Returns query selecting VISIT_COLUMNS of visits
+
+    :param model: VisitModel for the live visits or VisitArchive for the archived ones
+    :type model: class
+    :returns: query joining visits with their doctors and patients
+    :rtype: flask_sqlalchemy.BaseQuery object
+    """
+    return db.session.query(*VISIT_COLUMNS[:3], model.visit_date, model.visit_id).select_from(model)\
+        .outerjoin(Doctor, model.doctor_id == Doctor.doctor_id)\
+        .outerjoin(Patient, model.patient_key == Patient.patient_key)
+
+
+def with_archive(build):
+    """Returns query of the live visits, joined with the same query of the archived visits
+    when the request sets include_archived
+
+    :param build: function returning the query for a model given as its argument
+    :type build: function
+    :returns: query selecting VISIT_COLUMNS
+    :rtype: flask_sqlalchemy.BaseQuery object
+    """
+    query = build(VisitModel)
+    if include_archived():
+        query = query.union_all(build(VisitArchive))
+    return query
+
+
+def include_archived():
+    """Returns True if the request sets include_archived"""
+    return request.values.get("include_archived", "").lower() in ("1", "true", "yes")
+
+
+def filter_key(query, column, key):
+    """Filters query by a key that may not exist
+
+    :param query: query to filter
+    :type query: flask_sqlalchemy.BaseQuery object
+    :param column: column of the key
+    :type column: sqlalchemy.Column object
+    :param key: value of the key or None if there is no such doctor or patient
+    :type key: int
+    :returns: filtered query
+    :rtype: flask_sqlalchemy.BaseQuery object
+    """
+    if key is None:
+        return query.filter(false())
+    return query.filter(column == key)
+
+
+def filter_visits(req, model=VisitModel):
+    """Returns query selecting visits matching the filters of GET /visit/query
+
+    :param req: parsed QUERY_ARGS, None for filters that aren't used
+    :type req: dict
+    :param model: VisitModel for the live visits or VisitArchive for the archived ones
+    :type model: class
+    :returns: query selecting VISIT_COLUMNS
+    :rtype: flask_sqlalchemy.BaseQuery object
+    """
+    query = visit_rows(model)
+    if req["doctor_name"] is not None:
+        query = filter_key(query, model.doctor_id, find_doctor(req["doctor_name"]))
+    if req["patient_id"] is not None:
+        query = filter_key(query, model.patient_key, find_patient(req["patient_id"]))
+    if req["from"] is not None:
+        query = query.filter(model.visit_date >= req["from"])
+    if req["to"] is not None:
+        query = query.filter(model.visit_date <= req["to"])
+    return query
+
+
+def date_range_only(req):
+    """Tells if GET /visit/query is narrowed only by a date range
+
+    :param req: parsed QUERY_ARGS
+    :type req: dict
+    :returns: True if from or to is given without doctor_name and patient_id
+    :rtype: bool
+    """
+    return (req["from"] is not None or req["to"] is not None) and \
+        req["doctor_name"] is None and req["patient_id"] is None
+
+
+def find_doctor(doctor_name):
+    """Returns doctor_id of a doctor without adding it
+
+    :param doctor_name: name of a doctor
+    :type doctor_name: str
+    :returns: doctor_id or None if there is no such doctor
+    :rtype: int
+    """
+    added = db.session.info.get("added_doctors", {})
+    if doctor_name in added:
+        return added[doctor_name]
+    if doctor_name is not None and doctor_name not in doctor_ids:
+        doctor_id = db.session.query(Doctor.doctor_id).filter_by(doctor_name=doctor_name).scalar()
+        if doctor_id is not None:
+            doctor_ids[doctor_name] = doctor_id
+    return doctor_ids.get(doctor_name)
+
+
+def shard_doctors():
+    """Returns doctors of the current shard
+
+    Doctors left in a shard the doctor doesn't belong to, by a database used before the shards were added,
+    are left out, they are moved by reshard-visits
+
+    :returns: pairs of doctor_id and doctor_name ordered by doctor_id
+    :rtype: list
+    """
+    doctors = db.session.query(Doctor.doctor_id, Doctor.doctor_name).order_by(Doctor.doctor_id)
+    return [tuple(doctor) for doctor in doctors if shard_of(doctor.doctor_name) == current_shard()]
+
+
+def find_patient(patient_id):
+    """Returns patient_key of a patient without adding it
+
+    :param patient_id: id of a patient
+    :type patient_id: str
+    :returns: patient_key or None if there is no such patient
+    :rtype: int
+    """
+    return db.session.query(Patient.patient_key).filter_by(patient_id=patient_id).scalar()
+
+
+def visits_json(rows):
+    """Encodes visits as json list
+
+    Gives the same output as jsonify(my_app_schema.dump(entries)) without building VisitModel objects
+
+    :param rows: tuples of VISIT_COLUMNS
+    :type rows: list
+    :returns: list of visits in json format
+    :rtype: str
+    """
+    return json_encoder.encode([dict(zip(VISIT_FIELDS, row)) for row in rows]) + '\n'
+
+
+def stream_visits(rows):
+    """Generator of visits in NDJSON format
+
+    Rows are taken from shard_rows, which fetches them from the cursors in chunks of STREAM_CHUNK,
+    so memory used by the request does not depend on the number of visits
+
+    :param rows: ordered rows of VISIT_COLUMNS
+    :type rows: iterable
+    :returns: generator of lines, one visit in json format per line
+    :rtype: generator
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(json_encoder.encode(dict(zip(VISIT_FIELDS, row))))
+        if len(chunk) == STREAM_CHUNK:
+            yield '\n'.join(chunk) + '\n'
+            chunk = []
+    if chunk:
+        yield '\n'.join(chunk) + '\n'
+
+
+def page_query(query, page, order, sort_ids=False):
+    """Orders the query and limits it to one page
+
+    Visits ordered by date are paged by the pair (visit_date, visit_id), so visits at the same date
+    are neither skipped nor repeated
+
+    :param query: query selecting the visits
+    :type query: flask_sqlalchemy.BaseQuery object
+    :param page: parsed PAGE_ARGS
+    :type page: dict
+    :param order: one of ORDERS
+    :type order: str
+    :param sort_ids: True if the query is narrowed only by a date range, then visits are found by the index
+    on visit_date and sorted, instead of reading the whole table in visit_id order
+    :type sort_ids: bool
+    :returns: ordered and limited query
+    :rtype: flask_sqlalchemy.BaseQuery object
+    """
+    if page["limit"] is not None and page["limit"] < 1:
+        abort(make_response(jsonify({"error": "Invalid limit..."}), 400))
+    if order == "id":
+        query = query.order_by(VisitModel.visit_id + 0 if sort_ids else VisitModel.visit_id)
+        if page["after"] is not None:
+            query = query.filter(VisitModel.visit_id > page["after"])
+    else:
+        descending = order == "-date"
+        if descending:
+            query = query.order_by(VisitModel.visit_date.desc(), VisitModel.visit_id.desc())
+        else:
+            query = query.order_by(VisitModel.visit_date, VisitModel.visit_id)
+        if page["after"] is not None:
+            if page["after_date"] is None:
+                abort(make_response(jsonify({"error": "after_date is required when ordering by date..."}), 400))
+            key = tuple_(VisitModel.visit_date, VisitModel.visit_id)
+            last = tuple_(page["after_date"], page["after"])
+            query = query.filter(key < last if descending else key > last)
+    if page["limit"] is not None:
+        query = query.limit(page["limit"])
+    return query
+
+
+# Sort keys of rows of VISIT_COLUMNS by ORDERS, the same as the order of page_query, visits without date first
+ROW_KEYS = {"id": lambda row: row.visit_id,
+            "date": lambda row: (row.visit_date is not None, row.visit_date or 0, row.visit_id)}
+
+
+def merge_rows(results, order, limit):
+    """Merges pages of visits of several shards into one page
+
+    :param results: ordered rows of VISIT_COLUMNS of every shard
+    :type results: list
+    :param order: one of ORDERS
+    :type order: str
+    :param limit: size of the page, None for all visits
+    :type limit: int
+    :returns: ordered rows of the page
+    :rtype: iterator
+    """
+    if len(results) == 1:
+        return iter(results[0])
+    rows = heapq.merge(*results, key=ROW_KEYS[order.lstrip("-")], reverse=order == "-date")
+    return rows if limit is None else itertools.islice(rows, limit)
+
+
+def shard_rows(query, order, limit, shards=None):
+    """Returns ordered visits of several shards fetched from their cursors while they are consumed
+
+    The queries are executed right away, in the current thread one after another, so the rows
+    may be consumed after the request left the shards
+
+    :param query: function returning the ordered query selecting the visits, called in every shard
+    :type query: function
+    :param order: one of ORDERS
+    :type order: str
+    :param limit: size of the page, None for all visits
+    :type limit: int
+    :param shards: indexes of the shards, None for all of them
+    :type shards: list
+    :returns: ordered rows of VISIT_COLUMNS
+    :rtype: iterator
+    """
+    cursors = []
+    for shard in range(shard_count()) if shards is None else shards:
+        with use_shard(shard):
+            cursors.append(iter(query().yield_per(STREAM_CHUNK)))
+    return merge_rows(cursors, order, limit)
+
+
+def list_visits(build, error_message, order="id", sort_ids=False, shards=None):
+    """Returns a page of visits selected by the query
+
+    Without limit all matching visits are returned, with limit the X-Next-After header holds the
+    value of after for the next page when there may be more visits, and X-Next-After-Date the value
+    of after_date when visits are ordered by date. The query runs in every given shard at the same time,
+    each returns one page and the pages are merged
+
+    :param build: function returning the query selecting the visits, called in every shard
+    :type build: function
+    :param error_message: error returned when the first page is empty, None if an empty list is fine
+    :type error_message: str
+    :param order: one of ORDERS
+    :type order: str
+    :param sort_ids: passed to page_query
+    :type sort_ids: bool
+    :param shards: indexes of the shards keeping the visits, None for all of them
+    :type shards: list
+    :returns: list of visits in json or NDJSON format or flask.Response object containing
+    the error message in json format with error code
+    :rtype: flask.Response object
+    """
+    page = parse_args(PAGE_ARGS)
+
+    def query():
+        return page_query(build(), page, order, sort_ids)
+
+    if page["format"] == "ndjson":
+        rows = shard_rows(query, order, page["limit"], shards)
+        return Response(stream_with_context(stream_visits(rows)), mimetype='application/x-ndjson')
+
+    rows = list(merge_rows(fan_out(lambda: query().all(), shards), order, page["limit"]))
+    if not rows and error_message and page["after"] is None:
+        return make_response(jsonify({"error": error_message}), 405)
+    response = Response(visits_json(rows), mimetype='application/json')
+    if rows and len(rows) == page["limit"]:
+        response.headers['X-Next-After'] = str(rows[-1].visit_id)
+        if order != "id":
+            response.headers['X-Next-After-Date'] = str(rows[-1].visit_date)
+    return response
+
+
+def visit_tags(visit_id, visit_date, patient_id, doctor_name):
+    """Returns cache tags of all responses that may contain a given visit
+
+    A date response covers its day and the hour 00 of the next day, so visits at 00 belong to two days
+
+    :param visit_id: id of a visit
+    :type visit_id: int
+    :param visit_date: date of a visit
+    :type visit_date: int
+    :param patient_id: id of a patient
+    :type patient_id: str
+    :param doctor_name: name of a doctor
+    :type doctor_name: str
+    :returns: list of tags
+    :rtype: list
+    """
+    tags = [("all",), ("id", visit_id), ("patient", patient_id), ("doctor", doctor_name)]
+    if visit_date is not None:
+        tags.append(("day", visit_date // 100))
+        if visit_date % 100 == 0:
+            tags.append(("day", visit_date // 100 - 1))
+    return tags
+
+
+def selector_tags(parameter, req):
+    """Returns cache tags of a response of GET /visit/<parameter>
+
+    :param parameter: selector of the visits
+    :type parameter: str
+    :param req: parsed arguments of the request
+    :type req: dict
+    :returns: list of tags
+    :rtype: list
+    """
+    if parameter == "doctor" or parameter == "selected":
+        return [("doctor", req["doctor_name"])]
+    if parameter == "patient":
+        return [("patient", req["patient_id"])]
+    if parameter == "date":
+        return [("day", req["visit_date"] // 100)]
+    if parameter == "id":
+        return [("id", req["visit_id"])]
+    if parameter == "query":
+        if req["doctor_name"] is not None:
+            return [("doctor", req["doctor_name"])]
+        if req["patient_id"] is not None:
+            return [("patient", req["patient_id"])]
+    return [("all",)]
+
+
+@visits.route('/visit/<parameter>', methods=["GET"])
+def get_visit(parameter):
+    """GET type method
+
+    Function that returns choosen range of visits from visit_cache or, when it is not there, from database
+
+    :param parameter: Specifies the choice of option according to which we want to select elements from the database
+    :type parameter: str
+    :returns: result, which may be one or list of VisitModel objects when the action is succesful or
+    flask.Response object containing the error message in json format with error code
+    :rtype: list/flask.Request object
+    """
+    if parameter not in VISIT_SELECTORS:
+        return select_visits(parameter)
+    # Arguments may also come in the body, so the key is made of the parsed ones rather than the query string
+    req = parse_args(QUERY_ARGS if parameter == "query" else VISIT_ARGS)
+    page = parse_args(PAGE_ARGS)
+    if page["format"] == "ndjson":
+        return select_visits(parameter)
+
+    shards = selector_shards(parameter, req)
+    for shard in shards:
+        with use_shard(shard):
+            sync_local_state(False)
+    etag = listing_etag(parameter, req, shards)
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        response.vary.add('Accept-Encoding')
+        return response
+
+    key = (parameter, tuple(req.items()), tuple(page.items()), include_archived())
+    cached = visit_cache.get(key)
+    if cached is None:
+        generation = visit_cache.generation
+        response = select_visits(parameter)
+        if response.status_code not in (200, 405):
+            return response
+        headers = [(name, value) for name, value in response.headers
+                   if name in ('X-Next-After', 'X-Next-After-Date', 'ETag')]
+        cached = (response.get_data(), response.status_code, headers, {})
+        visit_cache.put(key, cached, selector_tags(parameter, req), generation)
+    return listing_response(cached, etag)
+
+
+def selector_shards(parameter, req):
+    """Returns the shards keeping the visits of a selector of GET /visit/<parameter>
+
+    :param parameter: selector of the visits
+    :type parameter: str
+    :param req: parsed arguments of the request
+    :type req: dict
+    :returns: indexes of the shards
+    :rtype: list
+    """
+    if parameter in ("doctor", "selected") or parameter == "query" and req["doctor_name"] is not None:
+        return [shard_of(req["doctor_name"])]
+    if parameter == "id":
+        shard = id_shard(req["visit_id"])
+        if shard is not None and not include_archived():
+            return [shard]
+    return list(range(shard_count()))
+
+
+def listing_etag(parameter, req, shards):
+    """Returns ETag of a response of GET /visit/<parameter> without selecting the visits
+
+    Listings of a doctor or a patient change only with the change counter of the doctor or the patient,
+    which is given with the doctor_id or patient_key, so listings of two doctors or patients never share
+    a validator, other listings with the change counter of all visits read by sync_local_state. Values of
+    several shards are joined with dots
+
+    :param parameter: selector of the visits
+    :type parameter: str
+    :param req: parsed arguments of the request
+    :type req: dict
+    :param shards: indexes of the shards keeping the visits, given by selector_shards
+    :type shards: list
+    :returns: value of a weak ETag or None if the response has no such ETag
+    :rtype: str
+    """
+    def counters(query):
+        values = []
+        for shard in shards:
+            with use_shard(shard):
+                values.append(query.first())
+        if all(value is None for value in values):
+            return None
+        return ".".join("-" if value is None else f"{value[0]}:{value[1]}" for value in values)
+
+    if parameter in ("doctor", "selected") or parameter == "query" and req["doctor_name"] is not None:
+        changes = counters(db.session.query(Doctor.doctor_id, Doctor.changes).filter_by(doctor_name=req["doctor_name"]))
+        return None if changes is None else f"d{changes}"
+    if parameter == "patient" or parameter == "query" and req["patient_id"] is not None:
+        changes = counters(db.session.query(Patient.patient_key, Patient.changes)
+                           .filter_by(patient_id=req["patient_id"]))
+        return None if changes is None else f"p{changes}"
+    if parameter in ("all", "date", "query"):
+        return "v" + ".".join(str(shard_states[shard]["version"]) for shard in shards)
+    return None
+
+
+def listing_response(cached, etag):
+    """Builds response of GET /visit/<parameter> from an entry of visit_cache
+
+    The body is compressed with brotli or gzip when the client accepts it, compressed bodies are kept
+    in the entry so every one is compressed only once
+
+    :param cached: body, status, headers and dictionary of compressed bodies by encoding
+    :type cached: tuple
+    :param etag: value returned by listing_etag
+    :type etag: str
+    :returns: the response, 304 if the client has it already
+    :rtype: flask.Response object
+    """
+    body, status, headers, encoded = cached
+    encoding = None
+    if len(body) >= current_app.config['COMPRESS_MIN_SIZE']:
+        encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+    if encoding is not None and encoding not in encoded:
+        level = current_app.config['COMPRESS_LEVEL']
+        encoded[encoding] = brotli.compress(body, quality=level) if encoding == 'br' else \
+            gzip.compress(body, compresslevel=level, mtime=0)
+
+    response = Response(encoded[encoding] if encoding else body, status, headers, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    if etag is not None and status == 200:
+        response.set_etag(etag, weak=True)
+    tag, _ = response.get_etag()
+    if tag is not None and status == 200 and request.if_none_match.contains_weak(tag):
+        not_modified = Response(status=304, headers=[('ETag', response.headers['ETag'])])
+        not_modified.vary.add('Accept-Encoding')
+        return not_modified
+    return response
+
+
+def select_visits(parameter):
+    """Selects visits from database
+
+    Function that returns choosen range of visits from database, together with the archived visits
+    when include_archived is set. Visits of a doctor and of an id are read from the shard keeping them,
+    other selectors read all shards
+
+    :param parameter: Specifies the choice of option according to which we want to select elements from the database
+    :type parameter: str
+    :returns: result, which may be one or list of VisitModel objects when the action is succesful or
+    flask.Response object containing the error message in json format with error code
+    :rtype: flask.Response object
+    """
+    if parameter == "doctor":
+        req = parse_args(VISIT_ARGS)
+        return list_visits(lambda: with_archive(lambda model: filter_key(visit_rows(model), model.doctor_id,
+                                                                         find_doctor(req["doctor_name"]))),
+                           "This doctor has no appointments...", shards=[shard_of(req["doctor_name"])])
+
+    if parameter == "patient":
+        req = parse_args(VISIT_ARGS)
+
+        def patient_visits():
+            patient_key = find_patient(req["patient_id"])
+            return with_archive(lambda model: filter_key(visit_rows(model), model.patient_key, patient_key))
+        return list_visits(patient_visits, "This patient has no appointments...")
+
+    if parameter == "selected":
+        req = parse_args(VISIT_ARGS)
+        with use_shard(shard_of(req["doctor_name"])):
+            doctor_id = find_doctor(req["doctor_name"])
+            rows = with_archive(lambda model: filter_key(visit_rows(model), model.doctor_id, doctor_id).filter(
+                model.visit_date == req["visit_date"], Patient.patient_id == req["patient_id"],
+                Patient.patient_name == req["patient_name"])).all()
+        if not rows:
+            return make_response(jsonify({"error": "Such visit doesn't exist..."}), 405)
+        return Response(visits_json(rows), mimetype='application/json')
+
+    if parameter == "date":
+        req = parse_args(VISIT_ARGS)
+
+        if req['visit_date'] < 100000000 or req['visit_date'] > 199999999:
+            return make_response(jsonify({"error": "Invalid date format..."}), 409)
+
+        date_day = req['visit_date'] - (req['visit_date'] % 100)
+        return list_visits(lambda: with_archive(lambda model: visit_rows(model).filter(
+            model.visit_date >= date_day, model.visit_date <= (date_day + 100))), "Such visit doesn't exist...")
+
+    if parameter == "id":
+        req = parse_args(VISIT_ARGS)
+        shard = id_shard(req["visit_id"])
+        rows = []
+        if shard is not None:
+            with use_shard(shard):
+                rows = visit_rows().add_columns(VisitModel.version).filter(VisitModel.visit_id == req["visit_id"]).all()
+        if include_archived():
+            # Archived visits leave the directory of visits, any shard may keep them
+            rows += itertools.chain.from_iterable(fan_out(
+                lambda: visit_rows(VisitArchive).add_columns(VisitArchive.version)
+                .filter(VisitArchive.visit_id == req["visit_id"]).all()))
+        if not rows:
+            return make_response(jsonify({"error": f"There is no appointment with ID:{req['visit_id']}..."}), 405)
+        response = Response(visits_json(row[:-1] for row in rows), mimetype='application/json')
+        response.set_etag(str(rows[0][-1]))
+        return response
+
+    if parameter == "all":
+        return list_visits(lambda: with_archive(visit_rows), None)
+
+    if parameter == "query":
+        req = parse_args(QUERY_ARGS)
+        for bound in ("from", "to"):
+            if req[bound] is not None and not 100000000 <= req[bound] <= 199999999:
+                return make_response(jsonify({"error": "Invalid date format..."}), 409)
+        order = req["order"] or "id"
+        if order not in ORDERS:
+            return make_response(jsonify({"error": f"Invalid order, expected one of {', '.join(ORDERS)}..."}), 400)
+        shards = None if req["doctor_name"] is None else [shard_of(req["doctor_name"])]
+        return list_visits(lambda: with_archive(lambda model: filter_visits(req, model)), None, order,
+                           date_range_only(req), shards)
+
+    return make_response(jsonify({"error": "Invalid specifier..."}), 409)
+
+
+# Arguments of GET /visit/search: searched words, whose names are searched, whether accents are ignored,
+# whether typos are tolerated and the page of visits
+SEARCH_ARGS = (("q", str), ("field", str), ("ignore_accents", str), ("fuzzy", str), ("limit", int),
+               ("offset", int))
+# Names searched by GET /visit/search, in the order of SEARCHED_TABLES
+SEARCH_FIELDS = ("patient", "doctor")
+# Default and largest number of visits returned by GET /visit/search at once
+SEARCH_LIMIT = 50
+SEARCH_MAX_LIMIT = 1000
+# Most words of the names a term of a fuzzy search is replaced with
+FUZZY_WORDS = 20
+
+
+def allowed_typos(term):
+    """Returns how many typos a fuzzy search tolerates in a term, none in short terms
+
+    :param term: searched term
+    :type term: str
+    :returns: number of typos
+    :rtype: int
+    """
+    return 0 if len(term) < 3 else 1 if len(term) < 6 else 2
+
+
+def typos(term, word, limit):
+    """Counts typos turning a term into the beginning of a word
+
+    Typos are inserted, deleted and replaced letters and swapped neighbouring letters (the optimal string
+    alignment distance), the counting stops once every beginning of the word takes more than limit
+
+    :param term: searched term
+    :type term: str
+    :param word: word of a name
+    :type word: str
+    :param limit: most typos of interest
+    :type limit: int
+    :returns: number of typos, limit + 1 if there are more
+    :rtype: int
+    """
+    before, previous = None, list(range(len(word) + 1))
+    for i in range(1, len(term) + 1):
+        current = [i] + [0] * len(word)
+        for j in range(1, len(word) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (term[i - 1] != word[j - 1]))
+            if i > 1 and j > 1 and term[i - 1] == word[j - 2] and term[i - 2] == word[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return min(min(previous[max(len(term) - limit, 0):len(term) + limit + 1]), limit + 1)
+
+
+def similar_words(term, words):
+    """Returns words of the names that a term may have meant, the closest ones first
+
+    :param term: searched term
+    :type term: str
+    :param words: pairs of a word and the number of names having it
+    :type words: iterable
+    :returns: at most FUZZY_WORDS words starting with the term with at most allowed_typos typos
+    :rtype: list
+    """
+    limit = allowed_typos(term)
+    letters = set(term)
+    found = []
+    for word, count in words:
+        # Every typo loses at most one of the letters of the term, a quick test before counting them
+        if len(word) >= len(term) - limit and len(letters.difference(word[:len(term) + limit])) <= limit:
+            count_typos = typos(term, word, limit)
+            if count_typos <= limit:
+                found.append((count_typos, -count, word))
+    return [word for _, _, word in heapq.nsmallest(FUZZY_WORDS, found)]
+
+
+def name_words(model, column, folded):
+    """Returns the words of the names of a table with the number of names having them
+
+    :param model: Patient or Doctor
+    :type model: class
+    :param column: name of the name column
+    :type column: str
+    :param folded: True for the words of search_name, otherwise of the name
+    :type folded: bool
+    :returns: pairs of a word and the number of names having it
+    :rtype: list
+    """
+    table = model.__tablename__
+    searched = "search_name" if folded else column
+    if search_index["fts5"]:
+        return db.session.execute(db.text(f"SELECT term, doc FROM {table}_search_vocab WHERE col = :col"),
+                                  {"col": searched}).fetchall()
+    counts = {}
+    for name, in db.session.query(getattr(model, searched)).filter(getattr(model, searched).isnot(None)):
+        for word in set(re.findall(r"[^\W_]+", name if folded else name.casefold())):
+            counts[word] = counts.get(word, 0) + 1
+    return list(counts.items())
+
+
+def matching_names(model, key, column, terms, folded, fuzzy=False):
+    """Returns query of the names of a table containing words starting with every term
+
+    :param model: Patient or Doctor
+    :type model: class
+    :param key: name of the key column
+    :type key: str
+    :param column: name of the name column
+    :type column: str
+    :param terms: searched terms
+    :type terms: list
+    :param folded: True if the terms are matched with search_name, otherwise with the name
+    :type folded: bool
+    :param fuzzy: True if a word may also start with a term with typos, see similar_words
+    :type fuzzy: bool
+    :returns: selectable of key and rank of the matching rows, better matches have lower rank
+    :rtype: sqlalchemy.sql.expression.Alias object
+    """
+    table = model.__tablename__
+    searched = "search_name" if folded else column
+    alternatives = [[term] for term in terms]
+    if fuzzy:
+        words = name_words(model, column, folded)
+        alternatives = [[term] + [word for word in similar_words(term, words) if word != term] for term in terms]
+    if search_index["fts5"]:
+        match = f"{{{searched}}}: (" + " AND ".join(
+            "(" + " OR ".join(f'"{word}"*' for word in words) + ")" for words in alternatives) + ")"
+        return db.text(f"SELECT rowid AS key, rank FROM {table}_search WHERE {table}_search MATCH :{table}")\
+            .bindparams(**{table: match}).columns(key=db.Integer, rank=db.Float).alias(f"{table}_match")
+    name = getattr(model, searched) if folded else db.func.lower(getattr(model, searched))
+    return select([getattr(model, key).label("key"), db.literal(0.0).label("rank")])\
+        .where(db.and_(*[or_(*[(" " + name).like(f"% {word}%") for word in words]) for words in alternatives]))\
+        .alias(f"{table}_match")
+
+
+def search_keys(model, field, terms, folded, fuzzy=False):
+    """Returns statement of the sort keys of the visits of patients or doctors whose names match the terms
+
+    Only columns of the indexes on patient_key or doctor_id and visit_date are selected, so a page is chosen
+    without reading the visit rows
+
+    :param model: VisitModel for the live visits or VisitArchive for the archived ones
+    :type model: class
+    :param field: one of SEARCH_FIELDS
+    :type field: str
+    :param terms: searched terms
+    :type terms: list
+    :param folded: True if accents are ignored
+    :type folded: bool
+    :param fuzzy: True if typos are tolerated
+    :type fuzzy: bool
+    :returns: statement selecting rank and key of the matched name, visit_date as sort_date, row_id and archived
+    :rtype: sqlalchemy.sql.expression.Select object
+    """
+    searched, key, column = SEARCHED_TABLES[SEARCH_FIELDS.index(field)]
+    names = matching_names(searched, key, column, terms, folded, fuzzy)
+    row_id = VisitArchive.archive_id if model is VisitArchive else VisitModel.visit_id
+    return select([names.c.rank, names.c.key.label("name_key"), model.visit_date.label("sort_date"),
+                   row_id.label("row_id"), db.literal(int(model is VisitArchive)).label("archived")])\
+        .select_from(model.__table__.join(names, getattr(model, key) == names.c.key))
+
+
+def search_order(row, shard):
+    """Returns sort key of a visit found by GET /visit/search in a shard, ordering visits of all shards
+
+    :param row: row of the search ending with rank, name_key, sort_date, row_id and archived
+    :type row: sqlalchemy.engine.RowProxy object
+    :param shard: index of the shard
+    :type shard: int
+    :returns: the key
+    :rtype: tuple
+    """
+    rank, name_key, sort_date, row_id, archived = tuple(row)[-5:]
+    return rank, shard, name_key, sort_date is not None, sort_date or 0, archived, row_id
+
+
+@visits.route('/visit/search', methods=["GET"])
+def get_search():
+    """GET type method
+
+    Function that returns visits of patients or, with field=doctor, of doctors found by their names. Every word
+    of q has to start a word of the name, names are found by full-text indexes on SQLite. Visits of the best
+    matching names come first, visits of one name by date. With ignore_accents "Stanislaw" finds also "Stanisław",
+    with fuzzy a word may also start with a word of q with typos, "Kowlaski" finds also "Kowalski"
+
+    :returns: result, page of visits in json format with the X-Next-Offset header holding offset of the next page
+    when there may be more visits or flask.Response object containing the error message in json format with error code
+    :rtype: flask.Request object
+    """
+    req = parse_args(SEARCH_ARGS)
+    field = req["field"] or SEARCH_FIELDS[0]
+    if field not in SEARCH_FIELDS:
+        return make_response(jsonify({"error": "Invalid field..."}), 400)
+    folded = (req["ignore_accents"] or "").lower() in ("1", "true", "yes")
+    fuzzy = (req["fuzzy"] or "").lower() in ("1", "true", "yes")
+    terms = re.findall(r"[^\W_]+", (fold_name if folded else str.casefold)(req["q"] or ""))
+    if not terms:
+        return make_response(jsonify({"error": "Nothing to search for..."}), 400)
+    limit = SEARCH_LIMIT if req["limit"] is None else req["limit"]
+    offset = req["offset"] or 0
+    if not 0 < limit <= SEARCH_MAX_LIMIT or offset < 0:
+        return make_response(jsonify({"error": "Invalid page..."}), 400)
+
+    models = (VisitModel, VisitArchive) if include_archived() else (VisitModel,)
+    order = [db.literal_column(name) for name in ("rank", "name_key", "sort_date", "archived", "row_id")]
+
+    def search(limit, offset):
+        page = db.union_all(*[search_keys(model, field, terms, folded, fuzzy) for model in models])\
+            .order_by(*order).limit(limit).offset(offset).alias("page")
+        query = db.union_all(*[visit_rows(model).join(page, db.and_(
+            page.c.archived == int(model is VisitArchive),
+            page.c.row_id == (VisitArchive.archive_id if model is VisitArchive else VisitModel.visit_id)))
+            .add_columns(*page.c).statement for model in models])
+        return db.session.execute(query.order_by(*order)).fetchall()
+
+    if shard_engines:
+        # Every shard returns its first offset + limit visits, which are ordered together by the same keys
+        rows = sorted(((search_order(row, shard), row) for shard, found in
+                       enumerate(fan_out(lambda: search(offset + limit, 0))) for row in found),
+                      key=lambda item: item[0])
+        rows = [row for _, row in rows[offset:offset + limit]]
+    else:
+        rows = search(limit, offset)
+    response = Response(visits_json(rows), mimetype='application/json')
+    if len(rows) == limit:
+        response.headers['X-Next-Offset'] = str(offset + limit)
+    return response
+
+
+def change_cursor(value):
+    """Reads position in the change logs given in after or Last-Event-ID
+
+    Every shard has its own change log, the position is made of the sequence numbers of the last changes
+    seen in the logs of all shards joined with dots, a plain sequence number when there are no shards.
+    0 stands for the start of the logs of all shards
+
+    :param value: the position
+    :type value: str
+    :returns: sequence number of the last change seen in every shard
+    :rtype: tuple
+    """
+    cursor = tuple(int(seq) for seq in str(value).split("."))
+    if cursor == (0,):
+        return (0,) * shard_count()
+    if len(cursor) != shard_count():
+        raise ValueError(f"Expected {shard_count()} sequence numbers")
+    return cursor
+
+
+def cursor_text(cursor):
+    """Returns position in the change logs in the format read by change_cursor
+
+    :param cursor: sequence number of the last change seen in every shard
+    :type cursor: tuple
+    :returns: the position
+    :rtype: str
+    """
+    return ".".join(str(seq) for seq in cursor)
+
+
+def cursor_json(cursor):
+    """Returns position in the change logs in json format, a number when there are no shards
+
+    :param cursor: sequence number of the last change seen in every shard
+    :type cursor: tuple
+    :returns: the position in json format
+    :rtype: str
+    """
+    return cursor_text(cursor) if len(cursor) == 1 else f'"{cursor_text(cursor)}"'
+
+
+# Arguments of GET /visit/changes: position in the change logs of the last change seen, doctor whose visits
+# are followed, maximal number of changes returned and time in seconds a long poll waits for them
+CHANGE_ARGS = (("after", change_cursor), ("doctor_name", str), ("limit", int), ("wait", float))
+# Maximal number of changes returned at once
+CHANGE_LIMIT = 1000
+# Time in seconds after which an idle event stream sends a comment, so proxies don't close it
+CHANGE_HEARTBEAT = 15
+
+
+def change_head():
+    """Returns sequence number of the newest change in the current shard, 0 if there are none"""
+    return db.session.query(db.func.max(VisitChange.seq)).scalar() or 0
+
+
+def change_heads():
+    """Returns position in the change logs of the newest changes of all shards
+
+    :returns: sequence number of the newest change in every shard
+    :rtype: tuple
+    """
+    return tuple(fan_out(change_head))
+
+
+def read_log(after, doctor_name, limit):
+    """Reads changes of visits of the current shard following a sequence number
+
+    The transaction is ended afterwards, so a waiting request neither holds a connection
+    nor reads an old snapshot of the database
+
+    :param after: sequence number of the last change seen
+    :type after: int
+    :param doctor_name: name of the doctor whose visits are followed, None for all visits
+    :type doctor_name: str
+    :param limit: maximal number of changes
+    :type limit: int
+    :returns: list of changes as triples of sequence number, kind and json, and sequence number to continue
+    after, which passes changes of other doctors too
+    :rtype: tuple
+    """
+    head = change_head()
+    rows = []
+    if head > after:
+        query = db.session.query(VisitChange.seq, VisitChange.kind, VisitChange.data)\
+            .filter(VisitChange.seq > after, VisitChange.seq <= head)
+        if doctor_name is not None:
+            doctor_id = find_doctor(doctor_name)
+            kinds = [VisitChange.kind == "cleared"]
+            if doctor_id is not None:
+                kinds += [VisitChange.doctor_id == doctor_id, VisitChange.old_doctor_id == doctor_id]
+            query = query.filter(or_(*kinds))
+        rows = query.order_by(VisitChange.seq).limit(limit).all()
+    db.session.close()
+    return [tuple(row) for row in rows], rows[-1].seq if len(rows) == limit else max(head, after)
+
+
+def read_changes(after, doctor_name, limit):
+    """Reads changes of visits following a position in the change logs
+
+    Logs of all shards are read at the same time, changes of a doctor only from the shard keeping its visits.
+    Changes of one shard come in the order they were made, changes of different shards one shard after another
+
+    :param after: position in the change logs of the last change seen, see change_cursor
+    :type after: tuple
+    :param doctor_name: name of the doctor whose visits are followed, None for all visits
+    :type doctor_name: str
+    :param limit: maximal number of changes
+    :type limit: int
+    :returns: list of changes as triples of position after the change, kind and json, and position to continue
+    after, which passes changes of other doctors too
+    :rtype: tuple
+    """
+    shards = list(range(shard_count())) if doctor_name is None else [shard_of(doctor_name)]
+    logs = fan_out(lambda: read_log(after[current_shard()], doctor_name, limit), shards)
+    cursor = list(after)
+    changes = []
+    for shard, (rows, last) in zip(shards, logs):
+        taken = rows[:limit - len(changes)]
+        for seq, kind, data in taken:
+            cursor[shard] = seq
+            # Data of the change is spliced into the event instead of being decoded and encoded again
+            changes.append((cursor_text(cursor), kind, f'{{"seq":{cursor_json(cursor)},"type":"{kind}",{data[1:]}'))
+        if len(taken) == len(rows):
+            cursor[shard] = last
+    return changes, tuple(cursor)
+
+
+def wait_for_changes(timeout):
+    """Waits until this process writes visits or the timeout passes
+
+    :param timeout: time in seconds
+    :type timeout: float
+    """
+    with change_signal:
+        change_signal.wait(timeout)
+
+
+def stream_changes(after, doctor_name, limit, seconds, poll):
+    """Generator of changes of visits in the server-sent events format
+
+    Every change is an event with the position in the change logs after it as id, so a reconnecting client
+    continues with the Last-Event-ID header. The stream ends after the given time
+
+    :param after: position in the change logs of the last change seen, see change_cursor
+    :type after: tuple
+    :param doctor_name: name of the doctor whose visits are followed, None for all visits
+    :type doctor_name: str
+    :param limit: maximal number of changes read at once
+    :type limit: int
+    :param seconds: duration of the stream
+    :type seconds: float
+    :param poll: time in seconds between looking for changes of other processes
+    :type poll: float
+    :returns: generator of events
+    :rtype: generator
+    """
+    deadline = time.monotonic() + seconds
+    heartbeat = time.monotonic() + CHANGE_HEARTBEAT
+    yield ": changes\n\n"
+    while time.monotonic() < deadline:
+        changes, after = read_changes(after, doctor_name, limit)
+        if changes:
+            yield "".join(f"id: {seq}\nevent: {kind}\ndata: {data}\n\n" for seq, kind, data in changes)
+            heartbeat = time.monotonic() + CHANGE_HEARTBEAT
+            continue
+        if time.monotonic() >= heartbeat:
+            # An id without data moves Last-Event-ID past changes of other doctors
+            yield f": keep-alive\nid: {cursor_text(after)}\n\n"
+            heartbeat = time.monotonic() + CHANGE_HEARTBEAT
+        wait_for_changes(min(poll, max(deadline - time.monotonic(), 0)))
+
+
+@visits.route('/visit/changes', methods=["GET"])
+def get_changes():
+    """GET type method
+
+    Function that returns changes of visits following the position given in after or Last-Event-ID,
+    only the new ones if neither is given. Clients accepting text/event-stream get the changes as server-sent
+    events, others get them in json format, after waiting up to wait seconds if there are none yet
+
+    :returns: result being events or json with list of changes and the position of the last change
+    seen, to be given in after of the next request
+    :rtype: flask.Request object
+    """
+    req = parse_args(CHANGE_ARGS)
+    after = req["after"]
+    if after is None and request.headers.get('Last-Event-ID'):
+        try:
+            after = change_cursor(request.headers['Last-Event-ID'])
+        except ValueError:
+            pass
+    if after is None:
+        after = change_heads()
+    if req["limit"] is not None and req["limit"] < 1:
+        return make_response(jsonify({"error": "Invalid limit..."}), 400)
+    limit = min(req["limit"] or CHANGE_LIMIT, CHANGE_LIMIT)
+    poll = current_app.config['CHANGE_POLL_MS'] / 1000
+
+    if request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream':
+        stream = stream_changes(after, req["doctor_name"], limit, current_app.config['CHANGE_STREAM_SECONDS'], poll)
+        return Response(stream_with_context(stream), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    deadline = time.monotonic() + min(max(req["wait"] or 0, 0), current_app.config['CHANGE_WAIT_MAX'])
+    while True:
+        changes, after = read_changes(after, req["doctor_name"], limit)
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            break
+        wait_for_changes(min(poll, remaining))
+    return Response(f'{{"changes":[{",".join(data for _, _, data in changes)}],"last":{cursor_json(after)}}}\n',
+                    mimetype='application/json')
+
+
+@visits.route('/doctors', methods=["GET"])
+def get_doctors():
+    """GET type method
+
+    Function that returns all doctors
+
+    :returns: result being list of doctors with their ids and names in json format
+    :rtype: flask.Request object
+    """
+    doctors = heapq.merge(*each_shard(shard_doctors))
+    return jsonify([{"doctor_id": doctor_id, "doctor_name": doctor_name} for doctor_id, doctor_name in doctors])
+
+
+@visits.route('/cache', methods=["GET"])
+def get_cache_stats():
+    """GET type method
+
+    Function that returns counters of visit_cache, useful for choosing its size
+
+    :returns: result being size, limit, hits, misses, evictions and invalidations of the cache in json format
+    :rtype: flask.Request object
+    """
+    return jsonify(visit_cache.stats())
+
+
+@visits.route('/metrics', methods=["GET"])
+def get_metrics():
+    """GET type method
+
+    Function that returns statistics of the requests handled by this process
+
+    :returns: result being latency histograms, SQL statement counts and conflict counters in Prometheus text format
+    :rtype: flask.Request object
+    """
+    gauges = [("visits_cache_entries", "Responses stored in visit_cache", visit_cache.stats()["size"])]
+    return Response(metrics.render(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def route_label():
+    """Returns name of the route of the current request used in metrics
+
+    Selectors of GET /visit/<parameter> and GET /slot/<parameter> get their own names,
+    other values share the name of the rule so the number of names stays bounded
+
+    :returns: method and rule of the request, e.g. "GET /visit/doctor"
+    :rtype: str
+    """
+    req = request._get_current_object()
+    if req.url_rule is None:
+        return f"{req.method} unmatched"
+    parameter = (req.view_args or {}).get("parameter")
+    if parameter in VISIT_SELECTORS or parameter in SLOT_SELECTORS or parameter in STATS_SELECTORS:
+        return f"{req.method} {req.url_rule.rule.replace('<parameter>', parameter)}"
+    return f"{req.method} {req.url_rule.rule}"
+
+
+@visits.before_app_request
+def start_refresher():
+    """Starts the thread of refresh_local_state in this process, unless SLOT_REFRESH_MS is 0 or the database
+    is an in-memory one, which other threads don't see"""
+    interval = current_app.config['SLOT_REFRESH_MS']
+    if refresher["pid"] == os.getpid() or not interval or any(
+            engine.url.database in (None, '', ':memory:') for engine in each_shard(lambda: db.engine)):
+        return
+    with refresher_lock:
+        if refresher["pid"] != os.getpid():
+            threading.Thread(target=refresh_local_state, args=(current_app._get_current_object(), interval / 1000),
+                             name="refresh-local-state", daemon=True).start()
+            refresher["pid"] = os.getpid()
+
+
+@visits.before_app_request
+def start_metrics():
+    """Starts measuring the request, requests reading the profiles and long polls of changes are not profiled"""
+    metrics.start_request()
+    if profiler.enabled and not request.path.startswith('/admin/') and request.path != '/visit/changes':
+        profiler.start_request()
+
+
+@visits.after_app_request
+def response_metrics(response):
+    """Remembers route and status of the response, the request is recorded when it ends"""
+    if metrics.enabled or profiler.enabled:
+        route = route_label()
+        metrics.set_response(route, response.status_code)
+        profiler.set_response(route, response.status_code)
+    return response
+
+
+@visits.teardown_app_request
+def record_metrics(error):
+    """Records the request in metrics, after a streamed response has been sent entirely"""
+    metrics.end_request(error is not None)
+    profiler.end_request(error is not None)
+
+
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    """Listener of the before_cursor_execute event"""
+    metrics.start_statement()
+
+
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    """Listener of the after_cursor_execute event"""
+    metrics.end_statement()
+
+
+def start_profiled_statement(conn, cursor, statement, parameters, context, executemany):
+    """Listener of the before_cursor_execute event used while the profiler is enabled"""
+    profiler.start_statement()
+
+
+def end_profiled_statement(conn, cursor, statement, parameters, context, executemany):
+    """Listener of the after_cursor_execute event used while the profiler is enabled"""
+    profiler.end_statement(statement)
+
+
+def admin_error():
+    """Checks the X-Admin-Token header of a request to the /admin routes
+
+    :returns: flask.Response object containing the error message in json format with error code
+    or None if the request is allowed
+    :rtype: flask.Response object
+    """
+    token = current_app.config['ADMIN_TOKEN']
+    if token is not None and request.headers.get('X-Admin-Token') != token:
+        return make_response(jsonify({"error": "Invalid admin token..."}), 403)
+    return None
+
+
+@visits.route('/admin/profiles', methods=["GET"])
+def get_profiles():
+    """GET type method
+
+    Function that lists profiles saved by profiler
+
+    :returns: result being list of names and sizes of the profiles from the newest in json format
+    :rtype: flask.Request object
+    """
+    return admin_error() or jsonify(profiler.profiles())
+
+
+@visits.route('/admin/profiles/<name>', methods=["GET"])
+def get_profile(name):
+    """GET type method
+
+    Function that downloads a profile saved by profiler
+
+    :param name: name of the profile returned by GET /admin/profiles
+    :type name: str
+    :returns: result being the profile with the route, status, duration, SQL statements, cProfile report
+    and sampled stacks of the request in json format
+    :rtype: flask.Request object
+    """
+    error = admin_error()
+    if error is not None:
+        return error
+    if not profiler.directory or not name.endswith(".json"):
+        return make_response(jsonify({"error": "Such profile doesn't exist..."}), 404)
+    return send_from_directory(os.path.abspath(profiler.directory), name, mimetype='application/json',
+                               as_attachment=True)
+
+
+def valid_date(visit_date):
+    """Checks that a date is given in 1YYMMDDHH format and its day exists
+
+    :param visit_date: the date
+    :type visit_date: int
+    :returns: True if the date is valid
+    :rtype: bool
+    """
+    if visit_date is None or visit_date < 100000000 or visit_date > 199999999:
+        return False
+    try:
+        day_to_date(visit_date // 100)
+    except ValueError:
+        return False
+    return True
+
+
+@visits.route('/slot/<parameter>', methods=["GET"])
+def get_slot(parameter):
+    """GET type method
+
+    Function that returns free dates of doctors, answered from free_slots, slot_holds and doctor_ids without
+    querying the database, see refresh_local_state, held dates aren't free. Without doctor_name "next" looks
+    through every doctor of all shards, also the ones without visits
+
+    :param parameter: "free" for free dates of a doctor in the day of visit_date,
+    "next" for the first free date not earlier than visit_date of a doctor or of any doctor if doctor_name is not given
+    :type parameter: str
+    :returns: result, list of free dates or the first free date with doctor's name in json format when the action
+    is succesful or flask.Response object containing the error message in json format with error code
+    :rtype: flask.Request object
+    """
+    req = parse_args(VISIT_ARGS)
+    if not valid_date(req['visit_date']):
+        return make_response(jsonify({"error": "Invalid date format..."}), 409)
+
+    if parameter == "free":
+        day = req['visit_date'] // 100
+        with use_shard(shard_of(req["doctor_name"])):
+            sync_slots()
+            return jsonify(free_slots.free(req["doctor_name"], day,
+                                           slot_holds.held_hours(req["doctor_name"]).get(day, 0)))
+
+    if parameter == "next":
+        def next_free():
+            sync_slots()
+            doctors = [req["doctor_name"]] if req["doctor_name"] else \
+                [doctor_name for doctor_name in list(doctor_ids.keys()) if shard_of(doctor_name) == current_shard()]
+            found = []
+            for doctor_name in doctors:
+                visit_date = free_slots.next_free(doctor_name, req['visit_date'], slot_holds.held_hours(doctor_name))
+                if visit_date:
+                    found.append((visit_date, doctor_name))
+            return found
+
+        shards = [shard_of(req["doctor_name"])] if req["doctor_name"] else None
+        found = [free for shard_found in fan_out(next_free, shards) for free in shard_found]
+        if not found:
+            return make_response(jsonify({"error": "There are no free dates..."}), 405)
+        visit_date, doctor_name = min(found)
+        return jsonify({"visit_date": visit_date, "doctor_name": doctor_name})
+
+    return make_response(jsonify({"error": "Invalid specifier..."}), 409)
+
+
+def day_label(day):
+    """Returns day in 1YYMMDD format as YYYY-MM-DD
+
+    :param day: day in 1YYMMDD format
+    :type day: int
+    :returns: the day in ISO format, or as given if it doesn't exist
+    :rtype: str
+    """
+    try:
+        return day_to_date(day).isoformat()
+    except ValueError:
+        return str(day)
+
+
+def month_days(month, first_day, last_day):
+    """Returns number of days of a month between two days
+
+    :param month: month in 1YYMM format
+    :type month: int
+    :param first_day: first day in 1YYMMDD format, None for no bound
+    :type first_day: int
+    :param last_day: last day in 1YYMMDD format, None for no bound
+    :type last_day: int
+    :returns: number of days
+    :rtype: int
+    """
+    if not 1 <= month % 100 <= 12:
+        return 0
+    first = month * 100 + 1
+    last = month * 100 + calendar.monthrange(2000 + month // 100 % 100, month % 100)[1]
+    if first_day is not None:
+        first = max(first, first_day)
+    if last_day is not None:
+        last = min(last, last_day)
+    return max(last - first + 1, 0)
+
+
+@visits.route('/stats/<parameter>', methods=["GET"])
+def get_stats(parameter):
+    """GET type method
+
+    Function that returns numbers of visits read from the daily counts of visits, so a report costs the same
+    regardless of the number of visits. Utilization is the share of taken slots of the working hours.
+    Counts of all shards are read at the same time and added up
+
+    :param parameter: "doctor" for every doctor and day, "day" for every day and "month" for every month,
+    optionally narrowed by from, to and doctor_name
+    :type parameter: str
+    :returns: result being list of dates or months with numbers of all visits, visits in working hours
+    and utilization in json format or flask.Response object containing the error message in json format
+    with error code
+    :rtype: flask.Request object
+    """
+    if parameter not in STATS_SELECTORS:
+        return make_response(jsonify({"error": "Invalid specifier..."}), 409)
+    req = parse_args(STATS_ARGS)
+    for bound in ("from", "to"):
+        if req[bound] is not None and not 100000000 <= req[bound] <= 199999999:
+            return make_response(jsonify({"error": "Invalid date format..."}), 409)
+    first_day = None if req["from"] is None else req["from"] // 100
+    last_day = None if req["to"] is None else req["to"] // 100
+
+    def narrow(query):
+        query = query.filter(VisitCount.visits > 0)
+        if first_day is not None:
+            query = query.filter(VisitCount.day >= first_day)
+        if last_day is not None:
+            query = query.filter(VisitCount.day <= last_day)
+        if req["doctor_name"] is not None:
+            query = filter_key(query, VisitCount.doctor_id, find_doctor(req["doctor_name"]))
+        return query
+
+    shards = None if req["doctor_name"] is None else [shard_of(req["doctor_name"])]
+    if parameter == "doctor":
+        def doctor_counts():
+            return narrow(db.session.query(VisitCount.day, VisitCount.doctor_id, Doctor.doctor_name,
+                                           VisitCount.visits, VisitCount.grid_visits)
+                          .outerjoin(Doctor, VisitCount.doctor_id == Doctor.doctor_id))\
+                .order_by(VisitCount.day, VisitCount.doctor_id).all()
+        rows = heapq.merge(*fan_out(doctor_counts, shards), key=lambda row: row[:2])
+        return jsonify([{"date": day_label(day), "doctor_name": doctor_name, "visits": visits,
+                         "grid_visits": grid_visits, "utilization": round(grid_visits / GRID_HOURS, 4)}
+                        for day, _, doctor_name, visits, grid_visits in rows])
+
+    doctors = 1 if req["doctor_name"] is not None else sum(len(found) for found in each_shard(shard_doctors))
+    period = VisitCount.day if parameter == "day" else VisitCount.day / 100
+    totals = {}
+    for found in fan_out(lambda: narrow(db.session.query(period, db.func.sum(VisitCount.visits),
+                                                         db.func.sum(VisitCount.grid_visits)))
+                         .group_by(period).all(), shards):
+        for key, visits, grid_visits in found:
+            total = totals.setdefault(key, [0, 0])
+            total[0] += visits
+            total[1] += grid_visits
+    result = []
+    for key, (visits, grid_visits) in sorted(totals.items()):
+        if parameter == "day":
+            result.append({"date": day_label(key), "visits": visits, "grid_visits": grid_visits})
+            slots = GRID_HOURS * doctors
+        else:
+            result.append({"month": f"{2000 + key // 100 % 100}-{key % 100:02d}", "visits": visits,
+                           "grid_visits": grid_visits})
+            slots = GRID_HOURS * doctors * month_days(key, first_day, last_day)
+        result[-1]["utilization"] = round(grid_visits / slots, 4) if slots else None
+    return jsonify(result)
+
+
+# Longest accepted Idempotency-Key header
+IDEMPOTENCY_KEY_LENGTH = 200
+# Every how many stored keys the expired ones are deleted
+IDEMPOTENCY_PRUNE_EVERY = 100
+idempotency_numbers = itertools.count()
+
+
+def frozen(response):
+    """Returns body, status and headers of a response, shared by identical requests
+
+    :param response: the response
+    :type response: flask.Response object
+    :returns: body, status code and list of headers
+    :rtype: tuple
+    """
+    return response.get_data(), response.status_code, list(response.headers)
+
+
+def replayed(result, source):
+    """Returns a copy of a response given to an identical request
+
+    :param result: value returned by frozen
+    :type result: tuple
+    :param source: "stored" for a response of the idempotency table, "coalesced" for a concurrent request
+    :type source: str
+    :returns: the response
+    :rtype: flask.Response object
+    """
+    metrics.count("visits_idempotent_replays_total", source=source)
+    body, status, headers = result
+    response = Response(body, status, headers)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def stored_response(key, fingerprint):
+    """Returns the response stored for an Idempotency-Key
+
+    Waits up to IDEMPOTENCY_WAIT seconds while the request is handled by another process
+
+    :param key: value of the header
+    :type key: str
+    :param fingerprint: hash of the request
+    :type fingerprint: str
+    :returns: None if the key is not stored, otherwise value like the one returned by frozen and True if it is
+    the stored response, False if it is an error
+    :rtype: tuple
+    """
+    ttl = current_app.config['IDEMPOTENCY_TTL']
+    deadline = time.monotonic() + current_app.config['IDEMPOTENCY_WAIT']
+    while True:
+        row = db.session.query(IdempotencyKey.fingerprint, IdempotencyKey.status, IdempotencyKey.body,
+                               IdempotencyKey.created).filter_by(key=key).first()
+        db.session.close()
+        if row is None or row.created < time.time() - ttl:
+            return None
+        if row.fingerprint != fingerprint:
+            return (json_encoder.encode({"error": "The Idempotency-Key was used with another request..."}), 422,
+                    [('Content-Type', 'application/json')]), False
+        if row.status is not None:
+            return (row.body, row.status, [('Content-Type', 'application/json')]), True
+        if time.monotonic() >= deadline:
+            return (json_encoder.encode({"error": "A request with this Idempotency-Key is in progress..."}), 409,
+                    [('Content-Type', 'application/json')]), False
+        time.sleep(0.05)
+
+
+def keyed_response(key, fingerprint, view, args, kwargs):
+    """Handles a request with the Idempotency-Key header
+
+    The key is stored before the view is called and the response after it, responses with status 500
+    and errors aren't stored, so such requests can be repeated
+
+    :param key: value of the header
+    :type key: str
+    :param fingerprint: hash of the request
+    :type fingerprint: str
+    :param view: the view function
+    :type view: function
+    :param args: positional arguments of the view
+    :type args: tuple
+    :param kwargs: keyword arguments of the view
+    :type kwargs: dict
+    :returns: value like the one returned by frozen and True if it is a stored response
+    :rtype: tuple
+    """
+    while True:
+        stored = stored_response(key, fingerprint)
+        if stored is not None:
+            return stored
+        now = int(time.time())
+        try:
+            db.session.query(IdempotencyKey).filter(IdempotencyKey.key == key, IdempotencyKey.created <
+                                                    now - current_app.config['IDEMPOTENCY_TTL']).delete()
+            db.session.add(IdempotencyKey(key=key, fingerprint=fingerprint, created=now))
+            db.session.commit()
+            break
+        except IntegrityError:  # stored by a concurrent request in the meantime
+            db.session.rollback()
+
+    try:
+        response = frozen(view(*args, **kwargs))
+    except Exception:
+        db.session.rollback()
+        db.session.query(IdempotencyKey).filter_by(key=key).delete()
+        db.session.commit()
+        raise
+    db.session.rollback()
+    if response[1] >= 500:
+        db.session.query(IdempotencyKey).filter_by(key=key).delete()
+    else:
+        db.session.query(IdempotencyKey).filter_by(key=key)\
+            .update({"status": response[1], "body": response[0].decode()}, synchronize_session=False)
+    if next(idempotency_numbers) % IDEMPOTENCY_PRUNE_EVERY == 0:
+        db.session.query(IdempotencyKey).filter(
+            IdempotencyKey.created < now - current_app.config['IDEMPOTENCY_TTL']).delete(synchronize_session=False)
+    db.session.commit()
+    return response, False
 
-"""
-restAPI.py
-========================================================
-Program that creates and maintains a databse on a server
-"""
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///databse.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
-ma = Marshmallow(app)
+def idempotent(view):
+    """Decorator of POST views answering repeated requests with the response of the first one
 
+    Requests with the Idempotency-Key header get the response stored for the key, without touching
+    the visits. Identical requests handled at the same time by this process, with or without the header,
+    are coalesced, so only one of them reaches the database
 
-class VisitModel(db.Model):
-    """The record class in the db database
+    :param view: the view function
+    :type view: function
+    :returns: the decorated view function
+    :rtype: function
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is not None and not 0 < len(key) <= IDEMPOTENCY_KEY_LENGTH:
+            return make_response(jsonify({"error": "Invalid Idempotency-Key..."}), 400)
+        digest = hashlib.sha256(request.method.encode())
+        digest.update(request.full_path.encode())
+        digest.update(b"\0")
+        digest.update(request.get_data())
+        fingerprint = digest.hexdigest()
 
-    This class is a look of our visit database
+        if key is None:
+            result, shared = in_flight.run(("request", fingerprint), lambda: frozen(view(*args, **kwargs)))
+            return replayed(result, "coalesced") if shared else Response(*result)
+        (result, stored), shared = in_flight.run(("key", key, fingerprint),
+                                                 lambda: keyed_response(key, fingerprint, view, args, kwargs))
+        return replayed(result, "coalesced" if shared else "stored") if shared or stored else Response(*result)
+    return wrapper
+
+
+def held_error():
+    """Returns the error of a booking of a date held by someone else
+
+    :returns: flask.Response object containing the error message in json format with error code
+    :rtype: flask.Response object
+    """
+    metrics.count("visits_booking_conflicts_total", reason="held")
+    return make_response(jsonify({"error": "This date is held by someone else..."}), 409)
+
+
+def remember_hold(doctor_name, visit_date, hold_id, expires):
+    """Adds a hold to slot_holds for at most HOLD_LOCAL_SECONDS
 
-    :param visit_id: id of a visit, primary_key
-    :type visit_id: int
-    :param visit_date: date of a visit
-    :type visit_date: int
-    :param patient_id: id of a patient
-    :type patient_id: str
-    :param patient_name: name of a patient
-    :type patient_name: str
     :param doctor_name: name of a doctor
     :type doctor_name: str
+    :param visit_date: held date
+    :type visit_date: int
+    :param hold_id: id of the hold
+    :type hold_id: str
+    :param expires: time the hold expires in seconds since the epoch
+    :type expires: float
     """
-    visit_id = db.Column(db.Integer, primary_key=True)
-    visit_date = db.Column(db.Integer)
-    patient_id = db.Column(db.String(500))
-    patient_name = db.Column(db.String(500))
-    doctor_name = db.Column(db.String(500))
+    slot_holds.hold(doctor_name, visit_date, hold_id,
+                    min(expires, time.time() + current_app.config['HOLD_LOCAL_SECONDS']))
 
 
-class MyAppSchema(ma.Schema):
-    """The class that provides object serialization
+def take_hold(doctor_id, doctor_name, visit_date, hold_id=None):
+    """Checks the hold of a date in the transaction of a booking
 
-    This class is a schema that finds certain keywords and completes objects from given data
+    The hold with the given id and an expired hold of the date are deleted with the booking
+
+    :param doctor_id: id of the doctor of the booking
+    :type doctor_id: int
+    :param doctor_name: name of the doctor of the booking
+    :type doctor_name: str
+    :param visit_date: date of the booking
+    :type visit_date: int
+    :param hold_id: id of the hold given by the booking, None if it gave none
+    :type hold_id: str
+    :returns: True if the date is held by someone else
+    :rtype: bool
     """
-    class Meta:
-        fields = ('visit_id', 'visit_date', 'patient_id', 'patient_name', 'doctor_name')
+    if doctor_id is None or visit_date is None:
+        return False
+    held = db.session.query(SlotHold).filter_by(doctor_id=doctor_id, visit_date=visit_date)
+    row = held.with_entities(SlotHold.hold_id, SlotHold.expires).first()
+    if row is None:
+        return False
+    if row.hold_id != hold_id and row.expires > time.time():
+        remember_hold(doctor_name, visit_date, row.hold_id, row.expires)
+        return True
+    held.delete(synchronize_session=False)
+    slot_holds.release(doctor_name, visit_date)
+    return False
 
 
-my_app_schema = MyAppSchema(many=True)
+def book_visit(req, hold_id=None):
+    """Creates a visit unless its date is taken or held by someone else
 
+    Holds known to this process are checked before the database is touched, the hold of the date
+    is checked again in the transaction of the booking. Has to be called in the shard of the doctor
 
-visit_put_args = reqparse.RequestParser()
-visit_put_args.add_argument("visit_id", type=int)
-visit_put_args.add_argument("visit_date", type=int)
-visit_put_args.add_argument("patient_id", type=str)
-visit_put_args.add_argument("patient_name", type=str)
-visit_put_args.add_argument("doctor_name", type=str)
+    :param req: parsed arguments of the visit
+    :type req: dict
+    :param hold_id: id of the hold of the date given by the patient
+    :type hold_id: str
+    :returns: result being a flask.Response object containing either message or error in json format with appropriate code
+    :rtype: flask.Response object
+    """
+    hold = slot_holds.holder(req["doctor_name"], req["visit_date"])
+    if hold is not None and hold[0] != hold_id:
+        return held_error()
+    doctors, patients, renamed = visit_keys([req["doctor_name"]], {req["patient_id"]: req["patient_name"]})
 
+    visit_id, = assign_ids([req])
+    if visit_id is None:
+        db.session.rollback()
+        return id_taken_error(req["visit_id"])
+    values = {"visit_id": visit_id, "visit_date": req["visit_date"], "doctor_id": doctors.get(req["doctor_name"]),
+              "patient_key": patients.get(req["patient_id"])}
+    try:
+        db.session.execute(VisitModel.__table__.insert(), values)
+        if take_hold(values["doctor_id"], req["doctor_name"], req["visit_date"], hold_id):
+            db.session.rollback()
+            return held_error()
+        changes = [(None, dict(req, visit_id=visit_id))] + rename_patients(renamed)
+        version = record_changes(changes)
+        db.session.commit()
+    except IntegrityError:  # unique indexes reject duplicates, also when identical requests arrive simultaneously
+        db.session.rollback()
+        return conflict_error(req)
 
-@app.route('/visit/<parameter>', methods=["GET"])
-def get_visit(parameter):
-    """GET type method
+    apply_changes(changes, version)
+    spread_names(renamed)
+    return make_response(jsonify({'message': 'New visit created'}), 201)
 
-    Function that returns choosen range of visits from database
 
-    :param parameter: Specifies the choice of option according to which we want to select elements from the database
-    :type parameter: str
-    :returns: result, which may be one or list of VisitModel objects when the action is succesful or
-    flask.Response object containing the error message in json format with error code
-    :rtype: list/flask.Request object
+def id_taken_error(visit_id):
+    """Returns the error of a visit given an id that is taken
+
+    :param visit_id: the given id
+    :type visit_id: int
+    :returns: flask.Response object containing the error message in json format with error code
+    :rtype: flask.Response object
     """
-    if parameter == "doctor":
-        req = visit_put_args.parse_args()
-        entries = VisitModel.query.filter_by(doctor_name=req["doctor_name"]).all()
-        if not entries:
-            return make_response(jsonify({"error": "This doctor has no appointments..."}), 405)
-        result = my_app_schema.dump(entries)
-        return jsonify(result)
+    metrics.count("visits_booking_conflicts_total", reason="id_taken")
+    return make_response(jsonify({"error": f"Visit ID {visit_id} is already taken..."}), 409)
 
-    if parameter == "patient":
-        req = visit_put_args.parse_args()
-        entries = VisitModel.query.filter_by(patient_id=req["patient_id"]).all()
-        if not entries:
-            return make_response(jsonify({"error": "This patient has no appointments..."}), 405)
-        result = my_app_schema.dump(entries)
-        return jsonify(result)
 
-    if parameter == "selected":
-        req = visit_put_args.parse_args()
-        entries = VisitModel.query.filter_by(visit_date=req["visit_date"], patient_id=req["patient_id"],
-                                             patient_name=req["patient_name"], doctor_name=req["doctor_name"]).all()
-        if not entries:
-            return make_response(jsonify({"error": "Such visit doesn't exist..."}), 405)
-        result = my_app_schema.dump(entries)
-        return jsonify(result)
+@visits.route('/visit', methods=["POST"])
+@idempotent
+def post_visit():
+    """POST type method 
 
-    if parameter == "date":
-        req = visit_put_args.parse_args()
+    Function that creates a new VisitModel object in the database from data in json format given by the user,
+    a date held by POST /hold can be booked only with hold_id of the hold
 
-        if req['visit_date'] < 100000000 or req['visit_date'] > 199999999:
-            return make_response(jsonify({"error": "Invalid date format..."}), 409)
+    :returns: result being a flask.Response object containing either message or error in json format with appropriate code
+    :rtype: flask.Request object
+    """
+    req = parse_args(VISIT_ARGS + (("hold_id", str),))
+    hold_id = req.pop("hold_id")
+    with use_shard(shard_of(req["doctor_name"])):
+        return book_visit(req, hold_id)
 
-        date_day = req['visit_date'] - (req['visit_date'] % 100)
-        entries = db.session.query(VisitModel).filter(VisitModel.visit_date >= date_day,
-                                                      VisitModel.visit_date <= (date_day + 100)).all()
-        if not entries:
-            return make_response(jsonify({"error": "Such visit doesn't exist..."}), 405)
-        result = my_app_schema.dump(entries)
-        return jsonify(result)
 
-    if parameter == "id":
-        req = visit_put_args.parse_args()
-        entries = VisitModel.query.filter_by(visit_id=req["visit_id"]).all()
-        if not entries:
-            return make_response(jsonify({"error": f"There is no appointment with ID:{req['visit_id']}..."}), 405)
-        result = my_app_schema.dump(entries)
-        return jsonify(result)
+# Number of times a batch is checked again when a concurrent request took one of its slots
+BATCH_RETRIES = 3
 
-    if parameter == "all":
-        entries = VisitModel.query.all()
-        result = my_app_schema.dump(entries)
-        return jsonify(result)
 
-    return make_response(jsonify({"error": "Invalid specifier..."}), 409)
+def batch_row(item):
+    """Converts one visit of a batch to column values
 
+    Values are converted the same way parse_args converts them for a single visit
 
-@app.route('/visit', methods=["POST"])
-def post_visit():
-    """POST type method 
+    :param item: visit's data
+    :type item: dict
+    :returns: dictionary of column values
+    :rtype: dict
+    :raises ValueError: if the visit's data has wrong format
+    """
+    if not isinstance(item, dict):
+        raise ValueError("visit has to be an object")
+    row = {}
+    for column, convert in (("visit_id", int), ("visit_date", int), ("patient_id", str),
+                            ("patient_name", str), ("doctor_name", str)):
+        row[column] = None if item.get(column) is None else convert(item[column])
+    return row
 
-    Function that creates a new VisitModel object in the database from data in json format given by the user
 
-    :returns: result being a flask.Response object containing either message or error in json format with appropriate code
+def check_batch(rows):
+    """Checks all visits of a batch against the database and against each other
+
+    Taken ids, taken dates and held dates are read with a few set-based queries instead of three queries per visit,
+    ids taken in other shards are found by assign_ids
+
+    :param rows: column values of the visits
+    :type rows: list
+    :returns: result for every visit, None for visits that can be created
+    :rtype: list
+    """
+    taken_ids = set()
+    query = select([VisitModel.visit_id]).where(VisitModel.visit_id.in_(IN_VALUES))
+    for ids in in_chunks({row["visit_id"] for row in rows if row["visit_id"] is not None}):
+        taken_ids.update(visit_id for visit_id, in db.session.execute(query, {"values": ids}))
+
+    taken_dates = {}
+    query = select([Doctor.doctor_name, VisitModel.visit_date, Patient.patient_id])\
+        .select_from(VisitModel.__table__.join(Doctor).outerjoin(Patient))\
+        .where(Doctor.doctor_name.in_(db.bindparam("doctors", expanding=True)))\
+        .where(VisitModel.visit_date.in_(db.bindparam("dates", expanding=True)))
+    held_query = select([Doctor.doctor_name, SlotHold.visit_date])\
+        .select_from(SlotHold.__table__.join(Doctor))\
+        .where(Doctor.doctor_name.in_(db.bindparam("doctors", expanding=True)))\
+        .where(SlotHold.visit_date.in_(db.bindparam("dates", expanding=True)))\
+        .where(SlotHold.expires > time.time())
+    held_dates = set()
+    for doctors in in_chunks({row["doctor_name"] for row in rows}):
+        for dates in in_chunks({row["visit_date"] for row in rows}):
+            taken_dates.update(((doctor_name, visit_date), patient_id) for doctor_name, visit_date, patient_id
+                               in db.session.execute(query, {"doctors": doctors, "dates": dates}))
+            held_dates.update((doctor_name, visit_date) for doctor_name, visit_date
+                              in db.session.execute(held_query, {"doctors": doctors, "dates": dates}))
+
+    results = []
+    for row in rows:
+        slot = (row["doctor_name"], row["visit_date"])
+        if row["visit_id"] is not None and row["visit_id"] in taken_ids:
+            metrics.count("visits_booking_conflicts_total", reason="id_taken")
+            results.append({"error": f"Visit ID {row['visit_id']} is already taken..."})
+        elif slot in taken_dates and taken_dates[slot] == row["patient_id"]:
+            metrics.count("visits_booking_conflicts_total", reason="already_booked")
+            results.append({"error": "You've already made such appointment..."})
+        elif slot in taken_dates:
+            metrics.count("visits_booking_conflicts_total", reason="date_taken")
+            results.append({"error": "The given date is taken..."})
+        elif slot in held_dates:
+            metrics.count("visits_booking_conflicts_total", reason="held")
+            results.append({"error": "This date is held by someone else..."})
+        else:
+            results.append(None)
+            taken_ids.add(row["visit_id"])
+            taken_dates[slot] = row["patient_id"]
+    return results
+
+
+def insert_visits(rows, doctors, patients):
+    """Inserts visits in the current transaction with one executemany
+
+    :param rows: column values of the visits returned by batch_row, with visit_id given by assign_ids
+    :type rows: list
+    :param doctors: doctor_id of every doctor's name returned by visit_keys
+    :type doctors: dict
+    :param patients: patient_key of every patient_id returned by visit_keys
+    :type patients: dict
+    """
+    if rows:
+        db.session.execute(VisitModel.__table__.insert(), [
+            {"visit_id": row["visit_id"], "visit_date": row["visit_date"],
+             "doctor_id": doctors.get(row["doctor_name"]), "patient_key": patients.get(row["patient_id"])}
+            for row in rows])
+
+
+def book_batch(rows):
+    """Creates visits of a batch kept in the current shard in one transaction
+
+    :param rows: column values of the visits returned by batch_row
+    :type rows: list
+    :returns: result for every visit and patients renamed by the batch, to be passed to spread_names,
+    None if concurrent requests kept taking dates of the visits
+    :rtype: tuple
+    """
+    for _ in range(BATCH_RETRIES):
+        results = check_batch(rows)
+        new = [index for index, result in enumerate(results) if result is None]
+
+        try:
+            doctors, patients, renamed = visit_keys((rows[index]["doctor_name"] for index in new),
+                                                    {row["patient_id"]: row["patient_name"] for row in rows})
+            created = []
+            for index, visit_id in zip(new, assign_ids([rows[index] for index in new])):
+                if visit_id is None:
+                    metrics.count("visits_booking_conflicts_total", reason="id_taken")
+                    results[index] = {"error": f"Visit ID {rows[index]['visit_id']} is already taken..."}
+                else:
+                    created.append(dict(rows[index], visit_id=visit_id))
+            insert_visits(created, doctors, patients)
+            changes = [(None, row) for row in created] + rename_patients(renamed)
+            version = record_changes(changes)
+            db.session.commit()
+        except IntegrityError:  # a concurrent request took some of the slots in the meantime
+            db.session.rollback()
+            metrics.count("visits_booking_retries_total")
+            continue
+
+        apply_changes(changes, version)
+        return [result or {"message": "New visit created"} for result in results], renamed
+
+    metrics.count("visits_booking_conflicts_total", reason="race")
+    return None
+
+
+@visits.route('/visit/batch', methods=["POST"])
+@idempotent
+def post_visit_batch():
+    """POST type method
+
+    Function that creates many new VisitModel objects in the database from a list of visits in json format,
+    all valid visits of a shard are inserted in one transaction, the shards of the batch are written at the
+    same time. When concurrent requests keep taking dates of the batch, visits of that shard get an error,
+    without shards the whole request does. The batch isn't atomic across shards, a shard may commit its visits
+    while another one fails
+
+    :returns: result being a flask.Response object containing list of messages or errors in json format,
+    one for every given visit, in the same order
     :rtype: flask.Request object
     """
-    req = visit_put_args.parse_args()
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        return make_response(jsonify({"error": "Expected a list of visits..."}), 400)
 
-    result = VisitModel.query.filter_by(visit_id=req["visit_id"]).first()
-    if result:
-        return make_response(jsonify({"error": f"Visit ID {req['visit_id']} is already taken..."}), 409)
+    results = []
+    groups = {}
+    for index, item in enumerate(items):
+        try:
+            row = batch_row(item)
+        except (TypeError, ValueError):
+            results.append({"error": "Invalid visit data..."})
+            continue
+        results.append(None)
+        groups.setdefault(shard_of(row["doctor_name"]), []).append((index, row))
+    groups = groups or {0: []}
 
-    result = VisitModel.query.filter_by(visit_date=req["visit_date"], patient_id=req["patient_id"],
-                                        patient_name=req["patient_name"], doctor_name=req["doctor_name"]).first()
-    if result:
-        return make_response(jsonify({"error": "You've already made such appointment..."}), 409)
+    shards = sorted(groups)
+    booked = fan_out(lambda: book_batch([row for _, row in groups[current_shard()]]), shards)
+    renamed = []
+    for shard, outcome in zip(shards, booked):
+        if outcome is None:
+            if not shard_engines:
+                return make_response(jsonify({'error': 'Someone just took this date...'}), 409)
+            outcome = [{'error': 'Someone just took this date...'}] * len(groups[shard]), []
+        for (index, _), result in zip(groups[shard], outcome[0]):
+            results[index] = result
+        renamed += outcome[1]
+    spread_names(renamed)
+    return jsonify(results)
 
-    result = VisitModel.query.filter_by(visit_date=req["visit_date"], doctor_name=req["doctor_name"]).first()
-    if result:
+
+# Arguments of POST /hold, seconds defaults to HOLD_SECONDS
+HOLD_ARGS = (("doctor_name", str), ("visit_date", int), ("seconds", float))
+# Every how many holds the expired ones are deleted
+HOLD_PRUNE_EVERY = 100
+hold_numbers = itertools.count()
+
+
+@visits.route('/hold', methods=["POST"])
+def post_hold():
+    """POST type method
+
+    Function that holds a free date of a doctor for some seconds, until the hold expires the date can be booked
+    only with its hold_id, by POST /hold/<hold_id>/confirm or POST /visit. Dates taken or held by someone else
+    are refused from free_slots and slot_holds without writing to the database
+
+    :returns: result being a flask.Response object containing hold_id, doctor_name, visit_date and the time
+    the hold expires in seconds since the epoch or error in json format with appropriate code
+    :rtype: flask.Request object
+    """
+    req = parse_args(HOLD_ARGS)
+    doctor_name, visit_date = req["doctor_name"], req["visit_date"]
+    seconds = current_app.config['HOLD_SECONDS'] if req["seconds"] is None else req["seconds"]
+    if doctor_name is None:
+        return make_response(jsonify({"error": "Doctor's name is required..."}), 400)
+    if not valid_date(visit_date):
+        return make_response(jsonify({"error": "Invalid date format..."}), 409)
+    if not 0 < seconds <= current_app.config['HOLD_MAX_SECONDS']:
+        return make_response(jsonify({"error": "Invalid hold time..."}), 400)
+    with use_shard(shard_of(doctor_name)):
+        return hold_slot(doctor_name, visit_date, seconds)
+
+
+def hold_slot(doctor_name, visit_date, seconds):
+    """Holds a date of a doctor in the shard of the doctor
+
+    :param doctor_name: name of the doctor
+    :type doctor_name: str
+    :param visit_date: held date
+    :type visit_date: int
+    :param seconds: time the hold lasts
+    :type seconds: float
+    :returns: result being a flask.Response object containing the hold or error in json format with appropriate code
+    :rtype: flask.Response object
+    """
+    sync_slots()
+    day, hour = split_date(visit_date)
+    if FIRST_HOUR <= hour <= LAST_HOUR and free_slots.taken(doctor_name, day) >> (hour - FIRST_HOUR) & 1:
+        metrics.count("visits_holds_total", result="taken")
         return make_response(jsonify({"error": "The given date is taken..."}), 409)
+    if slot_holds.holder(doctor_name, visit_date) is not None:
+        metrics.count("visits_holds_total", result="held")
+        return make_response(jsonify({"error": "This date is held by someone else..."}), 409)
+
+    slot = {"doctor_id": doctor_keys([doctor_name])[doctor_name], "visit_date": visit_date}
+    now = time.time()
+    hold_id = secrets.token_urlsafe(16)
+    try:
+        db.session.query(SlotHold).filter_by(**slot).filter(SlotHold.expires <= now).delete(synchronize_session=False)
+        if next(hold_numbers) % HOLD_PRUNE_EVERY == 0:
+            db.session.query(SlotHold).filter(SlotHold.expires <= now).delete(synchronize_session=False)
+        db.session.add(SlotHold(hold_id=hold_id, expires=now + seconds, **slot))
+        db.session.flush()
+        # Checked after the insert, so a booking of the date can't commit unnoticed in the meantime
+        if db.session.query(VisitModel.visit_id).filter_by(**slot).first() is not None:
+            db.session.rollback()
+            metrics.count("visits_holds_total", result="taken")
+            return make_response(jsonify({"error": "The given date is taken..."}), 409)
+        db.session.commit()
+    except IntegrityError:  # a live hold of the date exists
+        db.session.rollback()
+        row = db.session.query(SlotHold.hold_id, SlotHold.expires).filter_by(**slot).first()
+        if row is not None:
+            remember_hold(doctor_name, visit_date, row.hold_id, row.expires)
+        metrics.count("visits_holds_total", result="held")
+        return make_response(jsonify({"error": "This date is held by someone else..."}), 409)
+
+    remember_hold(doctor_name, visit_date, hold_id, now + seconds)
+    metrics.count("visits_holds_total", result="created")
+    return make_response(jsonify({"hold_id": hold_id, "doctor_name": doctor_name, "visit_date": visit_date,
+                                  "expires": round(now + seconds, 3)}), 201)
+
+
+def find_hold(hold_id):
+    """Reads a hold from the shard keeping it
+
+    :param hold_id: id of the hold
+    :type hold_id: str
+    :returns: index of the shard and doctor_name, visit_date and expires of the hold, None if there is no such hold
+    :rtype: tuple
+    """
+    query = db.session.query(Doctor.doctor_name, SlotHold.visit_date, SlotHold.expires)\
+        .select_from(SlotHold).join(Doctor).filter(SlotHold.hold_id == hold_id)
+    for shard, hold in enumerate(each_shard(query.first)):
+        if hold is not None:
+            return shard, hold
+    return None
+
+
+@visits.route('/hold/<hold_id>/confirm', methods=["POST"])
+@idempotent
+def confirm_hold(hold_id):
+    """POST type method
+
+    Function that turns a hold into a visit, patient's data are given like in POST /visit,
+    the doctor and the date are the held ones
+
+    :param hold_id: id of the hold returned by POST /hold
+    :type hold_id: str
+    :returns: result being a flask.Response object containing either message or error in json format with appropriate code
+    :rtype: flask.Request object
+    """
+    found = find_hold(hold_id)
+    if found is None or found[1].expires <= time.time():
+        metrics.count("visits_holds_total", result="expired")
+        return make_response(jsonify({"error": "Such hold doesn't exist or has expired..."}), 405)
+    shard, hold = found
+    req = parse_args(VISIT_ARGS)
+    req["doctor_name"], req["visit_date"] = hold.doctor_name, hold.visit_date
+    with use_shard(shard):
+        response = book_visit(req, hold_id)
+    if response.status_code == 201:
+        metrics.count("visits_holds_total", result="confirmed")
+    return response
+
+
+@visits.route('/hold/<hold_id>', methods=["DELETE"])
+def delete_hold(hold_id):
+    """DELETE type method
+
+    Function releasing a hold before it expires, so the date can be booked by anyone
+
+    :param hold_id: id of the hold returned by POST /hold
+    :type hold_id: str
+    :returns: result being a flask.Response object containing either message or error in json format with appropriate code
+    :rtype: flask.Request object
+    """
+    found = find_hold(hold_id)
+    if found is None:
+        return make_response(jsonify({"error": "Such hold doesn't exist"}), 405)
+    shard, hold = found
+    with use_shard(shard):
+        db.session.query(SlotHold).filter_by(hold_id=hold_id).delete(synchronize_session=False)
+        db.session.commit()
+    slot_holds.release(hold.doctor_name, hold.visit_date, hold_id)
+    metrics.count("visits_holds_total", result="released")
+    return make_response(jsonify({'message': 'Hold released'}), 200)
+
+
+# Formats of exported and imported visits with their mimetypes
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# Number of visits inserted in one transaction by import_visits
+IMPORT_BATCH = 5000
+
+
+def stream_csv(rows):
+    """Generator of visits in CSV format with a header line
+
+    Rows are taken from shard_rows like in stream_visits, None is written as an empty field
+
+    :param rows: ordered rows of VISIT_COLUMNS
+    :type rows: iterable
+    :returns: generator of chunks of lines
+    :rtype: generator
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(VISIT_FIELDS)
+    for number, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if number % STREAM_CHUNK == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_visits(export_format, archived=False):
+    """Generator of all visits ordered by visit_id
+
+    The visits of every shard are read with a single query through a server-side cursor, so memory doesn't
+    depend on their number and the export is a consistent snapshot of every shard
+
+    :param export_format: one of EXPORT_FORMATS
+    :type export_format: str
+    :param archived: True to export the archived visits too
+    :type archived: bool
+    :returns: generator of chunks of the export
+    :rtype: generator
+    """
+    def query():
+        query = visit_rows()
+        if archived:
+            query = query.union_all(visit_rows(VisitArchive))
+        return query.order_by(VisitModel.visit_id)
+
+    rows = shard_rows(query, "id", None)
+    return stream_csv(rows) if export_format == "csv" else stream_visits(rows)
+
+
+def read_visits(lines, import_format):
+    """Generator of visits read from an export
+
+    :param lines: lines of the export, e.g. a file opened in text mode
+    :type lines: iterable
+    :param import_format: one of EXPORT_FORMATS
+    :type import_format: str
+    :returns: generator of dictionaries of visit's data, empty fields of CSV are None
+    :rtype: generator
+    """
+    if import_format == "csv":
+        for item in csv.DictReader(lines):
+            yield {name: value if value != '' else None for name, value in item.items()}
+        return
+    for line in lines:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+def batches(items, size):
+    """Splits items into lists no longer than size, reading only one list at a time
+
+    :param items: items to split
+    :type items: iterable
+    :param size: length of the lists
+    :type size: int
+    :returns: generator of lists
+    :rtype: generator
+    """
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def import_batch(rows):
+    """Inserts visits of an import kept in the current shard in one transaction
+
+    A batch that breaks the rules of booking is checked by check_batch and only its valid visits are inserted,
+    visits given ids taken in any shard are rejected
+
+    :param rows: column values of the visits returned by batch_row
+    :type rows: list
+    :returns: numbers of imported and rejected visits and patients renamed by the batch
+    :rtype: tuple
+    """
+    valid = rows
+    for checked in (False, True):
+        if checked:
+            valid = [row for row, result in zip(rows, check_batch(rows)) if result is None]
+        doctors, patients, renamed = visit_keys((row["doctor_name"] for row in valid),
+                                                {row["patient_id"]: row["patient_name"] for row in valid})
+        created = [dict(row, visit_id=visit_id) for row, visit_id in zip(valid, assign_ids(valid))
+                   if visit_id is not None]
+        try:
+            insert_visits(created, doctors, patients)
+            rename_patients(renamed)
+            db.session.commit()
+            break
+        except IntegrityError:  # some visits are already booked
+            db.session.rollback()
+            if checked:
+                raise
+    return len(created), len(rows) - len(created), renamed
+
+
+def record_import():
+    """Makes visits written in bulk into the current shard known like other changes
+
+    The change counters are incremented, an "imported" change is logged and the daily counts are rebuilt
+    """
+    db.session.query(ChangeCounter).filter_by(name="visits").update({"value": ChangeCounter.value + 1},
+                                                                    synchronize_session=False)
+    db.session.execute(Doctor.__table__.update().values(changes=Doctor.changes + 1))
+    db.session.execute(Patient.__table__.update().values(changes=Patient.changes + 1))
+    db.session.execute(VisitChange.__table__.insert(), [{
+        "kind": "imported", "visit_id": None, "doctor_id": None, "old_doctor_id": None,
+        "data": json_encoder.encode({"visit_id": None, "old": None, "new": None})}])
+    db.session.commit()
+    rebuild_counts()
+
+
+def import_visits(items, batch=IMPORT_BATCH, rebuild_indexes=False):
+    """Inserts visits read from an export
 
-    visit_id = req["visit_id"]
-    visit_date = req["visit_date"]
-    patient_id = req["patient_id"]
-    patient_name = req["patient_name"]
-    doctor_name = req["doctor_name"]
-    new_entry = VisitModel(visit_id=visit_id, visit_date=visit_date, patient_id=patient_id,
-                           patient_name=patient_name, doctor_name=doctor_name)
+    Visits are inserted with executemany in transactions of batch visits, visits of every shard of a batch
+    in a transaction of their own, written at the same time, see import_batch. At the end the change
+    counters are incremented, an "imported" change is logged and the daily counts are rebuilt in every shard
 
-    db.session.add(new_entry)
+    :param items: dictionaries of visit's data, None for unreadable ones
+    :type items: iterable
+    :param batch: number of visits inserted in one transaction
+    :type batch: int
+    :param rebuild_indexes: True to drop the indexes of the visit table during the import and create them
+    afterwards, which is faster for large imports into a database nobody else writes to; visits booking
+    a date taken by a visit with lower visit_id are then removed
+    :type rebuild_indexes: bool
+    :returns: numbers of imported and rejected visits
+    :rtype: dict
+    """
+    imported = rejected = 0
+    renamed = {}
     db.session.commit()
+    if rebuild_indexes:
+        for engine in each_shard(lambda: db.engine):
+            for index in VisitModel.__table__.indexes:
+                index.drop(engine)
+
+    for items in batches(items, batch):
+        groups = {}
+        for item in items:
+            try:
+                row = batch_row(item)
+            except (TypeError, ValueError):
+                rejected += 1
+                continue
+            groups.setdefault(shard_of(row["doctor_name"]), []).append(row)
+        shards = sorted(groups)
+        for shard_imported, shard_rejected, shard_renamed in fan_out(
+                lambda: import_batch(groups[current_shard()]), shards):
+            imported += shard_imported
+            rejected += shard_rejected
+            renamed.update((patient["id"], patient) for patient in shard_renamed)
+
+    for shard in range(shard_count()):
+        with use_shard(shard):
+            if rebuild_indexes:
+                removed = remove_double_bookings()
+                imported -= removed
+                rejected += removed
+                create_indexes()
+            if db.engine.dialect.name == 'postgresql':
+                db.session.execute("SELECT setval(pg_get_serial_sequence('visit_model', 'visit_id'), "
+                                   "COALESCE(MAX(visit_id), 0) + 1, false) FROM visit_model")
+            record_import()
+    spread_names(list(renamed.values()))
+    with change_signal:
+        change_signal.notify_all()
+    return {"imported": imported, "rejected": rejected}
+
 
-    result = VisitModel.query.filter_by(visit_date=req["visit_date"], doctor_name=req["doctor_name"]).all()
-    if len(result) > 1:  # This fragment ensures the control of cases of simultaneous arrival of identical requests
-        db.session.delete(new_entry)
+def place_visit(row, model):
+    """Inserts a visit moved from another shard into the current one, which is the shard of its doctor
+
+    The visit keeps its id unless the id is taken in the shard, then it gets a new one from counter "visits"
+
+    :param row: column values of the visit with its version
+    :type row: dict
+    :param model: VisitModel for a live visit or VisitArchive for an archived one
+    :type model: class
+    :returns: id given to the visit, None if its date is taken by another visit of the doctor
+    :rtype: int
+    """
+    doctors, patients, _ = visit_keys([row["doctor_name"]], {row["patient_id"]: row["patient_name"]})
+    values = {"visit_id": row["visit_id"], "visit_date": row["visit_date"],
+              "doctor_id": doctors.get(row["doctor_name"]), "patient_key": patients.get(row["patient_id"]),
+              "version": row["version"]}
+    try:
+        db.session.execute(model.__table__.insert(), values)
         db.session.commit()
-        return make_response(jsonify({'error': 'Someone just took this date...'}), 409)
+        return row["visit_id"]
+    except IntegrityError:  # the id or the date is taken
+        db.session.rollback()
+    taken = db.session.query(VisitModel.visit_id).filter_by(doctor_id=values["doctor_id"],
+                                                            visit_date=row["visit_date"]).first()
+    if taken is not None:
+        return None
+    with db.main_engine().begin() as connection:
+        values["visit_id"] = reserve_ids("visits", 1, connection=connection)
+    db.session.execute(model.__table__.insert(), values)
+    db.session.commit()
+    return values["visit_id"]
 
-    return make_response(jsonify({'message': 'New visit created'}), 201)
+
+def misplaced_visit():
+    """Returns id of a live visit of the current shard that belongs to another shard
+
+    :returns: id of the visit, None if all visits belong to the shard
+    :rtype: int
+    """
+    shard = current_shard()
+    others = [doctor_id for doctor_id, doctor_name in db.session.query(Doctor.doctor_id, Doctor.doctor_name)
+              if shard_of(doctor_name) != shard]
+    conditions = []
+    if shard:
+        conditions.append(VisitModel.doctor_id.is_(None))
+    for chunk in in_chunks(others):
+        conditions.append(VisitModel.doctor_id.in_(chunk))
+    if not conditions:
+        return None
+    return db.session.query(VisitModel.visit_id).filter(or_(*conditions)).limit(1).scalar()
+
+
+def sync_id_counters():
+    """Moves the id counters past the ids kept in the databases
+
+    Databases written before the counters existed or used with other SHARD_URIS keep ids the counters
+    haven't given out. Counter "visits" of the main database is moved past the ids of the live and archived
+    visits of all shards, with shards counter "doctors" of every shard past the doctor_ids of the shard
+    """
+    def highest():
+        visit_id = max(db.session.query(db.func.max(model.visit_id)).scalar() or 0
+                       for model in (VisitModel, VisitArchive))
+        if shard_engines:
+            reserve_ids("doctors", 0, (db.session.query(db.func.max(Doctor.doctor_id)).scalar() or 0)
+                        // shard_count())
+        db.session.commit()
+        return visit_id
+
+    visit_id = max(each_shard(highest))
+    with use_shard(0):
+        reserve_ids("visits", 0, visit_id)
+        db.session.commit()
+
+
+def index_visits():
+    """Builds the directory of visits again from the live visits of all shards
+
+    An id kept by live visits of more than one shard, left by databases used before SHARD_URIS was set or
+    changed, stays with the visit of the first shard, the others get new ids, which are logged. Has to run
+    while the application isn't serving requests, ids claimed in the meantime would be lost
+
+    :returns: number of renumbered visits
+    :rtype: int
+    """
+    sync_id_counters()
+    owners = {}
+    duplicates = []
+    for shard in range(shard_count()):
+        with use_shard(shard):
+            for visit_id, in db.session.query(VisitModel.visit_id).yield_per(STREAM_CHUNK):
+                if visit_id in owners:
+                    duplicates.append((visit_id, shard))
+                else:
+                    owners[visit_id] = shard
+            db.session.commit()
+    for visit_id, shard in duplicates:
+        with use_shard(shard):
+            with db.main_engine().begin() as connection:
+                new_id = reserve_ids("visits", 1, connection=connection)
+            db.session.execute(VisitModel.__table__.update().where(VisitModel.visit_id == visit_id)
+                               .values(visit_id=new_id))
+            db.session.commit()
+        owners[new_id] = shard
+        current_app.logger.warning("Visit %s of shard %d was given ID %s", visit_id, shard, new_id)
+    with db.main_engine().begin() as connection:
+        connection.execute(VisitShard.__table__.delete())
+        rows = [{"visit_id": visit_id, "shard": shard} for visit_id, shard in owners.items()]
+        for start in range(0, len(rows), STREAM_CHUNK):
+            connection.execute(VisitShard.__table__.insert(), rows[start:start + STREAM_CHUNK])
+    return len(duplicates)
+
+
+def reshard_visits():
+    """Moves visits kept in a shard they don't belong to into the shard of their doctor
+
+    Databases used before SHARD_URIS was set or changed keep visits of doctors of other shards, such visits
+    are inserted into the right shard first and deleted from the wrong one afterwards, so an interrupted run
+    can be repeated. Visits whose ids are taken in the right shard get new ids, visits booking a date already
+    taken in the right shard are removed like double bookings, both are logged. Archived visits are moved too.
+    At the end the directory of visits is built again, see index_visits, and every shard logs an "imported"
+    change and rebuilds its daily counts. Has to run while the application isn't serving requests
+
+    :returns: numbers of moved, renumbered and removed visits
+    :rtype: dict
+    """
+    moved = renumbered = removed = 0
+    if shard_engines:
+        sync_id_counters()
+    for source in range(shard_count()):
+        for model in (VisitModel, VisitArchive):
+            row_id = VisitArchive.archive_id if model is VisitArchive else VisitModel.visit_id
+            with use_shard(source):
+                query = visit_rows(model).add_columns(model.version, row_id).yield_per(STREAM_CHUNK)
+                rows = [row for row in (dict(zip(VISIT_FIELDS + ("version", "row_id"), row)) for row in query)
+                        if shard_of(row["doctor_name"]) != source]
+                db.session.commit()
+            for row in rows:
+                with use_shard(shard_of(row["doctor_name"])):
+                    visit_id = place_visit(row, model)
+                with use_shard(source):
+                    db.session.execute(model.__table__.delete().where(row_id == row["row_id"]))
+                    db.session.commit()
+                if visit_id is None:
+                    current_app.logger.warning("Removed double booking %s",
+                                               json_encoder.encode({field: row[field] for field in VISIT_FIELDS}))
+                    removed += 1
+                    continue
+                moved += 1
+                if visit_id != row["visit_id"]:
+                    current_app.logger.warning("Visit %s was given ID %s", row["visit_id"], visit_id)
+                    renumbered += 1
+    if shard_engines:
+        renumbered += index_visits()
+    each_shard(record_import)
+    slot_holds.clear()
+    with change_signal:
+        change_signal.notify_all()
+    return {"moved": moved, "renumbered": renumbered, "removed": removed}
+
+
+def file_format(path, given):
+    """Returns format of an export file
+
+    :param path: path of the file
+    :type path: str
+    :param given: format given by the user, None to tell it by the extension
+    :type given: str
+    :returns: one of EXPORT_FORMATS
+    :rtype: str
+    """
+    return given or ("csv" if path.lower().endswith(".csv") else "ndjson")
+
+
+@click.command('export-visits')
+@click.argument('path')
+@click.option('--format', 'export_format', type=click.Choice(list(EXPORT_FORMATS)),
+              help="format of the file, by default csv for .csv files and ndjson for others")
+@click.option('--include-archived', is_flag=True, help="export the archived visits too")
+@with_appcontext
+def export_visits_command(path, export_format, include_archived):
+    """Exports visits to a CSV or NDJSON file, "-" writes them to the standard output"""
+    export_format = file_format(path, export_format)
+    with click.open_file(path, 'w', encoding='utf-8') as file:
+        for chunk in export_visits(export_format, include_archived):
+            file.write(chunk)
+
+
+@click.command('import-visits')
+@click.argument('path')
+@click.option('--format', 'import_format', type=click.Choice(list(EXPORT_FORMATS)),
+              help="format of the file, by default csv for .csv files and ndjson for others")
+@click.option('--batch', type=int, default=IMPORT_BATCH, show_default=True,
+              help="number of visits inserted in one transaction")
+@click.option('--rebuild-indexes', is_flag=True,
+              help="drop the indexes during the import and create them afterwards, only when nobody else writes")
+@with_appcontext
+def import_visits_command(path, import_format, batch, rebuild_indexes):
+    """Imports visits from a CSV or NDJSON file written by export-visits, "-" reads the standard input"""
+    import_format = file_format(path, import_format)
+    with click.open_file(path, 'r', encoding='utf-8') as file:
+        result = import_visits(read_visits(file, import_format), batch, rebuild_indexes)
+    click.echo(f"Imported {result['imported']} visits, rejected {result['rejected']}")
+
+
+@click.command('reshard-visits')
+@with_appcontext
+def reshard_visits_command():
+    """Moves visits into the shards of their doctors after SHARD_URIS was set or changed, while nobody else writes"""
+    result = reshard_visits()
+    click.echo(f"Moved {result['moved']} visits, renumbered {result['renumbered']}, "
+               f"removed {result['removed']} double bookings")
+
+
+@visits.route('/admin/export', methods=["GET"])
+def get_export():
+    """GET type method
+
+    Function that streams all visits, in CSV format with format=csv, in NDJSON format otherwise,
+    with include_archived the archived visits too
+
+    :returns: result being the visits ordered by visit_id
+    :rtype: flask.Request object
+    """
+    error = admin_error()
+    if error is not None:
+        return error
+    export_format = "csv" if request.args.get("format") == "csv" else "ndjson"
+    archived = request.args.get("include_archived", "").lower() in ("1", "true", "yes")
+    return Response(stream_with_context(export_visits(export_format, archived)),
+                    mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': f'attachment; filename=visits.{export_format}'})
+
+
+@visits.route('/admin/import', methods=["POST"])
+def post_import():
+    """POST type method
+
+    Function that imports visits from the body of the request, read in chunks in the format given in format
+    or by Content-Type text/csv, in NDJSON format otherwise
+
+    :returns: result being numbers of imported and rejected visits in json format
+    :rtype: flask.Request object
+    """
+    error = admin_error()
+    if error is not None:
+        return error
+    import_format = "csv" if request.args.get("format") == "csv" or request.mimetype == "text/csv" else "ndjson"
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    return jsonify(import_visits(read_visits(lines, import_format)))
+
+
+def update_conflict_error(req, visit_id):
+    """Finds out which rule was broken by a rejected update
+
+    :param req: parsed arguments of the update
+    :type req: dict
+    :param visit_id: id of the updated visit
+    :type visit_id: int
+    :returns: flask.Response object containing the error message in json format with error code
+    :rtype: flask.Response object
+    """
+    if req["visit_id"] != visit_id and VisitModel.query.get(req["visit_id"]) is not None:
+        return id_taken_error(req["visit_id"])
+    metrics.count("visits_booking_conflicts_total", reason="date_taken")
+    return make_response(jsonify({"error": "The given date is taken, cannot update..."}), 409)
+
+
+def lock_visits():
+    """Makes concurrent writers of visits of the current shard wait until the current transaction ends
+
+    Every write of visits increments counter "visits" in its transaction, see record_changes, so writing
+    the counter row first takes the lock they all need, and visits read afterwards can't be changed by anyone
+    else before commit
+    """
+    db.session.query(ChangeCounter).filter_by(name="visits").update({"value": ChangeCounter.value},
+                                                                    synchronize_session=False)
 
 
-@app.route('/visit/<visit_id>', methods=["PUT"])
+@visits.route('/visit/<visit_id>', methods=["PUT"])
 def update_visit(visit_id):
     """PUT type method
 
-    Function that used here to change already existing records in the database
+    Function that used here to change already existing records in the database. The visit is read and changed
+    in one transaction holding the lock of the writers of visits, see lock_visits, so the read can't be folded
+    into the UPDATE for nothing: the If-Match check and the changes recorded for the change log need the
+    old visit, and with the lock no change can come between them. With the If-Match header holding the ETag
+    returned by GET /visit/id the update is made only if nobody changed the visit since it was read, without
+    it the update is never retried, it waits for the lock instead. Taken ids and dates are rejected by the unique
+    indexes and the directory of visits. The visit is changed in the shard keeping it, it can't be moved
+    to a doctor of another shard
 
     :param visit_id: PrimalKey of an object that we want to change
     :type visit_id: int
     :returns: result being a flask.Response object containing either message or error in json format with appropriate code
     :rtype: flask.Request object
     """
-    req = visit_put_args.parse_args()
-    entry = VisitModel.query.get(visit_id)
-    if not entry:
+    req = parse_args(VISIT_ARGS)
+    try:
+        visit_id = int(visit_id)
+    except ValueError:
+        return make_response(jsonify({"error": "Such visit doesn't exist, cannot update..."}), 405)
+    if req["visit_id"] is None:
+        req["visit_id"] = visit_id
+    shard = id_shard(visit_id)
+    if shard is None:
         return make_response(jsonify({"error": "Such visit doesn't exist, cannot update..."}), 405)
+    if shard_of(req["doctor_name"]) != shard:
+        metrics.count("visits_booking_conflicts_total", reason="other_shard")
+        return make_response(jsonify({"error": "The visit can't be moved to a doctor of another shard..."}), 409)
+    with use_shard(shard):
+        expected = None
+        if request.if_match and not request.if_match.star_tag:
+            expected = {int(tag) for tag in request.if_match.as_set() if tag.isdigit()}
+        doctors, patients, renamed = visit_keys([req["doctor_name"]], {req["patient_id"]: req["patient_name"]})
+        lock_visits()
 
-    result = VisitModel.query.filter_by(visit_id=req["visit_id"]).first()
-    if result and result != entry:
-        return make_response(jsonify({"error": f"Visit ID {req['visit_id']} is already taken..."}), 409)
-
-    if entry.visit_date != req["visit_date"] and entry.doctor_name != req["doctor_name"]:
-        result = VisitModel.query.filter_by(visit_date=req["visit_date"], doctor_name=req["doctor_name"]).first()
-        if result:
-            return make_response(jsonify({"error": "The given date is taken, cannot update..."}), 409)
-
-    entry.visit_id = req["visit_id"]
-    entry.patient_id = req["patient_id"]
-    entry.patient_name = req["patient_name"]
-    entry.doctor_name = req["doctor_name"]
-    entry.visit_date = req["visit_date"]
-    db.session.add(entry)
-    db.session.commit()
-    return make_response(jsonify({'message': 'Visit updated'}), 202)
+        row = visit_rows().add_columns(VisitModel.version).filter(VisitModel.visit_id == visit_id).first()
+        if row is None:
+            db.session.rollback()
+            return make_response(jsonify({"error": "Such visit doesn't exist, cannot update..."}), 405)
+        old, version = dict(zip(VISIT_FIELDS, row[:-1])), row[-1]
+        if expected is not None and version not in expected:
+            db.session.rollback()
+            return make_response(jsonify({"error": "The visit was changed by someone else, read it again..."}), 412)
+        if req["visit_id"] != visit_id and assign_ids([req]) == [None]:
+            db.session.rollback()
+            return id_taken_error(req["visit_id"])
+
+        try:
+            updated = db.session.execute(
+                VisitModel.__table__.update()
+                .where(VisitModel.visit_id == visit_id).where(VisitModel.version == version)
+                .values(visit_id=req["visit_id"], visit_date=req["visit_date"],
+                        doctor_id=doctors.get(req["doctor_name"]), patient_key=patients.get(req["patient_id"]),
+                        version=VisitModel.version + 1)).rowcount
+            if not updated:  # only a writer not taking the lock can change the visit in the meantime
+                db.session.rollback()
+                metrics.count("visits_booking_conflicts_total", reason="changed")
+                return make_response(jsonify({"error": "The visit was changed by someone else, try again..."}), 409)
+            moved = (req["doctor_name"], req["visit_date"]) != (old["doctor_name"], old["visit_date"])
+            if moved and take_hold(doctors.get(req["doctor_name"]), req["doctor_name"], req["visit_date"]):
+                db.session.rollback()
+                return held_error()
+            changes = [(old, dict(req))] + rename_patients(renamed)
+            counter = record_changes(changes)
+            db.session.commit()
+        except IntegrityError:  # unique indexes reject taken ids and dates
+            db.session.rollback()
+            return update_conflict_error(req, visit_id)
 
+        apply_changes(changes, counter)
+        if req["visit_id"] != visit_id:
+            release_ids([visit_id])
+        spread_names(renamed)
+    response = make_response(jsonify({'message': 'Visit updated'}), 202)
+    response.set_etag(str(version + 1))
+    return response
 
-@app.route('/visit/<visit_id>', methods=["DELETE"])
+
+@visits.route('/visit/<visit_id>', methods=["DELETE"])
 def delete_visit(visit_id):
     """DELETE type method
 
@@ -216,28 +3999,196 @@ def delete_visit(visit_id):
     :returns: result being a flask.Response object containing either message or error in json format with appropriate code
     :rtype: flask.Request object
     """
-    entry = VisitModel.query.get(visit_id)
-    if not entry:
+    try:
+        visit_id = int(visit_id)
+    except ValueError:
         return make_response(jsonify({"error": "Such visit doesn't exist"}), 405)
-    db.session.delete(entry)
-    db.session.commit()
+    shard = id_shard(visit_id)
+    if shard is None:
+        return make_response(jsonify({"error": "Such visit doesn't exist"}), 405)
+    with use_shard(shard):
+        entry = VisitModel.query.get(visit_id)
+        if not entry:
+            return make_response(jsonify({"error": "Such visit doesn't exist"}), 405)
+        changes = [(visit_values(entry), None)]
+        db.session.delete(entry)
+        version = record_changes(changes)
+        db.session.commit()
+        apply_changes(changes, version)
+    release_ids([visit_id])
     return make_response(jsonify({'message': 'Visit deleted'}), 209)
 
 
-@app.route('/visit', methods=["DELETE"])
+@visits.route('/visit', methods=["DELETE"])
 def delete_all():
     """DELETE type method 
 
-    Function deleting all objects form the database
+    Function deleting all objects form the database, of all shards at the same time, the directory of visits
+    is emptied with the main database, so the ids can be given again
 
     :returns: result being a flask.Response object containing message in json format with appropriate code confirming the success
     :rtype: flask.Request object
     """
-    db.session.query(VisitModel).delete()
-    db.session.commit()
+    def clear():
+        db.session.query(VisitModel).delete()
+        db.session.query(VisitArchive).delete()
+        db.session.query(SlotHold).delete()
+        if not current_shard():
+            db.session.query(VisitShard).delete()
+            db.session.query(IdCounter).filter_by(name="visits").update({"value": 0})
+        version = record_changes(None)
+        db.session.commit()
+        apply_changes(None, version)
+
+    fan_out(clear)
+    slot_holds.clear()
     return make_response(jsonify({'message': 'You deleted the database'}), 200)
 
 
+def sqlite_pragmas(busy_timeout, synchronous):
+    """Returns listener configuring every new SQLite connection
+
+    WAL journal lets readers work while a write is in progress, the busy timeout makes writers wait
+    for the lock instead of failing with "database is locked"
+
+    :param busy_timeout: time in milliseconds a connection waits for a lock
+    :type busy_timeout: int
+    :param synchronous: value of PRAGMA synchronous
+    :type synchronous: str
+    :returns: listener of the connect event
+    :rtype: function
+    """
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={synchronous}")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+        cursor.close()
+    return on_connect
+
+
+def engine_options(config, uri=None):
+    """Returns SQLAlchemy engine options for the configured database
+
+    :param config: configuration of the application
+    :type config: flask.Config object
+    :param uri: database of a shard, None for the main database
+    :type uri: str
+    :returns: engine options
+    :rtype: dict
+    """
+    url = make_url(uri or config['SQLALCHEMY_DATABASE_URI'])
+    options = {"pool_size": config['DB_POOL_SIZE'], "max_overflow": config['DB_MAX_OVERFLOW'],
+               "pool_pre_ping": True}
+    if url.drivername.startswith('sqlite'):
+        if url.database in (None, '', ':memory:'):
+            return {}
+        # Connections are shared by the threads of a process through the pool
+        options.update(poolclass=QueuePool, connect_args={"check_same_thread": False,
+                                                          "timeout": config['SQLITE_BUSY_TIMEOUT'] / 1000})
+    return options
+
+
+def create_shard_engines(app):
+    """Creates engines of the databases of SHARD_URIS like Flask-SQLAlchemy creates the main one
+
+    Free slots, change counter values and doctor ids known to this process are reset for every shard
+
+    :param app: the application
+    :type app: flask.Flask object
+    """
+    shard_engines.clear()
+    for uri in app.config['SHARD_URIS']:
+        url = make_url(uri)
+        options = {}
+        db.apply_pool_defaults(app, options)
+        db.apply_driver_hacks(app, url, options)
+        options.update(engine_options(app.config, uri))
+        shard_engines.append(db.create_engine(url, options))
+    shard_slots[:] = [SlotIndex() for _ in range(shard_count())]
+    shard_states[:] = [{"version": None, "slots": False, "seq": None, "doctors": None} for _ in range(shard_count())]
+    shard_doctor_ids[:] = [{} for _ in range(shard_count())]
+
+
+def create_app(config=None):
+    """Creates the application
+
+    Function that configures the database engines, creates missing tables and indexes in every shard, fills
+    the daily counts of visits of databases that had no counts yet and fills free_slots.
+    Serve it with a multi-process WSGI server, e.g. gunicorn -w 4 --preload "restAPI:create_app()"
+
+    :param config: values overriding DEFAULT_CONFIG, the DATABASE_URI environment variable and VISITS_SETTINGS file
+    :type config: dict
+    :returns: the application
+    :rtype: flask.Flask object
+    """
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    if 'DATABASE_URI' in os.environ:
+        app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URI']
+    app.config.from_envvar('VISITS_SETTINGS', silent=True)
+    app.config.update(config or {})
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+
+    db.init_app(app)
+    ma.init_app(app)
+    app.register_blueprint(visits)
+    app.cli.add_command(rebuild_counts_command)
+    app.cli.add_command(archive_visits_command)
+    app.cli.add_command(export_visits_command)
+    app.cli.add_command(import_visits_command)
+    app.cli.add_command(reshard_visits_command)
+    visit_cache.maxsize = app.config['VISIT_CACHE_SIZE']
+    metrics.enabled = app.config['METRICS']
+    profiler.configure(app.config['PROFILE_DIR'], app.config['PROFILE_SAMPLE'], app.config['PROFILE_SLOW_MS'],
+                       app.config['PROFILE_KEEP'], app.config['PROFILE_INTERVAL_MS'])
+
+    with app.app_context():
+        create_shard_engines(app)
+        for engine in each_shard(lambda: db.engine):
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', sqlite_pragmas(app.config['SQLITE_BUSY_TIMEOUT'],
+                                                               app.config['SQLITE_SYNCHRONOUS']))
+            if app.config['METRICS']:
+                event.listen(engine, 'before_cursor_execute', start_statement)
+                event.listen(engine, 'after_cursor_execute', end_statement)
+            if profiler.enabled:
+                event.listen(engine, 'before_cursor_execute', start_profiled_statement)
+                event.listen(engine, 'after_cursor_execute', end_profiled_statement)
+        for shard in range(shard_count()):
+            with use_shard(shard):
+                db.create_all()
+                migrate_visits()
+                add_columns()
+                create_indexes()
+                create_search_index()
+                fill_search_names()
+                create_counters()
+                db.session.remove()
+        sync_id_counters()
+        for shard in range(shard_count()):
+            with use_shard(shard):
+                doctor_keys(name for name in app.config['DOCTORS'] if shard_of(name) == shard)
+                db.session.commit()
+                if VisitCount.query.first() is None and \
+                        (VisitModel.query.first() is not None or VisitArchive.query.first() is not None):
+                    rebuild_counts()
+                if shard_engines and misplaced_visit() is not None:
+                    app.logger.warning("Shard %d keeps visits of other shards, move them with flask reshard-visits",
+                                       shard)
+                sync_local_state(True)
+                # The session doesn't keep objects of one shard for the next one
+                db.session.remove()
+        if shard_engines and VisitShard.query.count() != sum(each_shard(lambda: VisitModel.query.count())):
+            app.logger.warning("The directory of visits doesn't match the visits, build it with flask reshard-visits")
+        db.session.remove()
+        # Worker processes forked from this one must not share its connections,
+        # an in-memory database lives only as long as its single connection
+        for engine in each_shard(lambda: db.engine):
+            if engine.url.database not in (None, '', ':memory:'):
+                engine.dispose()
+    return app
+
+
 if __name__ == '__main__':
-    db.create_all()
-    app.run(debug=True)
+    create_app().run(debug=os.environ.get('FLASK_DEBUG') == '1', threaded=True)
@@ -0,0 +1,301 @@
+import datetime
+import heapq
+import threading
+import time
+
+"""
+slots.py
+========================================================
+In-memory index of the taken visit dates of every doctor and of the held ones
+"""
+
+# Working hours of the hospital, the same as checked by date_check in menu.py
+FIRST_HOUR = 8
+LAST_HOUR = 18
+FULL_DAY = (1 << (LAST_HOUR - FIRST_HOUR + 1)) - 1
+# How many days ahead the next free date is searched for
+SEARCH_DAYS = 366
+
+
+def split_date(visit_date):
+    """Splits visit date into day and hour
+
+    :param visit_date: date in 1YYMMDDHH format
+    :type visit_date: int
+    :returns: day in 1YYMMDD format and hour
+    :rtype: tuple
+    """
+    return visit_date // 100, visit_date % 100
+
+
+def day_to_date(day):
+    """Converts day in 1YYMMDD format to datetime.date object
+
+    :param day: day in 1YYMMDD format
+    :type day: int
+    :returns: the same day as datetime.date object
+    :rtype: datetime.date
+    :raises ValueError: if the day doesn't exist
+    """
+    return datetime.date(2000 + day // 10000 % 100, day // 100 % 100, day % 100)
+
+
+def date_to_day(date):
+    """Converts datetime.date object to day in 1YYMMDD format
+
+    :param date: the day
+    :type date: datetime.date
+    :returns: day in 1YYMMDD format
+    :rtype: int
+    """
+    return 1000000 + (date.year - 2000) * 10000 + date.month * 100 + date.day
+
+
+class SlotIndex:
+    """Occupancy of the hourly grid of every doctor
+
+    Every day of a doctor is kept as a bitmap, bit i is set when the hour FIRST_HOUR + i is taken,
+    so free dates are found without querying the database. The index has to be updated after every
+    committed change of the visits
+    """
+    def __init__(self):
+        self._days = {}
+        self._lock = threading.Lock()
+
+    def rebuild(self, visits):
+        """Replaces the content of the index
+
+        :param visits: pairs of doctor's name and visit date of all visits
+        :type visits: iterable
+        """
+        days = {}
+        for doctor_name, visit_date in visits:
+            if visit_date is None:
+                continue
+            day, hour = split_date(visit_date)
+            if FIRST_HOUR <= hour <= LAST_HOUR:
+                doctor_days = days.setdefault(doctor_name, {})
+                doctor_days[day] = doctor_days.get(day, 0) | 1 << (hour - FIRST_HOUR)
+        with self._lock:
+            self._days = days
+
+    def add(self, doctor_name, visit_date):
+        """Marks the date of a doctor as taken
+
+        :param doctor_name: name of a doctor
+        :type doctor_name: str
+        :param visit_date: date in 1YYMMDDHH format, None for a visit without a date
+        :type visit_date: int
+        """
+        if visit_date is None:
+            return
+        day, hour = split_date(visit_date)
+        if FIRST_HOUR <= hour <= LAST_HOUR:
+            with self._lock:
+                doctor_days = self._days.setdefault(doctor_name, {})
+                doctor_days[day] = doctor_days.get(day, 0) | 1 << (hour - FIRST_HOUR)
+
+    def remove(self, doctor_name, visit_date):
+        """Marks the date of a doctor as free
+
+        :param doctor_name: name of a doctor
+        :type doctor_name: str
+        :param visit_date: date in 1YYMMDDHH format, None for a visit without a date
+        :type visit_date: int
+        """
+        if visit_date is None:
+            return
+        day, hour = split_date(visit_date)
+        if not FIRST_HOUR <= hour <= LAST_HOUR:
+            return
+        with self._lock:
+            doctor_days = self._days.get(doctor_name, {})
+            if day in doctor_days:
+                doctor_days[day] &= ~(1 << (hour - FIRST_HOUR))
+                if not doctor_days[day]:
+                    del doctor_days[day]
+
+    def clear(self):
+        """Marks all dates as free"""
+        with self._lock:
+            self._days = {}
+
+    def doctors(self):
+        """Returns names of the doctors that have any visits
+
+        :returns: list of doctors' names
+        :rtype: list
+        """
+        with self._lock:
+            return [doctor_name for doctor_name, doctor_days in self._days.items() if doctor_days]
+
+    def taken(self, doctor_name, day):
+        """Returns the bitmap of taken hours of a doctor in a given day
+
+        :param doctor_name: name of a doctor
+        :type doctor_name: str
+        :param day: day in 1YYMMDD format
+        :type day: int
+        :returns: bitmap of taken hours
+        :rtype: int
+        """
+        with self._lock:
+            return self._days.get(doctor_name, {}).get(day, 0)
+
+    def free(self, doctor_name, day, held=0):
+        """Returns free dates of a doctor in a given day
+
+        :param doctor_name: name of a doctor
+        :type doctor_name: str
+        :param day: day in 1YYMMDD format
+        :type day: int
+        :param held: bitmap of held hours of the day, they aren't free either
+        :type held: int
+        :returns: list of free dates in 1YYMMDDHH format
+        :rtype: list
+        """
+        free = ~(self.taken(doctor_name, day) | held) & FULL_DAY
+        return [day * 100 + FIRST_HOUR + i for i in range(LAST_HOUR - FIRST_HOUR + 1) if free >> i & 1]
+
+    def next_free(self, doctor_name, visit_date, held=None):
+        """Returns the first free date of a doctor not earlier than a given date
+
+        :param doctor_name: name of a doctor
+        :type doctor_name: str
+        :param visit_date: date in 1YYMMDDHH format
+        :type visit_date: int
+        :param held: bitmaps of held hours by day, see SlotHolds.held_hours, they aren't free either
+        :type held: dict
+        :returns: the first free date in 1YYMMDDHH format or None if there is none in SEARCH_DAYS days
+        :rtype: int
+        :raises ValueError: if the given day doesn't exist
+        """
+        held = held or {}
+        day, hour = split_date(visit_date)
+        date = day_to_date(day)
+        first_bit = max(hour - FIRST_HOUR, 0)
+        for _ in range(SEARCH_DAYS):
+            day = date_to_day(date)
+            free = ~(self.taken(doctor_name, day) | held.get(day, 0)) & FULL_DAY & ~((1 << first_bit) - 1)
+            if free:
+                return day * 100 + FIRST_HOUR + (free & -free).bit_length() - 1
+            date += datetime.timedelta(days=1)
+            first_bit = 0
+            if date.year > 2099:
+                break
+        return None
+
+
+class SlotHolds:
+    """Time-limited holds of dates of doctors known to this process
+
+    Holds are kept by doctor with their ids and the time they expire, expired holds are dropped in the order
+    of expiry, so answering whether a date is held takes two dictionary lookups and the held hours of a doctor
+    are found among the holds of the doctor only
+    """
+    def __init__(self):
+        self._holds = {}
+        self._expiry = []
+        self._lock = threading.Lock()
+
+    def hold(self, doctor_name, visit_date, hold_id, expires):
+        """Marks the date of a doctor as held
+
+        :param doctor_name: name of a doctor
+        :type doctor_name: str
+        :param visit_date: date in 1YYMMDDHH format
+        :type visit_date: int
+        :param hold_id: id of the hold, None for a hold of another process
+        :type hold_id: str
+        :param expires: time the hold expires in seconds since the epoch
+        :type expires: float
+        """
+        with self._lock:
+            self._prune(time.time())
+            self._holds.setdefault(doctor_name, {})[visit_date] = (hold_id, expires)
+            heapq.heappush(self._expiry, (expires, doctor_name, visit_date))
+
+    def holder(self, doctor_name, visit_date):
+        """Returns the hold of the date of a doctor
+
+        :param doctor_name: name of a doctor
+        :type doctor_name: str
+        :param visit_date: date in 1YYMMDDHH format
+        :type visit_date: int
+        :returns: id of the hold and the time it expires, None if the date isn't held
+        :rtype: tuple
+        """
+        with self._lock:
+            hold = self._holds.get(doctor_name, {}).get(visit_date)
+            if hold is not None and hold[1] <= time.time():
+                return None
+            return hold
+
+    def held_hours(self, doctor_name):
+        """Returns the held hours of a doctor
+
+        :param doctor_name: name of a doctor
+        :type doctor_name: str
+        :returns: bitmap of held hours by day in 1YYMMDD format, bit i is set when the hour FIRST_HOUR + i is held
+        :rtype: dict
+        """
+        now = time.time()
+        held = {}
+        with self._lock:
+            for visit_date, (_, expires) in self._holds.get(doctor_name, {}).items():
+                day, hour = split_date(visit_date)
+                if expires > now and FIRST_HOUR <= hour <= LAST_HOUR:
+                    held[day] = held.get(day, 0) | 1 << (hour - FIRST_HOUR)
+        return held
+
+    def release(self, doctor_name, visit_date, hold_id=None):
+        """Removes the hold of the date of a doctor
+
+        :param doctor_name: name of a doctor
+        :type doctor_name: str
+        :param visit_date: date in 1YYMMDDHH format
+        :type visit_date: int
+        :param hold_id: id of the hold, None for any hold
+        :type hold_id: str
+        """
+        with self._lock:
+            hold = self._holds.get(doctor_name, {}).get(visit_date)
+            if hold is not None and (hold_id is None or hold[0] == hold_id):
+                self._remove(doctor_name, visit_date)
+
+    def replace(self, holds):
+        """Replaces all holds, e.g. by the holds read from the database
+
+        :param holds: quadruples of doctor's name, visit date, hold id and the time the hold expires
+        :type holds: iterable
+        """
+        now = time.time()
+        doctors = {}
+        expiry = []
+        for doctor_name, visit_date, hold_id, expires in holds:
+            if expires > now:
+                doctors.setdefault(doctor_name, {})[visit_date] = (hold_id, expires)
+                expiry.append((expires, doctor_name, visit_date))
+        heapq.heapify(expiry)
+        with self._lock:
+            self._holds = doctors
+            self._expiry = expiry
+
+    def clear(self):
+        """Removes all holds"""
+        with self._lock:
+            self._holds = {}
+            self._expiry = []
+
+    def _remove(self, doctor_name, visit_date):
+        doctor_holds = self._holds[doctor_name]
+        del doctor_holds[visit_date]
+        if not doctor_holds:
+            del self._holds[doctor_name]
+
+    def _prune(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            expires, doctor_name, visit_date = heapq.heappop(self._expiry)
+            hold = self._holds.get(doctor_name, {}).get(visit_date)
+            if hold is not None and hold[1] <= now:
+                self._remove(doctor_name, visit_date)
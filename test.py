@@ -1,4 +1,4 @@
-import requests
+from client import VisitClient
 
 """Add 5 users to database
 """
@@ -18,6 +18,6 @@ data = [{"visit_date": 112123012, "patient_id": 12345678934, "patient_name": "Ja
         {"visit_date": 112080816, "patient_id": 12345678934, "patient_name": "Jan Kowalski",
          "doctor_name": "Adam Nadobny"}]
 
-for i in data:
-    response = requests.post(BASE + "visit", i)
-    print(response.json())
+with VisitClient(BASE) as client:
+    for outcome in client.create_many(data):
+        print({"message": outcome.message} if outcome.ok else {"error": outcome.error})